@@ -0,0 +1,190 @@
+import os
+import logging
+import re
+import json
+import time
+import hashlib
+import threading
+from collections import OrderedDict
+
+import numpy as np
+
+import metrics
+from search_index import STOPWORDS
+
+logger = logging.getLogger(__name__)
+
+# Cache of model answers keyed by the normalized question, the content
+# version of the document store and the conversation history window sent
+# with the prompt. The content version is a digest of the stored documents,
+# so any add or clear yields a new version and older answers are simply no
+# longer reachable; they age out through the entry cap and the TTL. Sessions
+# that uploaded the same report share a version and therefore share answers.
+#
+# Optionally, a differently worded question is matched against the cached
+# questions of the same store version and history using the store's
+# retrieval embedder. Embeddings barely tell "store 12" from "store 13", so
+# only cached questions with the same numbers, operators and capitalised
+# names are compared.
+
+ANSWER_CACHE_MAX_ENTRIES = int(os.getenv("ANSWER_CACHE_MAX_ENTRIES", "1024"))
+ANSWER_CACHE_TTL_SECONDS = int(os.getenv("ANSWER_CACHE_TTL_SECONDS", "3600"))
+# Cosine similarity from which a cached question counts as the same question; 0 (the default) disables the lookup
+ANSWER_CACHE_SIMILARITY = float(os.getenv("ANSWER_CACHE_SIMILARITY", "0"))
+
+WORD_PATTERN = re.compile(r"\w+")
+# Words, numbers with their sign, decimals and percent sign, and comparison
+# operators: "growth > -5%" and "growth < 5%" must not share an answer. The
+# hyphen of a compound word ("year-end") is not an operator.
+TOKEN_PATTERN = re.compile(r"(?<![\w.])-?\d+(?:[.,]\d+)*%?(?!\w)|[<>=!]=?|%|(?<![^\W\d_])-|-(?![^\W\d_])|\w+")
+OPERATOR_CHARS = "<>=!%-"
+
+# Stopwords that still change the meaning of a question and are kept for the similarity lookup
+MEANINGFUL_STOPWORDS = {'belum'}
+
+
+def normalize_query(query):
+    """Lowercased words, numbers and operators of the question, without other punctuation or extra whitespace"""
+    return " ".join(TOKEN_PATTERN.findall(query.lower()))
+
+
+def similarity_text(query):
+    """Question without stopwords, so that filler words do not lower the similarity"""
+    words = WORD_PATTERN.findall(query.lower())
+    return " ".join(w for w in words if w not in STOPWORDS or w in MEANINGFUL_STOPWORDS)
+
+
+def key_terms(query):
+    """Numbers, operators and capitalised names of the question, which a reworded question has to keep"""
+    return frozenset(w.lower() for w in TOKEN_PATTERN.findall(query)
+                     if any(c.isdigit() for c in w) or w[0] in OPERATOR_CHARS
+                     or (w[0].isupper() and w.lower() not in STOPWORDS))
+
+
+def history_key(history):
+    if not history:
+        return ""
+    return hashlib.sha1(json.dumps(history, ensure_ascii=False).encode('utf-8')).hexdigest()
+
+
+class AnswerCache:
+    """LRU and TTL bounded map of (store version, history, question) to answer"""
+
+    def __init__(self, max_entries=ANSWER_CACHE_MAX_ENTRIES, ttl_seconds=ANSWER_CACHE_TTL_SECONDS,
+                 similarity=ANSWER_CACHE_SIMILARITY):
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self.similarity = similarity
+        self.entries = OrderedDict()
+        # (version, history) -> keys of its entries, for the near-duplicate lookup
+        self.contexts = {}
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.near_hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    def _embed(self, embedder, query):
+        if embedder is None or self.similarity <= 0:
+            return None
+        try:
+            return embedder.embed([similarity_text(query)])[0]
+        except Exception as e:
+            logger.warning("Error embedding query for the answer cache: %s", e)
+            return None
+
+    def get(self, query, version, history=None, embedder=None):
+        """Cached answer for the question, or None"""
+        normalized = normalize_query(query)
+        context = (version, history_key(history))
+        key = context + (normalized,)
+        now = time.time()
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and now - entry["created"] > self.ttl_seconds:
+                self._remove_locked(key)
+                self.expirations += 1
+                entry = None
+            if entry is not None:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return entry["answer"]
+            terms = key_terms(query)
+            candidates = [(k, self.entries[k]["vector"]) for k in self.contexts.get(context, ())
+                          if self.entries[k]["vector"] is not None and self.entries[k]["terms"] == terms]
+
+        if candidates:
+            vector = self._embed(embedder, query)
+            if vector is not None:
+                keys = [k for k, _ in candidates]
+                similarities = np.stack([v for _, v in candidates]) @ vector
+                best = int(np.argmax(similarities))
+                if similarities[best] >= self.similarity:
+                    with self.lock:
+                        entry = self.entries.get(keys[best])
+                        if entry is not None and now - entry["created"] <= self.ttl_seconds:
+                            self.entries.move_to_end(keys[best])
+                            self.near_hits += 1
+                            return entry["answer"]
+
+        with self.lock:
+            self.misses += 1
+        return None
+
+    def put(self, query, version, answer, history=None, embedder=None):
+        normalized = normalize_query(query)
+        context = (version, history_key(history))
+        key = context + (normalized,)
+        vector = self._embed(embedder, query)
+        with self.lock:
+            if key in self.entries:
+                self._remove_locked(key)
+            self.entries[key] = {"answer": answer, "created": time.time(), "vector": vector,
+                                 "terms": key_terms(query)}
+            self.contexts.setdefault(context, set()).add(key)
+            while len(self.entries) > self.max_entries:
+                self._remove_locked(next(iter(self.entries)))
+                self.evictions += 1
+
+    def _remove_locked(self, key):
+        del self.entries[key]
+        keys = self.contexts.get(key[:2])
+        if keys is not None:
+            keys.discard(key)
+            if not keys:
+                del self.contexts[key[:2]]
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.contexts.clear()
+
+    def stats(self):
+        with self.lock:
+            lookups = self.hits + self.near_hits + self.misses
+            return {
+                "entries": len(self.entries),
+                "hits": self.hits,
+                "near_hits": self.near_hits,
+                "misses": self.misses,
+                "hit_rate": (self.hits + self.near_hits) / lookups if lookups else 0.0,
+                "evictions": self.evictions,
+                "expirations": self.expirations,
+            }
+
+
+answer_cache = AnswerCache()
+
+
+def _collect_metrics():
+    stats = answer_cache.stats()
+    return [
+        ("chatbot_answer_cache_lookups_total", "counter", "Answer cache lookups by result",
+         [({"result": result}, stats[key]) for result, key in
+          (("hit", "hits"), ("near_hit", "near_hits"), ("miss", "misses"))]),
+        ("chatbot_answer_cache_entries", "gauge", "Answers held in the answer cache", [({}, stats["entries"])]),
+    ]
+
+
+metrics.register_collector(_collect_metrics)
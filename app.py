@@ -1,29 +1,100 @@
 import os
-from flask import Flask, render_template, request, jsonify, redirect, url_for
-from dotenv import load_dotenv
+import logging
+import re
+import json
 import uuid
-from werkzeug.utils import secure_filename
+from flask import Flask, Request, render_template, request, jsonify, redirect, url_for, Response, stream_with_context, g
+from dotenv import load_dotenv
 import os.path
 
-# Import document processors
-from document_processor import process_document
-from chatbot import get_answer_from_docs
-
 # Load environment variables
 load_dotenv()
 
+# Log level of the application loggers (DEBUG shows per-query retrieval and prompt details)
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").upper()
+logging.basicConfig(level=LOG_LEVEL, format="%(asctime)s %(levelname)s %(name)s: %(message)s")
+logger = logging.getLogger(__name__)
+
+# Import document processors
+from chatbot import get_answer_from_docs, stream_answer_from_docs
+from ingest_queue import ingestion_queue, QueueFullError
+from parse_cache import remember_file_hash, parse_cache
+from answer_cache import answer_cache
+from sessions import session_manager, set_current_session
+import metrics
+from metrics import stage_timer
+from debug_trace import trace_buffer
+from upload_manifest import upload_manifest
+from uploads import (UPLOAD_FOLDER, ALLOWED_EXTENSIONS, MAX_UPLOAD_BYTES, RESUMABLE_CHUNK_BYTES, UploadRejected,
+                     open_upload, safe_filename, upload_path, resumable_uploads)
+
+
+class UploadRequest(Request):
+    """Request whose uploaded file is streamed straight into an UploadWriter,
+    instead of a temporary file that would be copied again afterwards"""
+
+    def _get_file_stream(self, total_content_length, content_type, filename=None, content_length=None):
+        if self.endpoint != 'upload_file' or not filename:
+            return super()._get_file_stream(total_content_length, content_type, filename, content_length)
+        writer = open_upload(filename)
+        g.upload_writers.append(writer)
+        return writer
+
+
 app = Flask(__name__)
+app.request_class = UploadRequest
 
 # Configure upload folder
-UPLOAD_FOLDER = 'uploads'
-ALLOWED_EXTENSIONS = {'docx', 'xlsx', 'xls', 'pdf', 'txt'}
 app.config['UPLOAD_FOLDER'] = UPLOAD_FOLDER
-app.config['MAX_CONTENT_LENGTH'] = 16 * 1024 * 1024  # 16MB max upload size
+# Room for the multipart headers around the largest accepted file
+app.config['MAX_CONTENT_LENGTH'] = MAX_UPLOAD_BYTES + 1024 * 1024
 
 # Create uploads folder if it doesn't exist
 if not os.path.exists(UPLOAD_FOLDER):
     os.makedirs(UPLOAD_FOLDER)
 
+# Each browser gets its own document store and history, identified by a cookie
+SESSION_COOKIE = 'chat_session'
+SESSION_ID_PATTERN = re.compile(r'^[0-9a-f]{32}$')
+
+# Background jobs start with the first request, not at import: ingestion
+# workers import this module too when it is the main script
+@app.before_request
+def start_background_jobs():
+    # Delete old uploads and their cached artifacts
+    upload_manifest.start_retention()
+
+@app.before_request
+def load_session():
+    session_id = request.cookies.get(SESSION_COOKIE, '')
+    g.new_session = not SESSION_ID_PATTERN.match(session_id)
+    if g.new_session:
+        session_id = uuid.uuid4().hex
+    g.session_id = session_id
+    g.upload_writers = []
+    set_current_session(session_id)
+
+@app.after_request
+def save_session(response):
+    if getattr(g, 'new_session', False):
+        response.set_cookie(SESSION_COOKIE, g.session_id, httponly=True, samesite='Lax')
+    return response
+
+@app.teardown_request
+def discard_uploads(error=None):
+    # Files of a rejected or failed upload are deleted; finished ones were moved already
+    for writer in g.get('upload_writers', ()):
+        writer.discard()
+
+@app.errorhandler(UploadRejected)
+def upload_rejected(error):
+    logger.warning("Rejecting upload: %s", error)
+    return jsonify({'error': str(error)}), error.status
+
+@app.errorhandler(413)
+def request_too_large(error):
+    return jsonify({'error': f"File is larger than {MAX_UPLOAD_BYTES // (1024 * 1024)}MB"}), 413
+
 # Function to check allowed file extensions
 def allowed_file(filename):
     return '.' in filename and filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
@@ -32,48 +103,149 @@ def allowed_file(filename):
 def index():
     return render_template('index.html')
 
+def queue_upload(file_path, filename, content_hash):
+    """Start the ingestion job of a stored upload; returns (job, None) or (None, error response)"""
+    remember_file_hash(file_path, content_hash)
+    upload_manifest.record(file_path, filename, content_hash, g.session_id)
+    try:
+        job = ingestion_queue.submit(file_path, filename, content_hash, session_id=g.session_id)
+    except QueueFullError as e:
+        logger.warning("Rejecting upload, %s", e)
+        upload_manifest.forget(file_path)
+        response = jsonify({'error': 'Server is busy processing other documents, please retry shortly', 'filename': filename})
+        response.headers['Retry-After'] = '5'
+        return None, (response, 429)
+    except Exception as e:
+        logger.exception("Exception while queueing document: %s", e)
+        upload_manifest.forget(file_path)
+        return None, (jsonify({'error': f"Error processing document: {str(e)}", 'filename': filename}), 500)
+    
+    logger.info("Queued document processing job %s for %s", job['job_id'], file_path)
+    return job, None
+
+def job_accepted(job, filename):
+    return jsonify({
+        'success': True,
+        'message': 'Document uploaded, processing started',
+        'filename': filename,
+        'job_id': job['job_id'],
+        'status_url': url_for('upload_status', job_id=job['job_id']),
+    }), 202
+
 @app.route('/upload', methods=['POST'])
 def upload_file():
-    print("Received upload request")
-    if 'file' not in request.files:
-        print("Error: No file part in request")
+    logger.debug("Received upload request")
+    # Parsing the form streams the file to disk, hashing and type-checking it on the way
+    with stage_timer("upload_save"):
+        files = request.files
+    if 'file' not in files:
+        logger.warning("No file part in request")
         return jsonify({'error': 'No file part'}), 400
         
-    file = request.files['file']
-    print(f"File received: {file.filename}")
+    file = files['file']
+    logger.debug("File received: %s", file.filename)
     
     if file.filename == '':
-        print("Error: Empty filename")
+        logger.warning("Empty filename")
         return jsonify({'error': 'No selected file'}), 400
         
     if file and allowed_file(file.filename):
-        # Generate unique filename
-        filename = secure_filename(file.filename)
-        unique_filename = f"{uuid.uuid4()}_{filename}"
-        file_path = os.path.join(app.config['UPLOAD_FOLDER'], unique_filename)
+        filename = safe_filename(file.filename)
+        file_path = upload_path(filename)
+        content_hash = file.stream.finish(file_path)
+        logger.info("File saved to %s (sha256 %s)", file_path, content_hash[:12])
         
-        print(f"Saving file to: {file_path}")
-        # Save file
-        file.save(file_path)
-        print(f"File saved successfully")
-        
-        # Process document
-        try:
-            print(f"Starting document processing for {file_path}")
-            success = process_document(file_path)
-            if success:
-                print("Document processed successfully")
-                return jsonify({'success': True, 'message': 'Document uploaded and processed successfully', 'filename': filename})
-            else:
-                print("Document processing failed")
-                return jsonify({'error': 'Failed to process document', 'filename': filename}), 500
-        except Exception as e:
-            print(f"Exception during document processing: {str(e)}")
-            return jsonify({'error': f"Error processing document: {str(e)}", 'filename': filename}), 500
+        # Queue document for background processing
+        job, error = queue_upload(file_path, filename, content_hash)
+        if error is not None:
+            os.remove(file_path)
+            return error
+        return job_accepted(job, filename)
     
-    print(f"File type not allowed: {file.filename}")
+    logger.warning("File type not allowed: %s", file.filename)
     return jsonify({'error': 'File type not allowed'}), 400
 
+# Resumable uploads: POST starts one, PUT appends the chunk starting at the
+# Upload-Offset header, GET tells where an interrupted upload continues
+@app.route('/upload/resumable', methods=['POST'])
+def resumable_create():
+    data = request.get_json(silent=True) or {}
+    record = resumable_uploads.create(data.get('filename', ''), data.get('size'), g.session_id)
+    return jsonify({
+        'upload_id': record['upload_id'],
+        'filename': record['filename'],
+        'offset': 0,
+        'chunk_size': RESUMABLE_CHUNK_BYTES,
+        'upload_url': url_for('resumable_append', upload_id=record['upload_id']),
+    }), 201
+
+@app.route('/upload/resumable/<upload_id>', methods=['GET'])
+def resumable_status(upload_id):
+    record = resumable_uploads.get(upload_id, g.session_id)
+    if record is None:
+        return jsonify({'error': 'Unknown upload id'}), 404
+    return jsonify({'upload_id': upload_id, 'offset': record['offset'], 'size': record['size']})
+
+@app.route('/upload/resumable/<upload_id>', methods=['PUT'])
+def resumable_append(upload_id):
+    record = resumable_uploads.get(upload_id, g.session_id)
+    if record is None:
+        return jsonify({'error': 'Unknown upload id'}), 404
+    offset = request.headers.get('Upload-Offset', type=int)
+    if offset is None:
+        return jsonify({'error': 'Upload-Offset header required'}), 400
+    
+    filename = record['filename']
+    file_path = upload_path(filename)
+    with stage_timer("upload_save"):
+        offset, content_hash = resumable_uploads.append(record, offset, request.stream, file_path)
+    if content_hash is None:
+        return jsonify({'upload_id': upload_id, 'offset': offset, 'size': record['size']})
+    logger.info("Resumable upload %s saved to %s (sha256 %s)", upload_id, file_path, content_hash[:12])
+    
+    job, error = queue_upload(file_path, filename, content_hash)
+    if error is not None:
+        # Kept complete, so a repeated final PUT with no body starts the job
+        resumable_uploads.restore(record, file_path)
+        return error
+    resumable_uploads.remove(upload_id)
+    return job_accepted(job, filename)
+
+@app.route('/upload/resumable/<upload_id>', methods=['DELETE'])
+def resumable_cancel(upload_id):
+    if resumable_uploads.get(upload_id, g.session_id) is None:
+        return jsonify({'error': 'Unknown upload id'}), 404
+    resumable_uploads.remove(upload_id)
+    return '', 204
+
+@app.route('/upload/<job_id>', methods=['GET'])
+def upload_status(job_id):
+    job = ingestion_queue.get(job_id)
+    # Jobs are only visible to the session that uploaded the file
+    if job is None or job['session_id'] != g.session_id:
+        return jsonify({'error': 'Unknown job id'}), 404
+    job.pop('session_id')
+    return jsonify(job)
+
+@app.route('/cache/stats', methods=['GET'])
+def cache_stats():
+    return jsonify({'answers': answer_cache.stats(), 'parse': parse_cache.stats()})
+
+@app.route('/metrics', methods=['GET'])
+def metrics_endpoint():
+    if not metrics.METRICS_ENABLED:
+        return jsonify({'error': 'Metrics are disabled'}), 404
+    return Response(metrics.render(), mimetype='text/plain; version=0.0.4')
+
+@app.route('/debug/traces', methods=['GET'])
+def debug_traces():
+    if not trace_buffer.enabled:
+        return jsonify({'error': 'Debug traces are disabled'}), 404
+    limit = request.args.get('limit', type=int)
+    # Traces contain document text, so a session only sees its own
+    return jsonify({'traces': trace_buffer.recent(limit, session_id=g.session_id),
+                    'recorded': trace_buffer.recorded, 'skipped': trace_buffer.skipped})
+
 @app.route('/chat', methods=['POST'])
 def chat():
     data = request.json
@@ -83,10 +255,36 @@ def chat():
     user_message = data['message']
     
     try:
-        response = get_answer_from_docs(user_message)
+        response = get_answer_from_docs(user_message, session_manager.get(g.session_id))
         return jsonify({'response': response})
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
+@app.route('/chat/stream', methods=['POST'])
+def chat_stream():
+    data = request.json
+    if not data or 'message' not in data:
+        return jsonify({'error': 'No message provided'}), 400
+    
+    user_message = data['message']
+    session = session_manager.get(g.session_id)
+    
+    # Server-sent events: one "data" event per text delta, then "done" (or "error")
+    def generate():
+        try:
+            for delta in stream_answer_from_docs(user_message, session):
+                yield f"data: {json.dumps({'delta': delta})}\n\n"
+            yield "event: done\ndata: {}\n\n"
+        except Exception as e:
+            logger.exception("Exception during streamed chat: %s", e)
+            yield f"event: error\ndata: {json.dumps({'error': str(e)})}\n\n"
+    
+    return Response(
+        stream_with_context(generate()),
+        mimetype='text/event-stream',
+        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'},
+    )
+
 if __name__ == '__main__':
-    app.run(debug=True)
+    # Development server; production runs asgi.py
+    app.run(debug=os.getenv('FLASK_DEBUG') == '1')
@@ -0,0 +1,377 @@
+import os
+import sys
+import json
+import uuid
+import asyncio
+import logging
+import threading
+from http import HTTPStatus
+from http.cookies import SimpleCookie
+from concurrent.futures import ThreadPoolExecutor
+
+from werkzeug.exceptions import ClientDisconnected
+from app import app as flask_app, SESSION_COOKIE, SESSION_ID_PATTERN
+from chatbot import get_answer_from_docs_async, stream_answer_from_docs_async
+from llm_gateway import llm_gateway
+from sessions import session_manager, set_current_session
+from upload_manifest import upload_manifest
+
+logger = logging.getLogger(__name__)
+
+# Production entry point. POST /chat and /chat/stream are served natively on
+# the event loop: retrieval and packing run on a small thread pool and the
+# model call is awaited, so one process keeps hundreds of chat requests open
+# while each waits for the model. Every other route is passed to the Flask app
+# through a WSGI bridge running on WSGI_THREADS threads.
+#
+# Run with `python asgi.py` or any ASGI server (`uvicorn asgi:application`).
+# With STORE_BACKEND=sqlite, documents, history and ingestion jobs are shared
+# by all worker processes of the node and WEB_CONCURRENCY can be raised. With
+# the default memory backend they live in the serving process, so it stays at
+# 1 unless requests of a browser always reach the same worker.
+
+HOST = os.getenv("HOST", "127.0.0.1")
+PORT = int(os.getenv("PORT", "5000"))
+WEB_CONCURRENCY = int(os.getenv("WEB_CONCURRENCY", "1"))
+WSGI_THREADS = int(os.getenv("WSGI_THREADS", "16"))
+CHAT_MAX_BODY_BYTES = 1024 * 1024
+# Body chunks of a bridged request received ahead of the Flask thread reading them
+WSGI_BODY_QUEUE_CHUNKS = 4
+
+_wsgi_pool = ThreadPoolExecutor(max_workers=max(1, WSGI_THREADS), thread_name_prefix="wsgi")
+
+
+def _headers(scope):
+    """Header name -> value (latin-1 text), repeated headers joined with commas"""
+    headers = {}
+    for name, value in scope.get("headers", []):
+        name, value = name.decode("latin-1").lower(), value.decode("latin-1")
+        headers[name] = f"{headers[name]},{value}" if name in headers else value
+    return headers
+
+
+async def _wait_for_disconnect(receive):
+    while True:
+        message = await receive()
+        if message["type"] == "http.disconnect":
+            return
+
+
+async def _send_response(send, status, body, content_type="application/json", headers=()):
+    await send({"type": "http.response.start", "status": status,
+                "headers": [(b"content-type", content_type.encode()),
+                            (b"content-length", str(len(body)).encode())] + list(headers)})
+    await send({"type": "http.response.body", "body": body})
+
+
+def _json_body(data):
+    return json.dumps(data).encode("utf-8")
+
+
+# Native chat routes
+
+async def _read_body(receive, limit):
+    """Request body, or None when it is larger than limit"""
+    parts = []
+    size = 0
+    while True:
+        message = await receive()
+        if message["type"] == "http.disconnect":
+            raise ConnectionError("Client disconnected")
+        parts.append(message.get("body", b""))
+        size += len(parts[-1])
+        if size > limit:
+            return None
+        if not message.get("more_body"):
+            return b"".join(parts)
+
+
+def _session(scope):
+    """(session id, Set-Cookie header or None) from the session cookie, as app.load_session does"""
+    cookie = SimpleCookie(_headers(scope).get("cookie", ""))
+    session_id = cookie[SESSION_COOKIE].value if SESSION_COOKIE in cookie else ""
+    if SESSION_ID_PATTERN.match(session_id):
+        return session_id, None
+    session_id = uuid.uuid4().hex
+    set_cookie = f"{SESSION_COOKIE}={session_id}; HttpOnly; Path=/; SameSite=Lax"
+    return session_id, (b"set-cookie", set_cookie.encode("latin-1"))
+
+
+async def _chat_request(scope, receive, send):
+    """(message, session, extra headers) of a chat request, or None when it was answered or abandoned"""
+    session_id, set_cookie = _session(scope)
+    headers = [set_cookie] if set_cookie else []
+    try:
+        body = await _read_body(receive, CHAT_MAX_BODY_BYTES)
+    except ConnectionError:
+        return None
+    if body is None:
+        await _send_response(send, 413, _json_body({'error': 'Request too large'}), headers=headers)
+        return None
+    try:
+        data = json.loads(body) if body else None
+    except ValueError:
+        data = None
+    if not isinstance(data, dict) or 'message' not in data:
+        await _send_response(send, 400, _json_body({'error': 'No message provided'}), headers=headers)
+        return None
+    set_current_session(session_id)
+    return data['message'], session_manager.get(session_id), headers
+
+
+async def chat(scope, receive, send):
+    request = await _chat_request(scope, receive, send)
+    if request is None:
+        return
+    user_message, session, headers = request
+    try:
+        response = await get_answer_from_docs_async(user_message, session)
+        await _send_response(send, 200, _json_body({'response': response}), headers=headers)
+    except Exception as e:
+        await _send_response(send, 500, _json_body({'error': str(e)}), headers=headers)
+
+
+async def chat_stream(scope, receive, send):
+    request = await _chat_request(scope, receive, send)
+    if request is None:
+        return
+    user_message, session, headers = request
+
+    async def generate():
+        await send({"type": "http.response.start", "status": 200,
+                    "headers": [(b"content-type", b"text/event-stream; charset=utf-8"),
+                                (b"cache-control", b"no-cache"), (b"x-accel-buffering", b"no")] + headers})
+        # Same events as the Flask view: one "data" event per text delta, then "done" (or "error")
+        try:
+            async for delta in stream_answer_from_docs_async(user_message, session):
+                event = f"data: {json.dumps({'delta': delta})}\n\n"
+                await send({"type": "http.response.body", "body": event.encode("utf-8"), "more_body": True})
+            event = "event: done\ndata: {}\n\n"
+        except Exception as e:
+            logger.exception("Exception during streamed chat: %s", e)
+            event = f"event: error\ndata: {json.dumps({'error': str(e)})}\n\n"
+        await send({"type": "http.response.body", "body": event.encode("utf-8")})
+
+    # A client that goes away cancels the stream, which closes the model request
+    producer = asyncio.ensure_future(generate())
+    watcher = asyncio.ensure_future(_wait_for_disconnect(receive))
+    await asyncio.wait({producer, watcher}, return_when=asyncio.FIRST_COMPLETED)
+    for task in (producer, watcher):
+        task.cancel()
+    if producer.done() and not producer.cancelled() and producer.exception() is not None:
+        raise producer.exception()
+
+
+CHAT_ROUTES = {"/chat": chat, "/chat/stream": chat_stream}
+
+
+# WSGI bridge for the Flask routes
+
+class _RequestBody:
+    """wsgi.input of a bridged request, received from the client as the Flask thread reads it.
+
+    A small queue sits between the connection and the thread, so an upload
+    flows to disk at the pace the thread writes it instead of being collected
+    before the request starts. Once the body is complete the pump keeps
+    listening for the client to disconnect.
+    """
+
+    def __init__(self, loop, receive):
+        self.loop = loop
+        self.chunks = asyncio.Queue(maxsize=WSGI_BODY_QUEUE_CHUNKS)
+        self.disconnected = False
+        self.closed = False
+        self.buffer = bytearray()
+        self.ended = False
+        self.pump = asyncio.ensure_future(self._pump(receive))
+
+    async def _pump(self, receive):
+        more_body = True
+        while True:
+            message = await receive()
+            if message["type"] == "http.disconnect":
+                self.disconnected = True
+                self.close()
+                return
+            if more_body:
+                more_body = message.get("more_body", False)
+                if message.get("body"):
+                    await self.chunks.put(message["body"])
+                if not more_body:
+                    await self.chunks.put(b"")
+
+    def close(self):
+        """Loop side: no more chunks will come; a thread waiting for one gets None"""
+        self.closed = True
+        if self.chunks.empty():
+            self.chunks.put_nowait(None)
+
+    async def _next(self):
+        if self.closed and self.chunks.empty():
+            return None
+        return await self.chunks.get()
+
+    def _receive(self):
+        """Thread side: next chunk of the body, b"" at its end"""
+        chunk = asyncio.run_coroutine_threadsafe(self._next(), self.loop).result()
+        if chunk is None:
+            raise ClientDisconnected()
+        self.ended = not chunk
+        return chunk
+
+    def read(self, size=-1):
+        while (size is None or size < 0 or len(self.buffer) < size) and not self.ended:
+            self.buffer += self._receive()
+        size = len(self.buffer) if size is None or size < 0 else size
+        data = bytes(self.buffer[:size])
+        del self.buffer[:size]
+        return data
+
+    def readline(self, size=-1):
+        while b"\n" not in self.buffer and (size is None or size < 0 or len(self.buffer) < size) and not self.ended:
+            self.buffer += self._receive()
+        end = self.buffer.find(b"\n") + 1 or len(self.buffer)
+        return self.read(end if size is None or size < 0 else min(end, size))
+
+
+def _environ(scope, body):
+    headers = _headers(scope)
+    server = scope.get("server") or ("localhost", 80)
+    client = scope.get("client") or ("", 0)
+    environ = {
+        "REQUEST_METHOD": scope["method"],
+        "SCRIPT_NAME": scope.get("root_path", "").encode("utf-8").decode("latin-1"),
+        "PATH_INFO": scope["path"].encode("utf-8").decode("latin-1"),
+        "QUERY_STRING": scope.get("query_string", b"").decode("latin-1"),
+        "SERVER_NAME": str(server[0]),
+        "SERVER_PORT": str(server[1] or 80),
+        "SERVER_PROTOCOL": f"HTTP/{scope.get('http_version', '1.1')}",
+        "REMOTE_ADDR": str(client[0]),
+        "wsgi.version": (1, 0),
+        "wsgi.url_scheme": scope.get("scheme", "http"),
+        "wsgi.input": body,
+        "wsgi.input_terminated": True,
+        "wsgi.errors": sys.stderr,
+        "wsgi.multithread": True,
+        "wsgi.multiprocess": WEB_CONCURRENCY > 1,
+        "wsgi.run_once": False,
+    }
+    for name, value in headers.items():
+        if name == "content-type":
+            environ["CONTENT_TYPE"] = value
+        elif name == "content-length":
+            environ["CONTENT_LENGTH"] = value
+        else:
+            environ["HTTP_" + name.upper().replace("-", "_")] = value
+    return environ
+
+
+def _run_wsgi(environ, loop, queue, aborted):
+    """Thread: run the Flask app, passing ("start", status, headers), ("body", bytes) and ("end", error) to the loop"""
+    put = lambda item: loop.call_soon_threadsafe(queue.put_nowait, item)
+    state = {}
+
+    def send_start():
+        if not state.get("sent"):
+            put(state["start"])
+            state["sent"] = True
+
+    def write(data):
+        send_start()
+        put(("body", data))
+
+    def start_response(status, headers, exc_info=None):
+        if exc_info and state.get("sent"):
+            raise exc_info[1].with_traceback(exc_info[2])
+        encoded = [(name.lower().encode("latin-1"), value.encode("latin-1")) for name, value in headers]
+        state["start"] = ("start", int(status.split(" ", 1)[0]), encoded)
+        return write
+
+    error = None
+    try:
+        iterable = flask_app(environ, start_response)
+        try:
+            for data in iterable:
+                if aborted.is_set():
+                    break
+                if data:
+                    write(data)
+        finally:
+            if hasattr(iterable, "close"):
+                iterable.close()
+        send_start()
+    except BaseException as e:
+        error = e
+    put(("end", error))
+
+
+async def wsgi_bridge(scope, receive, send):
+    """Serve one HTTP request with the Flask app on the WSGI thread pool"""
+    loop = asyncio.get_running_loop()
+    body = _RequestBody(loop, receive)
+    queue = asyncio.Queue()
+    aborted = threading.Event()
+    loop.run_in_executor(_wsgi_pool, _run_wsgi, _environ(scope, body), loop, queue, aborted)
+    started = False
+    try:
+        # Read until the thread is done with the request, so it never waits on a closed body
+        while True:
+            item = await queue.get()
+            if item[0] == "end":
+                error = item[1]
+                break
+            if body.disconnected:
+                # The client is gone; the thread stops at its next chunk
+                aborted.set()
+            elif item[0] == "start":
+                await send({"type": "http.response.start", "status": item[1], "headers": item[2]})
+                started = True
+            else:
+                await send({"type": "http.response.body", "body": item[1], "more_body": True})
+    finally:
+        body.pump.cancel()
+        body.close()
+    if aborted.is_set():
+        return
+    if error is not None:
+        logger.error("Error serving %s %s: %s", scope["method"], scope["path"], error)
+        if not started:
+            status = HTTPStatus.INTERNAL_SERVER_ERROR
+            await _send_response(send, status.value, status.phrase.encode(), content_type="text/plain")
+            return
+    await send({"type": "http.response.body", "body": b""})
+
+
+async def lifespan(receive, send):
+    while True:
+        message = await receive()
+        if message["type"] == "lifespan.startup":
+            # The native chat routes skip Flask's before_request hook, which starts it otherwise
+            upload_manifest.start_retention()
+            await send({"type": "lifespan.startup.complete"})
+        elif message["type"] == "lifespan.shutdown":
+            await llm_gateway.aclose()
+            await send({"type": "lifespan.shutdown.complete"})
+            return
+
+
+async def application(scope, receive, send):
+    """ASGI application: native chat routes, everything else through Flask"""
+    if scope["type"] == "lifespan":
+        await lifespan(receive, send)
+        return
+    if scope["type"] != "http":
+        raise ValueError(f"Unsupported ASGI scope type: {scope['type']}")
+    handler = CHAT_ROUTES.get(scope["path"]) if scope["method"] == "POST" else None
+    await (handler or wsgi_bridge)(scope, receive, send)
+
+
+def serve():
+    import uvicorn
+
+    uvicorn.run("asgi:application", host=HOST, port=PORT, workers=WEB_CONCURRENCY, lifespan="on",
+                log_level=logging.getLevelName(logging.getLogger().level).lower())
+
+
+if __name__ == "__main__":
+    serve()
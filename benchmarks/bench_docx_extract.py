@@ -0,0 +1,106 @@
+"""
+Speed and peak memory benchmark for .docx text extraction.
+
+Builds Word documents of growing size (paragraphs plus tables) and extracts
+them with the python-docx object model, as process_docx used to (paragraphs
+only), with the object model including table rows ("+tables") and with the
+streaming XML extractor. Each extraction runs in a fresh process so its peak
+RSS can be reported on its own.
+
+Usage: python benchmarks/bench_docx_extract.py [--quick]
+"""
+import os
+import sys
+import json
+import time
+import argparse
+import resource
+import tempfile
+import subprocess
+
+import docx
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from docx_extract import iter_docx_blocks
+from corpus import make_docx
+
+
+def extract_python_docx(path):
+    doc = docx.Document(path)
+    return "\n".join(para.text for para in doc.paragraphs)
+
+
+def extract_python_docx_tables(path):
+    """Paragraphs and then table rows through the object model, for a like-for-like comparison"""
+    doc = docx.Document(path)
+    lines = [para.text for para in doc.paragraphs]
+    for table in doc.tables:
+        lines.extend(" | ".join(cell.text for cell in row.cells) for row in table.rows)
+    return "\n".join(lines)
+
+
+def extract_streaming(path):
+    return "\n".join(iter_docx_blocks(path))
+
+
+def peak_rss_kb():
+    # ru_maxrss survives exec on Linux and would report the parent's peak, VmHWM does not
+    try:
+        with open("/proc/self/status") as status:
+            for line in status:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def measure(method, path):
+    """Run in a child process: time, peak RSS growth and output size of one extraction"""
+    extract = METHODS[method]
+    baseline = peak_rss_kb()
+    start = time.perf_counter()
+    text = extract(path)
+    elapsed = time.perf_counter() - start
+    peak = peak_rss_kb()
+    print(json.dumps({"seconds": elapsed, "rss_kb": peak - baseline, "chars": len(text)}))
+
+
+METHODS = {
+    "python-docx": extract_python_docx,
+    "+tables": extract_python_docx_tables,
+    "streaming": extract_streaming,
+}
+
+
+def run_child(method, path):
+    output = subprocess.run([sys.executable, os.path.abspath(__file__), "--measure", method, path],
+                            check=True, capture_output=True, text=True).stdout
+    return json.loads(output.strip().splitlines()[-1])
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--quick", action="store_true", help="Smaller documents for a fast smoke run")
+    parser.add_argument("--measure", nargs=2, metavar=("METHOD", "PATH"), help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.measure:
+        measure(*args.measure)
+        return
+
+    sizes = [(2000, 20), (10000, 100)] if args.quick else [(10000, 100), (50000, 500), (200000, 2000)]
+    print(f"{'paragraphs':>10} {'tables':>6} {'MB':>6} {'method':>12} {'seconds':>8} {'peak MB':>8} {'chars':>10}")
+    with tempfile.TemporaryDirectory() as directory:
+        for paragraphs, tables in sizes:
+            path = os.path.join(directory, f"bench_{paragraphs}.docx")
+            make_docx(path, paragraphs, tables)
+            size = os.path.getsize(path) / (1024 * 1024)
+            for method in METHODS:
+                result = run_child(method, path)
+                print(f"{paragraphs:>10} {tables:>6} {size:>6.1f} {method:>12} {result['seconds']:>8.2f} "
+                      f"{result['rss_kb'] / 1024:>8.1f} {result['chars']:>10}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,74 @@
+"""
+Scaling benchmark for the Excel sheet profiling engine.
+
+Profiles synthetic sheets that grow in width (columns) and in height (rows)
+and reports the time taken by profile_sheet() plus text formatting.
+
+Usage: python benchmarks/bench_excel_profile.py [--quick]
+"""
+import os
+import sys
+import time
+import argparse
+
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from excel_profile import profile_sheet, format_sheet_header, format_sheet_insights, format_data_rows
+
+
+def make_sheet(rows, numeric_columns, seed=0):
+    """Sheet with an id, a name, a date, a profit column and random numeric columns"""
+    rng = np.random.default_rng(seed)
+    data = {
+        "Product ID": np.arange(rows),
+        "Product Name": pd.Categorical(rng.choice([f"Product {i}" for i in range(200)], rows)),
+        "Date": pd.date_range("2020-01-01", periods=rows, freq="min"),
+        "Profit": rng.normal(1000, 250, rows),
+    }
+    base = rng.normal(size=rows)
+    for i in range(numeric_columns):
+        # Every tenth column tracks the base series so correlations are found
+        noise = rng.normal(size=rows)
+        data[f"Metric {i}"] = base + 0.1 * noise if i % 10 == 0 else noise
+    return pd.DataFrame(data)
+
+
+def time_profile(df, repeat=3):
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        profile = profile_sheet(df)
+        format_sheet_header("Sheet1", profile)
+        format_data_rows(df, limit=100)
+        format_sheet_insights(profile)
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--quick", action="store_true", help="Smaller sizes for a fast smoke run")
+    args = parser.parse_args()
+
+    if args.quick:
+        wide = [(2_000, 50), (2_000, 100)]
+        tall = [(10_000, 8), (100_000, 8)]
+    else:
+        wide = [(10_000, 50), (10_000, 100), (10_000, 250), (10_000, 500)]
+        tall = [(10_000, 8), (100_000, 8), (1_000_000, 8)]
+
+    print(f"{'shape':>22} {'seconds':>10} {'rows/s':>14}")
+    for label, sizes in (("wide", wide), ("tall", tall)):
+        print(f"-- {label}")
+        for rows, columns in sizes:
+            df = make_sheet(rows, columns)
+            seconds = time_profile(df)
+            shape = f"{rows:,} x {df.shape[1]}"
+            print(f"{shape:>22} {seconds:>10.3f} {rows / seconds:>14,.0f}")
+
+
+if __name__ == "__main__":
+    main()
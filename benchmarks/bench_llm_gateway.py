@@ -0,0 +1,73 @@
+"""
+Throughput and tail latency benchmark for the LLM gateway.
+
+Starts the local fake completion server with injected latency, slow tail
+responses and failures, then sends concurrent chat completions through
+LLMGateway with and without hedging and reports requests per second, latency
+percentiles and the gateway counters.
+
+Usage: python benchmarks/bench_llm_gateway.py [--quick]
+"""
+import os
+import sys
+import time
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from fake_llm_server import start_server
+from llm_gateway import LLMGateway, LLMError
+
+MESSAGES = [{"role": "user", "content": "What was the total revenue last quarter?"}]
+
+
+def run(gateway, requests, concurrency):
+    """Latencies of successful calls and the number of failed ones"""
+    def call(_):
+        start = time.perf_counter()
+        try:
+            gateway.complete(MESSAGES, "fake-model")
+            return time.perf_counter() - start
+        except LLMError:
+            return None
+
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        results = list(pool.map(call, range(requests)))
+    latencies = np.array([r for r in results if r is not None])
+    return latencies, sum(r is None for r in results)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--quick", action="store_true", help="Fewer requests for a fast smoke run")
+    args = parser.parse_args()
+    requests = 100 if args.quick else 1000
+    concurrency = 16
+
+    scenarios = [
+        ("baseline", {"latency": 0.02}, {}),
+        ("slow tail 5%", {"latency": 0.02, "tail_latency": 0.5, "tail_probability": 0.05}, {}),
+        ("slow tail 5% + hedging", {"latency": 0.02, "tail_latency": 0.5, "tail_probability": 0.05},
+         {"hedge_after": 0.1}),
+        ("10% errors + retries", {"latency": 0.02, "error_rate": 0.1, "error_status": 503}, {}),
+    ]
+
+    print(f"{'scenario':>24} {'req/s':>8} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8} {'failed':>7}  counters")
+    for name, server_options, gateway_options in scenarios:
+        server = start_server(chunk_delay=0, **server_options)
+        base_url = f"http://127.0.0.1:{server.server_address[1]}/v1"
+        gateway = LLMGateway(api_key="benchmark", base_url=base_url, max_concurrency=concurrency,
+                             timeout=10, **gateway_options)
+        start = time.perf_counter()
+        latencies, failed = run(gateway, requests, concurrency)
+        elapsed = time.perf_counter() - start
+        server.shutdown()
+        p50, p95, p99 = (np.percentile(latencies, [50, 95, 99]) * 1000) if len(latencies) else (0, 0, 0)
+        print(f"{name:>24} {requests / elapsed:>8.1f} {p50:>8.1f} {p95:>8.1f} {p99:>8.1f} {failed:>7}  {gateway.stats()}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,417 @@
+"""
+End-to-end benchmark suite with JSON results for comparing runs.
+
+Generates synthetic corpora (benchmarks/corpus.py) and measures:
+  - startup:   time to import the ASGI application and to answer its first
+               page and first /chat request, each run in a fresh process
+  - ingest:    process_document time, MB/s and peak RSS per format and size,
+               each document in a fresh process
+  - retrieval: get_relevant_documents latency against stores of growing size
+  - chat:      /chat and /chat/stream latency and throughput through the Flask
+               test client, against the local fake completion server
+
+Results are written to benchmarks/results/<timestamp>.json. With --compare,
+the run is checked against an earlier results file and every metric that got
+worse by more than --threshold is listed; the exit status is 1 if any did.
+
+Usage: python benchmarks/bench_suite.py [--quick] [--only startup,ingest,retrieval,chat]
+                                        [--output FILE] [--compare FILE] [--threshold 0.2]
+"""
+import os
+import sys
+import json
+import time
+import uuid
+import platform
+import asyncio
+import argparse
+import resource
+import tempfile
+import threading
+import subprocess
+from datetime import datetime, timezone
+
+import numpy as np
+
+BENCHMARK_DIR = os.path.dirname(os.path.abspath(__file__))
+ROOT_DIR = os.path.dirname(BENCHMARK_DIR)
+sys.path.insert(0, ROOT_DIR)
+
+from corpus import make_txt, make_docx, make_xlsx, make_pdf, make_chunks
+
+RESULTS_DIR = os.path.join(BENCHMARK_DIR, "results")
+SECTIONS = ("startup", "ingest", "retrieval", "chat")
+
+STARTUP_RUNS = {"quick": 3, "full": 10}
+
+# (format, size label, generator arguments) per corpus document
+INGEST_CORPUS = {
+    "quick": [
+        ("txt", "1 MB", {"megabytes": 1}),
+        ("docx", "2k paragraphs", {"paragraphs": 2_000, "tables": 20}),
+        ("xlsx", "1k rows", {"rows": 1_000}),
+        ("xlsx", "20k rows", {"rows": 20_000}),
+        ("pdf", "50 pages", {"pages": 50}),
+    ],
+    "full": [
+        ("txt", "5 MB", {"megabytes": 5}),
+        ("txt", "50 MB", {"megabytes": 50}),
+        ("docx", "50k paragraphs", {"paragraphs": 50_000, "tables": 500}),
+        ("xlsx", "1k rows", {"rows": 1_000}),
+        ("xlsx", "100k rows", {"rows": 100_000}),
+        ("xlsx", "1M rows", {"rows": 1_000_000}),
+        ("pdf", "500 pages", {"pages": 500}),
+    ],
+}
+GENERATORS = {"txt": make_txt, "docx": make_docx, "xlsx": make_xlsx, "pdf": make_pdf}
+
+RETRIEVAL_STORE_SIZES = {"quick": [500, 2_000], "full": [1_000, 5_000, 20_000]}
+RETRIEVAL_QUERIES = ["revenue of the North region", "profit driven by Product 7", "supplier delays in Surabaya",
+                     "customer churn percent change", "marketing spend for Central", "inventory of Product 21"]
+
+CHAT_REQUESTS = {"quick": 30, "full": 200}
+CHAT_CONCURRENCY = 8
+FAKE_LLM_OPTIONS = {"latency": 0.05, "chunk_delay": 0.005}
+
+# Metrics where a larger value is an improvement; all others are better when smaller
+HIGHER_IS_BETTER = ("mb_per_s", "requests_per_s")
+
+
+def peak_rss_kb():
+    # ru_maxrss survives exec on Linux and would report the parent's peak, VmHWM does not
+    try:
+        with open("/proc/self/status") as status:
+            for line in status:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def percentiles(seconds):
+    p50, p95, p99 = np.percentile(np.array(seconds) * 1000, [50, 95, 99])
+    return {"p50_ms": round(float(p50), 2), "p95_ms": round(float(p95), 2), "p99_ms": round(float(p99), 2)}
+
+
+async def asgi_request(application, method, path, body=b""):
+    """(status, body) of one request sent straight to an ASGI application"""
+    scope = {"type": "http", "method": method, "path": path, "query_string": b"", "root_path": "",
+             "scheme": "http", "http_version": "1.1", "server": ("127.0.0.1", 5000), "client": ("127.0.0.1", 0),
+             "headers": [(b"content-type", b"application/json"), (b"content-length", str(len(body)).encode())]}
+    incoming = [{"type": "http.request", "body": body, "more_body": False}]
+    sent = []
+
+    async def receive():
+        if incoming:
+            return incoming.pop()
+        # The client stays connected until the response is complete
+        await asyncio.get_running_loop().create_future()
+
+    async def send(message):
+        sent.append(message)
+
+    await application(scope, receive, send)
+    return sent[0]["status"], b"".join(message.get("body", b"") for message in sent[1:])
+
+
+def measure_startup():
+    """Run in a child process: import the ASGI app, serve a first page and chat request, print timings as JSON"""
+    start = time.perf_counter()
+    import asgi
+    imported = time.perf_counter()
+    status, _ = asyncio.run(asgi_request(asgi.application, "GET", "/"))
+    assert status == 200, status
+    page = time.perf_counter()
+    status, body = asyncio.run(asgi_request(asgi.application, "POST", "/chat",
+                                            json.dumps({"message": "What is in the report?"}).encode()))
+    assert status == 200, body
+    chatted = time.perf_counter()
+    print(json.dumps({"import_seconds": round(imported - start, 3), "first_page_seconds": round(page - imported, 3),
+                      "first_chat_seconds": round(chatted - page, 3)}))
+
+
+def bench_startup(mode, directory):
+    from fake_llm_server import start_server
+
+    server = start_server(**FAKE_LLM_OPTIONS)
+    env = dict(os.environ, OPENAI_BASE_URL=f"http://127.0.0.1:{server.server_address[1]}/v1",
+               OPENAI_API_KEY=os.environ.get("OPENAI_API_KEY", "benchmark"), LOG_LEVEL="WARNING")
+    runs = []
+    for _ in range(STARTUP_RUNS[mode]):
+        workdir = tempfile.mkdtemp(dir=directory)
+        start = time.perf_counter()
+        output = subprocess.run([sys.executable, os.path.abspath(__file__), "--measure-startup"],
+                                cwd=workdir, env=env, check=True, capture_output=True, text=True).stdout
+        run = json.loads(output.strip().splitlines()[-1])
+        run["process_seconds"] = time.perf_counter() - start
+        runs.append(run)
+    server.shutdown()
+    # Medians, so one slow run (e.g. a cold disk cache) does not decide the result
+    result = {"entry": "asgi", "runs": len(runs)}
+    for metric in ("import_seconds", "first_page_seconds", "first_chat_seconds", "process_seconds"):
+        result[metric] = round(float(np.median([run[metric] for run in runs])), 3)
+    print(f"  startup asgi: import {result['import_seconds']}s, first page {result['first_page_seconds']}s, "
+          f"first chat {result['first_chat_seconds']}s, whole process {result['process_seconds']}s")
+    return [result]
+
+
+def measure_ingest(path):
+    """Run in a child process: ingest one document and print its timings as JSON"""
+    import document_processor
+
+    baseline = peak_rss_kb()
+    start = time.perf_counter()
+    ok = document_processor.process_document(path)
+    elapsed = time.perf_counter() - start
+    store = document_processor.get_store()
+    size_mb = os.path.getsize(path) / (1024 * 1024)
+    print(json.dumps({
+        "ok": bool(ok),
+        "seconds": round(elapsed, 3),
+        "file_mb": round(size_mb, 2),
+        "mb_per_s": round(size_mb / elapsed, 3) if elapsed > 0 else None,
+        "peak_rss_mb": round((peak_rss_kb() - baseline) / 1024, 1),
+        "chunks": len(store),
+    }))
+
+
+def bench_ingest(mode, directory):
+    results = []
+    for file_format, label, options in INGEST_CORPUS[mode]:
+        path = os.path.join(directory, f"corpus_{label.replace(' ', '_')}.{file_format}")
+        start = time.perf_counter()
+        GENERATORS[file_format](path, **options)
+        generated = time.perf_counter() - start
+        # A private working directory per document, so no parse cache or spill file is reused
+        workdir = tempfile.mkdtemp(dir=directory)
+        env = dict(os.environ, PARSE_CACHE_DIR=os.path.join(workdir, "parse"),
+                   EXCEL_SPILL_DIR=os.path.join(workdir, "spill"), LOG_LEVEL="WARNING")
+        output = subprocess.run([sys.executable, os.path.abspath(__file__), "--measure-ingest", path],
+                                cwd=workdir, env=env, check=True, capture_output=True, text=True).stdout
+        result = dict(json.loads(output.strip().splitlines()[-1]), format=file_format, size=label)
+        results.append(result)
+        print(f"  ingest {file_format:>4} {label:>15}: {result['seconds']:>8.2f}s {result['mb_per_s']:>8} MB/s "
+              f"peak {result['peak_rss_mb']:>7} MB, {result['chunks']} chunks (generated in {generated:.1f}s)")
+        os.remove(path)
+    return results
+
+
+def bench_retrieval(mode):
+    from document_store import DocumentStore
+    from sessions import session_manager, set_current_session
+    import document_processor
+
+    results = []
+    for size in RETRIEVAL_STORE_SIZES[mode]:
+        session_id = f"bench-retrieval-{size}"
+        store = DocumentStore()
+        chunks = make_chunks(size)
+        start = time.perf_counter()
+        ids = []
+        for i, chunk in enumerate(chunks):
+            chunk_id = f"bench.txt_chunk_{i}"
+            store.add(chunk_id, chunk, {"source": "bench.txt", "type": ".txt", "chunk_id": i,
+                                        "total_chunks": size, "parent_doc": "bench.txt"})
+            ids.append(chunk_id)
+        for offset in range(0, size, 256):
+            store.add_vectors(ids[offset:offset + 256], chunks[offset:offset + 256])
+        build_seconds = time.perf_counter() - start
+        session_manager.get(session_id).replace_store(store)
+        set_current_session(session_id)
+
+        latencies = []
+        for _ in range(5):
+            for query in RETRIEVAL_QUERIES:
+                start = time.perf_counter()
+                document_processor.get_relevant_documents(query, top_k=5)
+                latencies.append(time.perf_counter() - start)
+        session_manager.drop(session_id)
+        result = dict(percentiles(latencies), chunks=size, build_seconds=round(build_seconds, 3))
+        results.append(result)
+        print(f"  retrieval {size:>7} chunks: p50 {result['p50_ms']:>7} ms, p95 {result['p95_ms']:>7} ms "
+              f"(built in {build_seconds:.1f}s)")
+    return results
+
+
+def chat_request(client, session_id, number, stream):
+    """(first byte seconds, total seconds) of one chat request"""
+    # Numbered questions are distinct, so every request goes to the model
+    body = {"message": f"Which region had the highest revenue in period {number}?"}
+    headers = {"Cookie": f"chat_session={session_id}"}
+    start = time.perf_counter()
+    if not stream:
+        response = client.post("/chat", json=body, headers=headers)
+        assert response.status_code == 200, response.get_data(as_text=True)
+        elapsed = time.perf_counter() - start
+        return elapsed, elapsed
+    response = client.post("/chat/stream", json=body, headers=headers, buffered=False)
+    first = None
+    for _ in response.response:
+        if first is None:
+            first = time.perf_counter() - start
+    response.close()
+    return first, time.perf_counter() - start
+
+
+def bench_chat(mode, directory):
+    from fake_llm_server import start_server
+
+    server = start_server(**FAKE_LLM_OPTIONS)
+    os.environ["OPENAI_BASE_URL"] = f"http://127.0.0.1:{server.server_address[1]}/v1"
+    os.environ.setdefault("OPENAI_API_KEY", "benchmark")
+    # Reworded questions must not be answered from the cache either
+    os.environ["ANSWER_CACHE_SIMILARITY"] = "0"
+    os.environ.setdefault("LOG_LEVEL", "WARNING")
+    from app import app
+    import document_processor
+    from sessions import session_manager
+
+    document = os.path.join(directory, "chat_report.txt")
+    make_txt(document, 1)
+    session_id = uuid.uuid4().hex
+    document_processor.process_document(document, session=session_manager.get(session_id))
+
+    requests = CHAT_REQUESTS[mode]
+    results = []
+    for endpoint, stream in (("/chat", False), ("/chat/stream", True)):
+        client = app.test_client()
+        timings = [chat_request(client, session_id, i, stream) for i in range(requests)]
+        result = {"endpoint": endpoint, "concurrency": 1, "requests": requests}
+        result.update({f"total_{k}": v for k, v in percentiles([t[1] for t in timings]).items()})
+        if stream:
+            result.update({f"first_byte_{k}": v for k, v in percentiles([t[0] for t in timings]).items()})
+
+        # Throughput with concurrent clients, each with its own cookie jar
+        counter = iter(range(requests, 2 * requests))
+        lock = threading.Lock()
+
+        def worker():
+            worker_client = app.test_client()
+            while True:
+                with lock:
+                    number = next(counter, None)
+                if number is None:
+                    return
+                chat_request(worker_client, session_id, number, stream)
+
+        start = time.perf_counter()
+        threads = [threading.Thread(target=worker) for _ in range(CHAT_CONCURRENCY)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        result["requests_per_s"] = round(requests / (time.perf_counter() - start), 2)
+        result["throughput_concurrency"] = CHAT_CONCURRENCY
+        results.append(result)
+        print(f"  chat {endpoint:>13}: p50 {result['total_p50_ms']:>7} ms, p95 {result['total_p95_ms']:>7} ms, "
+              f"{result['requests_per_s']} req/s with {CHAT_CONCURRENCY} clients")
+    server.shutdown()
+    return results
+
+
+def entry_name(section, entry):
+    if section == "startup":
+        return entry["entry"]
+    if section == "ingest":
+        return f"{entry['format']} {entry['size']}"
+    if section == "retrieval":
+        return f"{entry['chunks']} chunks"
+    return entry["endpoint"]
+
+
+def flatten(results):
+    """{"section: entry: metric": value} for every timing and rate of a results file"""
+    metrics = {}
+    for section in SECTIONS:
+        for entry in results.get(section, []):
+            name = entry_name(section, entry)
+            for metric, value in entry.items():
+                if metric.endswith(("_ms", "seconds", "_mb", "_per_s")) and metric != "file_mb":
+                    metrics[f"{section}: {name}: {metric}"] = value
+    return metrics
+
+
+def compare(current, baseline, threshold):
+    """Metrics that are worse than the baseline by more than threshold (a fraction)"""
+    regressions = []
+    old = flatten(baseline)
+    for key, value in flatten(current).items():
+        if key not in old or not old[key] or value is None:
+            continue
+        change = (value - old[key]) / abs(old[key])
+        if key.endswith(HIGHER_IS_BETTER):
+            change = -change
+        if change > threshold:
+            regressions.append((key, old[key], value, change))
+    return regressions
+
+
+def git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=ROOT_DIR, check=True,
+                              capture_output=True, text=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--quick", action="store_true", help="Smaller corpora and fewer requests for a fast smoke run")
+    parser.add_argument("--only", help="Comma-separated sections to run (startup, ingest, retrieval, chat)")
+    parser.add_argument("--output", help="Results file (default: benchmarks/results/<timestamp>.json)")
+    parser.add_argument("--compare", metavar="FILE", help="Earlier results file to check for regressions")
+    parser.add_argument("--threshold", type=float, default=0.2, help="Relative slowdown reported as a regression")
+    parser.add_argument("--measure-ingest", metavar="PATH", help=argparse.SUPPRESS)
+    parser.add_argument("--measure-startup", action="store_true", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.measure_ingest:
+        measure_ingest(args.measure_ingest)
+        return
+    if args.measure_startup:
+        measure_startup()
+        return
+
+    mode = "quick" if args.quick else "full"
+    sections = args.only.split(",") if args.only else SECTIONS
+    unknown = set(sections) - set(SECTIONS)
+    if unknown:
+        parser.error(f"unknown sections: {', '.join(sorted(unknown))}")
+
+    started = datetime.now(timezone.utc)
+    results = {"meta": {"started": started.isoformat(), "mode": mode, "commit": git_commit(),
+                        "python": platform.python_version(), "platform": platform.platform(),
+                        "cpus": os.cpu_count()}}
+    with tempfile.TemporaryDirectory() as directory:
+        if "startup" in sections:
+            print("startup")
+            results["startup"] = bench_startup(mode, directory)
+        if "ingest" in sections:
+            print("ingest")
+            results["ingest"] = bench_ingest(mode, directory)
+        if "retrieval" in sections:
+            print("retrieval")
+            results["retrieval"] = bench_retrieval(mode)
+        if "chat" in sections:
+            print("chat")
+            results["chat"] = bench_chat(mode, directory)
+
+    output = args.output or os.path.join(RESULTS_DIR, started.strftime("%Y%m%dT%H%M%SZ") + f"-{mode}.json")
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, "w") as f:
+        json.dump(results, f, indent=2)
+    print(f"Results written to {output}")
+
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        regressions = compare(results, baseline, args.threshold)
+        for key, old, new, change in regressions:
+            print(f"  REGRESSION {key}: {old} -> {new} ({change:+.0%})")
+        print(f"{len(regressions)} regressions against {args.compare} (threshold {args.threshold:.0%})")
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
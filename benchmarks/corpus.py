@@ -0,0 +1,150 @@
+"""
+Synthetic documents for the benchmarks.
+
+Every generator is deterministic for a given size and seed, so two benchmark
+runs parse exactly the same bytes. The text reads like a business report
+(regions, products, revenue figures) so retrieval queries have something to
+match.
+"""
+import os
+import random
+import zipfile
+from datetime import date, timedelta
+from xml.sax.saxutils import escape
+
+import docx
+import openpyxl
+
+REGIONS = ["North", "South", "East", "West", "Central", "Jakarta", "Bandung", "Surabaya"]
+PRODUCTS = [f"Product {i}" for i in range(40)]
+TOPICS = ["revenue", "profit", "shipping costs", "customer churn", "inventory", "marketing spend",
+          "headcount", "supplier delays", "returns", "average order value"]
+
+DOCX_NAMESPACE = "http://schemas.openxmlformats.org/wordprocessingml/2006/main"
+DOCX_DOCUMENT_PART = "word/document.xml"
+
+
+def sentence(rng, number):
+    return (f"In period {number}, {rng.choice(TOPICS)} for the {rng.choice(REGIONS)} region "
+            f"changed by {rng.randint(-40, 60)} percent, driven by {rng.choice(PRODUCTS)} "
+            f"and {rng.choice(PRODUCTS)}.")
+
+
+def paragraph(rng, number, sentences=4):
+    return " ".join(sentence(rng, number * sentences + i) for i in range(sentences))
+
+
+def make_txt(path, megabytes, seed=0):
+    """Plain text file of about the given size, in paragraphs separated by blank lines"""
+    rng = random.Random(seed)
+    target = int(megabytes * 1024 * 1024)
+    written = 0
+    number = 0
+    with open(path, "w", encoding="utf-8") as f:
+        while written < target:
+            text = paragraph(rng, number) + "\n\n"
+            f.write(text)
+            written += len(text)
+            number += 1
+
+
+def _docx_paragraph(text):
+    return f"<w:p><w:r><w:t xml:space=\"preserve\">{escape(text)}</w:t></w:r></w:p>"
+
+
+def _docx_table(rows, columns, number):
+    cells = lambda values: "".join(f"<w:tc>{_docx_paragraph(v)}</w:tc>" for v in values)
+    header = f"<w:tr>{cells([f'Column {c}' for c in range(columns)])}</w:tr>"
+    body = "".join(f"<w:tr>{cells([f'T{number} R{r} C{c}' for c in range(columns)])}</w:tr>"
+                   for r in range(rows))
+    grid = "<w:tblGrid>" + "<w:gridCol w:w=\"1500\"/>" * columns + "</w:tblGrid>"
+    return f"<w:tbl>{grid}{header}{body}</w:tbl>"
+
+
+def make_docx(path, paragraphs, tables, seed=0):
+    """Word document with the given number of paragraphs and 20x6 tables spread between them.
+
+    The document XML is written directly into the package of an empty
+    python-docx document, which is much faster than adding paragraphs
+    through the object model.
+    """
+    rng = random.Random(seed)
+    template = f"{path}.template.docx"
+    docx.Document().save(template)
+    every = max(1, paragraphs // max(tables, 1))
+    parts = []
+    for i in range(paragraphs):
+        parts.append(_docx_paragraph(paragraph(rng, i, sentences=2)))
+        if tables and i % every == every - 1 and i // every < tables:
+            parts.append(_docx_table(20, 6, i // every))
+    document = (f"<?xml version=\"1.0\" encoding=\"UTF-8\" standalone=\"yes\"?>"
+                f"<w:document xmlns:w=\"{DOCX_NAMESPACE}\"><w:body>{''.join(parts)}<w:sectPr/></w:body></w:document>")
+    with zipfile.ZipFile(template) as source, zipfile.ZipFile(path, "w", zipfile.ZIP_DEFLATED) as target:
+        for item in source.infolist():
+            data = document.encode("utf-8") if item.filename == DOCX_DOCUMENT_PART else source.read(item.filename)
+            target.writestr(item, data)
+    os.remove(template)
+
+
+def make_xlsx(path, rows, sheets=3, seed=0):
+    """Workbook of sales orders with rows spread over the given number of sheets"""
+    rng = random.Random(seed)
+    workbook = openpyxl.Workbook(write_only=True)
+    start = date(2020, 1, 1)
+    per_sheet = max(1, rows // sheets)
+    order = 0
+    for number in range(sheets):
+        sheet = workbook.create_sheet(f"Sales {2020 + number}")
+        sheet.append(["Order ID", "Date", "Region", "Product", "Quantity", "Unit Price", "Revenue", "Profit"])
+        for _ in range(per_sheet):
+            quantity = rng.randint(1, 50)
+            price = round(rng.uniform(5, 500), 2)
+            revenue = round(quantity * price, 2)
+            sheet.append([order, start + timedelta(days=order % 1500), rng.choice(REGIONS), rng.choice(PRODUCTS),
+                          quantity, price, revenue, round(revenue * rng.uniform(-0.1, 0.35), 2)])
+            order += 1
+    workbook.save(path)
+
+
+def make_pdf(path, pages, lines_per_page=45, seed=0):
+    """PDF with one text page per page, written without a PDF library.
+
+    Objects are numbered 1 (catalog), 2 (page tree), 3 (font), then a page
+    and its content stream for every page.
+    """
+    rng = random.Random(seed)
+    bodies = {
+        1: b"<< /Type /Catalog /Pages 2 0 R >>",
+        3: b"<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica >>",
+    }
+    kids = []
+    for page in range(pages):
+        page_id, content_id = 4 + 2 * page, 5 + 2 * page
+        kids.append(page_id)
+        lines = [sentence(rng, page * lines_per_page + i)[:110] for i in range(lines_per_page)]
+        text = " ".join("(" + line.replace("\\", "\\\\").replace("(", "\\(").replace(")", "\\)") + ") '"
+                        for line in lines)
+        stream = f"BT /F1 9 Tf 30 810 Td 11 TL {text} ET".encode("latin-1")
+        bodies[page_id] = (f"<< /Type /Page /Parent 2 0 R /MediaBox [0 0 595 842] "
+                           f"/Resources << /Font << /F1 3 0 R >> >> /Contents {content_id} 0 R >>").encode()
+        bodies[content_id] = b"<< /Length %d >>\nstream\n" % len(stream) + stream + b"\nendstream"
+    bodies[2] = ("<< /Type /Pages /Kids [" + " ".join(f"{k} 0 R" for k in kids) + f"] /Count {pages} >>").encode()
+
+    offsets = {}
+    with open(path, "wb") as f:
+        f.write(b"%PDF-1.4\n")
+        for number in sorted(bodies):
+            offsets[number] = f.tell()
+            f.write(b"%d 0 obj\n" % number + bodies[number] + b"\nendobj\n")
+        xref = f.tell()
+        total = max(bodies) + 1
+        f.write(b"xref\n0 %d\n0000000000 65535 f \n" % total)
+        for number in range(1, total):
+            f.write(b"%010d 00000 n \n" % offsets[number])
+        f.write(b"trailer\n<< /Size %d /Root 1 0 R >>\nstartxref\n%d\n%%%%EOF\n" % (total, xref))
+
+
+def make_chunks(count, seed=0):
+    """Chunk texts of about 500 characters for building stores of a given size"""
+    rng = random.Random(seed)
+    return [paragraph(rng, i, sentences=3) for i in range(count)]
@@ -1,170 +1,195 @@
 import os
-from openai import OpenAI
+import logging
 from dotenv import load_dotenv
-import pandas as pd
-import json
 import time
-from document_processor import get_relevant_documents, get_all_documents, excel_json_data
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from sessions import current_session
+from llm_gateway import llm_gateway, LLMError
+from answer_cache import answer_cache
+from context_packer import pack_context, store_candidates, ranked_candidates, text_candidates
+from metrics import observe_stage, stage_timer
+from debug_trace import trace_buffer
+from upload_manifest import upload_manifest
 
-# Store conversation history
-conversation_history = []
+logger = logging.getLogger(__name__)
 
 # Load environment variables
 load_dotenv()
 
-# Initialize OpenAI client
-try:
-    client = OpenAI(api_key=os.getenv("OPENAI_API_KEY"))
-    print(f"OpenAI client initialized successfully")
-except Exception as e:
-    print(f"Error initializing OpenAI client: {e}")
-    client = None
+# Retrieved chunks offered to the context packer per query
+CONTEXT_CANDIDATES = 20
 
-def _debug_data(data):
+# Conversation messages sent along with each prompt
+HISTORY_WINDOW = 5
+
+# Threads running retrieval, context packing and cache lookups for the async chat path
+CHAT_PREPARE_WORKERS = int(os.getenv("CHAT_PREPARE_WORKERS", "4"))
+_prepare_pool = ThreadPoolExecutor(max_workers=max(1, CHAT_PREPARE_WORKERS), thread_name_prefix="chat-prepare")
+
+def _extract_file_content(file_path):
     """
-    Utility to debug data by writing to a temp file
+    Extract content from a file directly if needed.
+    Returns (text, excel_data); text is None when extraction failed.
     """
+    logger.debug("Trying to extract content directly from %s", file_path)
     try:
-        with open("debug_data.json", "w", encoding="utf-8") as f:
-            json.dump({"data": data, "timestamp": time.time()}, f, ensure_ascii=False, indent=2)
-        print(f"Debug data written to debug_data.json")
+        from document_processor import extract_document_cached, parsed_text
+        
+        # Served from the parse cache when this file has been parsed before
+        parsed = extract_document_cached(file_path)
+        return parsed_text(parsed), parsed["excel_data"]
+    except ValueError as e:
+        logger.warning("Could not extract content from %s: %s", file_path, e)
+        return None, None
     except Exception as e:
-        print(f"Error writing debug data: {e}")
+        logger.exception("Error extracting file content: %s", e)
+        return None, None
 
-def _extract_file_content(file_path):
+def _latest_uploaded_file(session):
     """
-    Extract content from a file directly if needed
+    Most recent upload of the session that is still on disk, from the uploads manifest
     """
-    print(f"Trying to extract content directly from {file_path}")
     try:
-        from document_processor import process_excel, process_docx, process_pdf, process_txt
-        
-        if file_path.endswith('.xlsx') or file_path.endswith('.xls'):
-            return process_excel(file_path)
-        elif file_path.endswith('.docx'):
-            return process_docx(file_path)
-        elif file_path.endswith('.pdf'):
-            return process_pdf(file_path)
-        elif file_path.endswith('.txt'):
-            return process_txt(file_path)
-        else:
-            print(f"Unsupported file type: {file_path}")
-            return None
+        file_path = upload_manifest.latest(session.session_id)
     except Exception as e:
-        print(f"Error extracting file content: {e}")
-        import traceback
-        traceback.print_exc()
+        logger.exception("Error looking up uploaded files: %s", e)
         return None
+    return file_path if file_path and os.path.isfile(file_path) else None
 
-def _find_uploaded_files():
+def _run_excel_query(query, sheets, model_name):
     """
-    Find all uploaded files in the uploads directory
+    Plan a structured query for the question and compute it over all rows.
+    Returns the query result, or None when no query applies.
     """
-    uploads_dir = "uploads"
-    files = []
+    # Excel query planning (and pandas) is loaded with the first question about a workbook
+    from excel_query import EXCEL_QUERY_PLANNER, plan_query, plan_query_with_model, execute_query, describe_spec
+    if EXCEL_QUERY_PLANNER == "off":
+        return None
     try:
-        for filename in os.listdir(uploads_dir):
-            file_path = os.path.join(uploads_dir, filename)
-            if os.path.isfile(file_path):
-                files.append(file_path)
-        return files
+        spec = plan_query(query, sheets)
+        if spec is None and EXCEL_QUERY_PLANNER == "model":
+            spec = plan_query_with_model(query, sheets, llm_gateway, model_name)
+        if spec is None:
+            return None
+        result = execute_query(spec, sheets)
+        logger.debug("Computed Excel query locally: %s", describe_spec(result['spec']))
+        return result
     except Exception as e:
-        print(f"Error finding uploaded files: {e}")
-        return []
+        logger.warning("Error running Excel query, falling back to the JSON data: %s", e)
+        return None
 
-def get_answer_from_docs(query):
+def _prepare_chat(query, session):
     """
-    Get an answer to a query from the uploaded documents using OpenAI
+    Retrieve context and build the OpenAI request for a query.
+    Returns (messages, model_name, None), or (None, None, reply) when the
+    query can be answered without calling the model.
     """
-    print(f"\n\n==== Processing chat query: {query} ====")
+    logger.info("Processing chat query: %s", query)
     
-    # Import here to avoid circular imports
-    from document_processor import get_relevant_documents, get_all_documents, is_document_store_empty
+    # Work on one snapshot of the session's store even if an upload swaps it meanwhile
+    store = session.store
+    excel_json_data = store.excel_data
+    document_types = store.document_types()
     
     # Check if document store is empty
-    if is_document_store_empty():
-        print("Document store is empty, checking for files in uploads folder")
+    if store.is_empty():
+        logger.debug("Document store is empty, checking for files in uploads folder")
         # Try direct file access since document store is empty
-        uploaded_files = _find_uploaded_files()
-        print(f"Found {len(uploaded_files)} uploaded files: {uploaded_files}")
+        latest_file = _latest_uploaded_file(session)
         
-        if not uploaded_files:
-            return "I don't have any information about that. Please upload documents first."
+        if not latest_file:
+            return None, None, "I don't have any information about that. Please upload documents first."
         
         # Process the most recent file if available
-        if uploaded_files:
-            # Sort by modification time (most recent first)
-            uploaded_files.sort(key=lambda x: os.path.getmtime(x), reverse=True)
-            latest_file = uploaded_files[0]
-            print(f"Processing most recent file: {latest_file}")
+        if latest_file:
+            logger.info("Processing most recent file: %s", latest_file)
             
             # Extract content
-            content = _extract_file_content(latest_file)
+            content, excel_json_data = _extract_file_content(latest_file)
+            excel_json_data = excel_json_data or {}
             if content:
-                print(f"Successfully extracted content from {latest_file}")
-                relevant_docs = [content]
+                logger.debug("Successfully extracted content from %s", latest_file)
+                candidates = text_candidates([content])
             else:
-                return f"I couldn't extract content from the uploaded file. Please try uploading again or use a different file format."
+                return None, None, f"I couldn't extract content from the uploaded file. Please try uploading again or use a different file format."
         else:
-            return "I don't have any information about that. Please upload documents first."
+            return None, None, "I don't have any information about that. Please upload documents first."
     else:
         # Document store has content, retrieve documents
-        print("Fetching documents from document store...")
-        relevant_docs = get_relevant_documents(query)
+        logger.debug("Fetching documents from document store...")
+        with stage_timer("retrieval"):
+            candidates = store_candidates(store, store.search(query, top_k=CONTEXT_CANDIDATES))
         
-        print(f"Found {len(relevant_docs)} relevant documents")
+        logger.debug("Found %s relevant documents", len(candidates))
         
         # If no relevant docs, get all docs
-        if not relevant_docs:
-            print("No relevant documents found, fetching all...")
-            relevant_docs = get_all_documents(limit=10)
-            print(f"Retrieved {len(relevant_docs)} total documents from store")
-    
-    # Combine relevant documents (limit context size to avoid token limits)
-    max_context_length = 15000  # Limit context to ~15k characters
-    context = ""
+        if not candidates:
+            logger.debug("No relevant documents found, fetching all...")
+            candidates = ranked_candidates(store, list(store.documents)[:10])
+            logger.debug("Retrieved %s total documents from store", len(candidates))
     
-    # Add documents up to max length
-    for doc in relevant_docs:
-        if len(context) + len(doc) <= max_context_length:
-            if context:
-                context += "\n\n" + doc
-            else:
-                context = doc
-        else:
-            # If adding this doc would exceed limit, stop
-            break
+    # Fill the token budget by relevance per token, without chunks of documents already included
+    with stage_timer("context_pack"):
+        context, pack_report = pack_context(candidates)
+    logger.debug("Packed %s documents into %s/%s tokens, skipped %s, trimmed %s overlap characters",
+                 len(pack_report['included']), pack_report['tokens'], pack_report['budget'],
+                 len(pack_report['skipped']), pack_report['trimmed_chars'])
     
-    print(f"Final context length: {len(context)} characters")
+    logger.debug("Final context length: %s characters", len(context))
     
-    # Save context for debugging
-    _debug_data({"query": query, "context": context[:5000]})
+    # Keep a sampled trace of the context for /debug/traces
+    trace_buffer.record({"query": query, "context": context[:5000], "packing": pack_report},
+                        session_id=session.session_id)
     
-    # Detect if we're dealing with Excel data
-    is_excel_data = 'EXCEL FILE SUMMARY' in context or 'SHEET:' in context
+    # Detect if we're dealing with Excel data (ranked chunks may not include the summary header)
+    is_excel_data = ('EXCEL FILE SUMMARY' in context or 'SHEET:' in context
+                     or bool(document_types & {'.xlsx', '.xls'}))
     
     # Check if we have JSON data from Excel
     has_excel_json = bool(excel_json_data)
     
-    # Create messages for OpenAI based on document type
+    # Aggregate questions are computed locally over every row, so only the result table is sent
     if is_excel_data and has_excel_json:
+        with stage_timer("excel_query"):
+            query_result = _run_excel_query(query, excel_json_data, "gpt-5")
+    else:
+        query_result = None
+    
+    prompt_start = time.perf_counter()
+    # Create messages for OpenAI based on document type
+    if query_result is not None:
+        from excel_query import describe_scope, describe_spec, format_result, sheet_schema_preview
+        prompt = f"""
+        Answer the user's question using the result below. It was computed locally over
+        {describe_scope(query_result['spec'])}; say which sheets and filters the numbers
+        cover, and if the question asks about other rows or sheets, say that the result
+        does not include them instead of estimating.
+        
+        IMPORTANT: If the user's question is in Indonesian language, respond in Indonesian language.
+        If the question is in English, respond in English. Always match the language used in the question.
+        
+        QUERY: {describe_spec(query_result['spec'])}
+        
+        COMPUTED RESULT:
+        {format_result(query_result)}
+        
+        SHEETS:
+        {sheet_schema_preview(excel_json_data)}
+        
+        USER QUESTION:
+        {query}
+        """
+    elif is_excel_data and has_excel_json:
         # Use JSON format for Excel data
-        print(f"Using Excel JSON data for analysis with GPT-4.1")
-        
-        # Create a more concise representation of the JSON data if it's too large
-        excel_json_str = json.dumps(excel_json_data, indent=2)
-        if len(excel_json_str) > 12000:  # Limit size for API
-            # Create a summary of the data structure
-            excel_summary = {}
-            for sheet_name, records in excel_json_data.items():
-                # Include only first 5 records and metadata
-                sample = records[:5] if len(records) > 5 else records
-                excel_summary[sheet_name] = {
-                    "sample_records": sample,
-                    "total_records": len(records),
-                    "columns": list(sample[0].keys()) if sample else []
-                }
-            excel_json_str = json.dumps(excel_summary, indent=2)
+        logger.debug("Using Excel JSON data for analysis with GPT-4.1")
+        
+        # Serialized lazily from the columnar sheets: all records if they fit, otherwise a sample
+        if excel_json_data is store.excel_data:
+            excel_json_str = store.excel_payload(12000)
+        else:
+            from excel_store import excel_payload
+            excel_json_str = excel_payload(excel_json_data, 12000)
         
         prompt = f"""
         Analyze this Excel data in JSON format and answer the user's question.
@@ -217,82 +242,215 @@ def get_answer_from_docs(query):
         {query}
         """
     
-    # Add current query to conversation history
-    global conversation_history
+    # Prepare messages for OpenAI API
+    messages = []
     
-    try:
-        # Prepare messages for OpenAI API
-        messages = []
-        
-        # Determine system message based on document type
-        if is_excel_data:
-            system_content = """
-            You are a data analyst specializing in Excel data analysis. Your strengths include:
-            - Analyzing structured data from Excel files
-            - Identifying patterns and trends in numerical data
-            - Calculating and interpreting statistics
-            - Providing insights about relationships between data elements
-            - Explaining data in a clear, concise manner
-            
-            Maintain context from the conversation history when appropriate.
-            
-            IMPORTANT: When a user asks a question in Indonesian language, you MUST respond in Indonesian language as well.
-            Always match the language of your response to the language used in the question.
-            """
-        else:
-            system_content = """
-            You are a helpful assistant that analyzes document content and provides detailed, accurate answers 
-            based on the information available. Always analyze the provided document content thoroughly before responding.
-            
-            Maintain context from the conversation history when appropriate.
-            
-            IMPORTANT: When a user asks a question in Indonesian language, you MUST respond in Indonesian language as well.
-            Always match the language of your response to the language used in the question.
-            """
+    # Determine system message based on document type
+    if is_excel_data:
+        system_content = """
+        You are a data analyst specializing in Excel data analysis. Your strengths include:
+        - Analyzing structured data from Excel files
+        - Identifying patterns and trends in numerical data
+        - Calculating and interpreting statistics
+        - Providing insights about relationships between data elements
+        - Explaining data in a clear, concise manner
         
-        # Add system message
-        messages.append({"role": "system", "content": system_content})
+        Maintain context from the conversation history when appropriate.
         
-        # Add conversation history (up to 5 most recent exchanges)
-        history_limit = min(5, len(conversation_history))
-        for msg in conversation_history[-history_limit:]:
-            messages.append(msg)
-            
-        # Add current prompt with context
-        messages.append({"role": "user", "content": prompt})
+        IMPORTANT: When a user asks a question in Indonesian language, you MUST respond in Indonesian language as well.
+        Always match the language of your response to the language used in the question.
+        """
+    else:
+        system_content = """
+        You are a helpful assistant that analyzes document content and provides detailed, accurate answers 
+        based on the information available. Always analyze the provided document content thoroughly before responding.
         
-        print(f"Sending {len(messages)} messages to OpenAI including history")
-            
-        # Use gpt-4-turbo (latest version of GPT-4) when working with Excel JSON data
-        if is_excel_data and has_excel_json:
-            model_name = "gpt-5"  # The latest GPT-4 model
-        else:
-            model_name = "gpt-5"
-            
-        print(f"Using model: {model_name}")
+        Maintain context from the conversation history when appropriate.
+        
+        IMPORTANT: When a user asks a question in Indonesian language, you MUST respond in Indonesian language as well.
+        Always match the language of your response to the language used in the question.
+        """
+    
+    # Add system message
+    messages.append({"role": "system", "content": system_content})
+    
+    # Add conversation history (up to 5 most recent messages)
+    messages.extend(session.recent_history(HISTORY_WINDOW))
+        
+    # Add current prompt with context
+    messages.append({"role": "user", "content": prompt})
+    
+    logger.debug("Sending %s messages to OpenAI including history", len(messages))
         
-        response = client.chat.completions.create(
-            model=model_name,
-            messages=messages
-        )
+    # Use gpt-4-turbo (latest version of GPT-4) when working with Excel JSON data
+    if is_excel_data and has_excel_json:
+        model_name = "gpt-5"  # The latest GPT-4 model
+    else:
+        model_name = "gpt-5"
         
-        # Extract answer from response
-        answer = response.choices[0].message.content.strip()
-        print(f"OpenAI response received, length: {len(answer)}")
+    logger.debug("Using model: %s", model_name)
+    observe_stage("prompt_build", time.perf_counter() - prompt_start)
+    
+    return messages, model_name, None
+
+def _record_exchange(session, query, answer):
+    """
+    Save a finished question/answer pair to the session's conversation history
+    """
+    history_size = session.record_exchange(query, answer)
+    logger.debug("Conversation history updated, now has %s messages", history_size)
+
+def _cache_context(session):
+    """
+    (content version, history window, embedder) keying the answer cache for a
+    session, or None when the session has no documents to answer from
+    """
+    store = session.store
+    if store.is_empty():
+        return None
+    embedder = store.vector_index.embedder if store.vector_index is not None else None
+    return store.content_version(), session.recent_history(HISTORY_WINDOW), embedder
+
+def _cached_answer(query, session, cache_context):
+    if cache_context is None:
+        return None
+    version, history, embedder = cache_context
+    answer = answer_cache.get(query, version, history, embedder)
+    if answer is not None:
+        logger.debug("Answer served from the answer cache")
+        _record_exchange(session, query, answer)
+    return answer
+
+def _cache_answer(query, answer, cache_context):
+    if cache_context is not None and answer:
+        version, history, embedder = cache_context
+        answer_cache.put(query, version, answer, history, embedder)
+
+def get_answer_from_docs(query, session=None):
+    """
+    Get an answer to a query from the uploaded documents using OpenAI
+    """
+    if session is None:
+        session = current_session()
+    cache_context = _cache_context(session)
+    cached = _cached_answer(query, session, cache_context)
+    if cached is not None:
+        return cached
+    messages, model_name, reply = _prepare_chat(query, session)
+    if reply is not None:
+        return reply
+    
+    try:
+        # Deadline, retries and rate limiting are handled by the gateway
+        answer = llm_gateway.complete(messages, model_name)
+        logger.debug("OpenAI response received, length: %s", len(answer))
         
         # Save to conversation history
-        conversation_history.append({"role": "user", "content": query})
-        conversation_history.append({"role": "assistant", "content": answer})
+        _record_exchange(session, query, answer)
+        _cache_answer(query, answer, cache_context)
         
-        # Limit history size to prevent context overflow
-        if len(conversation_history) > 20:  # Keep last 10 exchanges (20 messages)
-            conversation_history = conversation_history[-20:]
-            
-        print(f"Conversation history updated, now has {len(conversation_history)} messages")
+        return answer
+        
+    except LLMError as e:
+        logger.exception("Error calling OpenAI API: %s", e)
+        return f"Sorry, I encountered an error processing your question: {str(e)}"
+
+def stream_answer_from_docs(query, session=None):
+    """
+    Generator version of get_answer_from_docs that yields the answer text
+    piece by piece as the model produces it. The full answer is added to the
+    conversation history once the stream completes.
+    """
+    if session is None:
+        session = current_session()
+    cache_context = _cache_context(session)
+    cached = _cached_answer(query, session, cache_context)
+    if cached is not None:
+        yield cached
+        return
+    messages, model_name, reply = _prepare_chat(query, session)
+    if reply is not None:
+        yield reply
+        return
+    
+    try:
+        parts = []
+        for delta in llm_gateway.stream(messages, model_name):
+            parts.append(delta)
+            yield delta
+        
+        answer = "".join(parts).strip()
+        logger.debug("OpenAI streamed response received, length: %s", len(answer))
+        
+        # Save to conversation history
+        _record_exchange(session, query, answer)
+        _cache_answer(query, answer, cache_context)
+        
+    except LLMError as e:
+        logger.exception("Error calling OpenAI API: %s", e)
+        yield f"Sorry, I encountered an error processing your question: {str(e)}"
+
+async def _in_pool(function, *args):
+    """Run CPU-bound or blocking work off the event loop"""
+    return await asyncio.get_running_loop().run_in_executor(_prepare_pool, function, *args)
+
+async def get_answer_from_docs_async(query, session=None):
+    """
+    Coroutine version of get_answer_from_docs for the ASGI server. Retrieval
+    and prompt building run on a small thread pool and the model call is
+    awaited, so a request waiting for the model holds no thread.
+    """
+    if session is None:
+        session = current_session()
+    cache_context = await _in_pool(_cache_context, session)
+    cached = await _in_pool(_cached_answer, query, session, cache_context)
+    if cached is not None:
+        return cached
+    messages, model_name, reply = await _in_pool(_prepare_chat, query, session)
+    if reply is not None:
+        return reply
+    
+    try:
+        answer = await llm_gateway.acomplete(messages, model_name)
+        logger.debug("OpenAI response received, length: %s", len(answer))
+        
+        await _in_pool(_record_exchange, session, query, answer)
+        await _in_pool(_cache_answer, query, answer, cache_context)
         
         return answer
         
-    except Exception as e:
-        print(f"Error calling OpenAI API: {str(e)}")
+    except LLMError as e:
+        logger.exception("Error calling OpenAI API: %s", e)
         return f"Sorry, I encountered an error processing your question: {str(e)}"
 
+async def stream_answer_from_docs_async(query, session=None):
+    """
+    Async generator version of stream_answer_from_docs for the ASGI server
+    """
+    if session is None:
+        session = current_session()
+    cache_context = await _in_pool(_cache_context, session)
+    cached = await _in_pool(_cached_answer, query, session, cache_context)
+    if cached is not None:
+        yield cached
+        return
+    messages, model_name, reply = await _in_pool(_prepare_chat, query, session)
+    if reply is not None:
+        yield reply
+        return
+    
+    try:
+        parts = []
+        async for delta in llm_gateway.astream(messages, model_name):
+            parts.append(delta)
+            yield delta
+        
+        answer = "".join(parts).strip()
+        logger.debug("OpenAI streamed response received, length: %s", len(answer))
+        
+        await _in_pool(_record_exchange, session, query, answer)
+        await _in_pool(_cache_answer, query, answer, cache_context)
+        
+    except LLMError as e:
+        logger.exception("Error calling OpenAI API: %s", e)
+        yield f"Sorry, I encountered an error processing your question: {str(e)}"
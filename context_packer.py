@@ -0,0 +1,176 @@
+import os
+import logging
+import re
+import threading
+
+logger = logging.getLogger(__name__)
+
+# Packs retrieved documents into the prompt context under a token budget.
+# Candidates are taken by relevance per token (items that do not fit are
+# skipped rather than ending the packing), chunks whose parent document is
+# already in the context are dropped, and adjacent chunks of one document are
+# joined with their splitter overlap removed. Tokens are counted with tiktoken
+# when its encoding is available locally, otherwise approximated.
+
+CONTEXT_TOKEN_BUDGET = int(os.getenv("CONTEXT_TOKEN_BUDGET", "4000"))
+TOKENIZER_ENCODING = os.getenv("TOKENIZER_ENCODING", "cl100k_base")
+
+# Overlap looked for between consecutive chunks (the splitter uses up to 100 characters);
+# shorter matches are treated as coincidence
+MAX_OVERLAP_CHARS = 200
+MIN_OVERLAP_CHARS = 10
+SEPARATOR = "\n\n"
+
+# Roughly one token per 4 characters of a word, and one per punctuation mark
+APPROX_TOKEN_PATTERN = re.compile(r"\w{1,4}|[^\w\s]")
+
+_encoding = None
+_encoding_loaded = False
+_encoding_lock = threading.Lock()
+
+
+def _get_encoding():
+    global _encoding, _encoding_loaded
+    with _encoding_lock:
+        if not _encoding_loaded:
+            _encoding_loaded = True
+            try:
+                import tiktoken
+                _encoding = tiktoken.get_encoding(TOKENIZER_ENCODING)
+            except Exception as e:
+                # The encoding file is downloaded on first use; offline we approximate
+                logger.warning("tiktoken unavailable, approximating token counts: %s", e)
+                _encoding = None
+        return _encoding
+
+
+def count_tokens(text):
+    encoding = _get_encoding()
+    if encoding is not None:
+        return len(encoding.encode(text, disallowed_special=()))
+    return len(APPROX_TOKEN_PATTERN.findall(text))
+
+
+def truncate_tokens(text, max_tokens):
+    """Longest prefix of text with at most max_tokens tokens"""
+    encoding = _get_encoding()
+    if encoding is not None:
+        return encoding.decode(encoding.encode(text, disallowed_special=())[:max_tokens])
+    matches = APPROX_TOKEN_PATTERN.finditer(text)
+    end = 0
+    for i, match in enumerate(matches):
+        if i >= max_tokens:
+            break
+        end = match.end()
+    return text[:end]
+
+
+def overlap_length(previous, following, max_chars=MAX_OVERLAP_CHARS):
+    """Length of the longest suffix of previous that starts following"""
+    for size in range(min(max_chars, len(previous), len(following)), MIN_OVERLAP_CHARS - 1, -1):
+        if previous.endswith(following[:size]):
+            return size
+    return 0
+
+
+def store_candidates(store, hits):
+    """Candidates for pack_context from (doc_id, score) pairs of a DocumentStore"""
+    candidates = []
+    for doc_id, score in hits:
+        text = store.documents.get(doc_id)
+        if not text:
+            continue
+        meta = store.get_metadata(doc_id) or {}
+        candidates.append({
+            "id": doc_id,
+            "text": text,
+            "score": float(score),
+            "parent": meta.get("parent_doc"),
+            "chunk_id": meta.get("chunk_id"),
+        })
+    return candidates
+
+
+def ranked_candidates(store, doc_ids):
+    """Candidates for documents without retrieval scores, ranked by their order"""
+    return store_candidates(store, [(doc_id, 1.0 / (rank + 1)) for rank, doc_id in enumerate(doc_ids)])
+
+
+def text_candidates(texts):
+    return [{"id": f"text_{i}", "text": text, "score": 1.0 / (i + 1), "parent": None, "chunk_id": None}
+            for i, text in enumerate(texts) if text]
+
+
+def pack_context(candidates, budget=CONTEXT_TOKEN_BUDGET):
+    """Fill the token budget with the candidates that give the most relevance per token.
+
+    Returns (context, report). The report lists the budget, the tokens used,
+    the included ids, the skipped ids with the reason and the overlap
+    characters trimmed between adjacent chunks.
+    """
+    report = {"budget": budget, "tokens": 0, "included": [], "skipped": [], "trimmed_chars": 0}
+    for candidate in candidates:
+        candidate["tokens"] = count_tokens(candidate["text"])
+
+    def density(candidate):
+        return candidate["score"] / max(candidate["tokens"], 1)
+
+    selected = []
+    included_ids = set()
+    used = 0
+    separator_tokens = count_tokens(SEPARATOR)
+    for candidate in sorted(candidates, key=density, reverse=True):
+        if candidate["id"] in included_ids:
+            continue
+        if candidate["parent"] in included_ids:
+            report["skipped"].append((candidate["id"], "parent included"))
+            continue
+        cost = candidate["tokens"] + (separator_tokens if selected else 0)
+        if used + cost > budget:
+            report["skipped"].append((candidate["id"], "over budget"))
+            continue
+        selected.append(candidate)
+        included_ids.add(candidate["id"])
+        used += cost
+
+    # A full document supersedes chunks of it that were selected before it
+    superseded = [c for c in selected if c["parent"] in included_ids]
+    for candidate in superseded:
+        selected.remove(candidate)
+        included_ids.discard(candidate["id"])
+        report["skipped"].append((candidate["id"], "parent included"))
+
+    if not selected and candidates:
+        # Nothing fits whole: use the head of the most relevant candidate instead of an empty context
+        best = max(candidates, key=lambda c: c["score"])
+        best = dict(best, text=truncate_tokens(best["text"], budget))
+        report["skipped"] = [entry for entry in report["skipped"] if entry[0] != best["id"]]
+        report["truncated"] = best["id"]
+        selected = [best]
+
+    # Chunks of one document are emitted together in document order, overlaps removed
+    groups = {}
+    group_score = {}
+    for candidate in selected:
+        key = candidate["parent"] or candidate["id"]
+        groups.setdefault(key, []).append(candidate)
+        group_score[key] = max(group_score.get(key, 0.0), candidate["score"])
+    parts = []
+    for key in sorted(groups, key=lambda k: group_score[k], reverse=True):
+        members = sorted(groups[key], key=lambda c: c["chunk_id"] if c["chunk_id"] is not None else -1)
+        text = members[0]["text"]
+        for previous, current in zip(members, members[1:]):
+            adjacent = (previous["chunk_id"] is not None and current["chunk_id"] is not None
+                        and current["chunk_id"] == previous["chunk_id"] + 1)
+            overlap = overlap_length(previous["text"], current["text"]) if adjacent else 0
+            if overlap:
+                report["trimmed_chars"] += overlap
+                text += current["text"][overlap:]
+            else:
+                text += SEPARATOR + current["text"]
+        parts.append(text)
+        report["included"].extend(c["id"] for c in members)
+
+    context = SEPARATOR.join(parts)
+    report["tokens"] = count_tokens(context) if context else 0
+    return context, report
@@ -0,0 +1,85 @@
+import os
+import json
+import time
+import random
+import logging
+import threading
+from collections import deque
+
+# Debug traces of chat requests (query, packed context, packing report). A
+# sample of them is kept in a fixed-size ring buffer in memory, readable from
+# /debug/traces, instead of rewriting a JSON file on every query. When
+# DEBUG_TRACE_FILE is set, a background thread writes the newest trace to it,
+# at most once every DEBUG_TRACE_FLUSH_SECONDS and never on the request path.
+#
+# Traces hold document text, so they are only kept when DEBUG_TRACES=1 (or a
+# trace file is configured), and /debug/traces only returns those of the
+# session asking for them.
+
+logger = logging.getLogger(__name__)
+
+DEBUG_TRACES = os.getenv("DEBUG_TRACES") == "1"
+DEBUG_TRACE_SAMPLE_RATE = float(os.getenv("DEBUG_TRACE_SAMPLE_RATE", "1.0"))
+DEBUG_TRACE_BUFFER = int(os.getenv("DEBUG_TRACE_BUFFER", "100"))
+DEBUG_TRACE_FILE = os.getenv("DEBUG_TRACE_FILE", "")
+DEBUG_TRACE_FLUSH_SECONDS = 5
+
+
+class TraceBuffer:
+    """Ring buffer of sampled traces with an optional background file writer"""
+
+    def __init__(self, capacity=DEBUG_TRACE_BUFFER, sample_rate=DEBUG_TRACE_SAMPLE_RATE, path=DEBUG_TRACE_FILE,
+                 enabled=DEBUG_TRACES):
+        self.enabled = enabled
+        self.traces = deque(maxlen=max(1, capacity))
+        self.sample_rate = sample_rate
+        self.path = path
+        self.recorded = 0
+        self.skipped = 0
+        self._pending = threading.Event()
+        self._writer = None
+        self._writer_lock = threading.Lock()
+
+    def record(self, data, session_id=None):
+        """Keep a trace of a session if it is sampled; returns whether it was kept"""
+        if not self.enabled and not self.path:
+            return False
+        if self.sample_rate < 1.0 and random.random() >= self.sample_rate:
+            self.skipped += 1
+            return False
+        self.traces.append({"data": data, "session_id": session_id, "timestamp": time.time()})
+        self.recorded += 1
+        if self.path:
+            self._start_writer()
+            self._pending.set()
+        return True
+
+    def recent(self, limit=None, session_id=None):
+        """Newest traces of a session (of all sessions when None) first"""
+        traces = [trace for trace in self.traces if session_id is None or trace["session_id"] == session_id]
+        traces.reverse()
+        return traces[:limit] if limit else traces
+
+    def _start_writer(self):
+        with self._writer_lock:
+            if self._writer is None:
+                self._writer = threading.Thread(target=self._write_loop, name="debug-trace-writer", daemon=True)
+                self._writer.start()
+
+    def _write_loop(self):
+        while True:
+            self._pending.wait()
+            self._pending.clear()
+            try:
+                latest = self.traces[-1]
+                temp_path = f"{self.path}.tmp"
+                with open(temp_path, "w", encoding="utf-8") as f:
+                    json.dump(latest, f, ensure_ascii=False, indent=2)
+                os.replace(temp_path, self.path)
+            except Exception as e:
+                logger.warning("Error writing debug trace to %s: %s", self.path, e)
+            # Traces recorded meanwhile are coalesced into the next write
+            time.sleep(DEBUG_TRACE_FLUSH_SECONDS)
+
+
+trace_buffer = TraceBuffer()
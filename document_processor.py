@@ -1,162 +1,323 @@
 import os
-import docx
-import pandas as pd
-import pdfplumber
-import chromadb
-from langchain.text_splitter import RecursiveCharacterTextSplitter
+import logging
+import time
+from parse_cache import parse_cache, file_sha256
+from document_store import DocumentStore
+from sessions import current_session, session_manager
+from metrics import observe_stage
+from text_pipeline import (StreamingSplitter, TextCollector, ChunkSpool, SpilledChunks, PipelineStats,
+                           format_report, session_spill_dir, CHUNK_SPILL_DIR, DOCUMENT_TEXT_MAX_CHARS)
 
 # Instead of ChromaDB, we'll use a simple in-memory document store
 import os
-from datetime import datetime
 
-# Global document store - simple dictionary to hold documents
-document_store = {}
+logger = logging.getLogger(__name__)
 
-# Document metadata store
-document_metadata = {}
+logger.info("Using simple in-memory document store instead of ChromaDB")
 
-# Store Excel data in JSON format for direct API access
-excel_json_data = {}
+# Characters read from a text file per segment, and chunks embedded per vector index call
+TXT_BLOCK_CHARS = 64 * 1024
+INDEX_BATCH_SIZE = 256
 
-print("Using simple in-memory document store instead of ChromaDB")
+# The helpers below act on the document store of the current session
+# (see sessions.py); a single-user process simply uses the default session.
+
+# Function to get the document store of the current session
+def get_store():
+    return current_session().store
 
 # Function to clear document store
 def clear_document_store():
-    global document_store, document_metadata
-    document_store = {}
-    document_metadata = {}
-    print("Document store cleared")
+    get_store().clear()
+    logger.info("Document store cleared")
     return True
 
 # Function to add document to store
-def add_document(doc_id, content, metadata=None):
-    global document_store, document_metadata
-    document_store[doc_id] = content
-    document_metadata[doc_id] = {
-        "timestamp": datetime.now().isoformat(),
-        "metadata": metadata or {}
-    }
-    return True
+def add_document(doc_id, content, metadata=None, index=True):
+    return get_store().add(doc_id, content, metadata, index=index)
+
+# Function to embed stored documents into the vector index
+def add_document_vectors(doc_ids, contents):
+    return get_store().add_vectors(doc_ids, contents)
 
 # Function to get all documents
 def get_documents():
-    return document_store
+    return get_store().documents
 
 # Function to check if document store is empty
 def is_document_store_empty():
-    return len(document_store) == 0
+    return get_store().is_empty()
 
-def process_document(file_path):
+# Function to get the file types of the stored documents
+def get_document_types():
+    return get_store().document_types()
+
+def process_document(file_path, content_hash=None, session=None):
     """Process document based on file extension and store in vector DB"""
-    print(f"Processing document: {file_path}")
-    _, file_extension = os.path.splitext(file_path)
-    file_extension = file_extension.lower()
+    logger.info("Processing document: %s", file_path)
     
     # Check if file exists
     if not os.path.exists(file_path):
-        print(f"File not found: {file_path}")
+        logger.warning("File not found: %s", file_path)
         return False
     
-    print(f"Detected file type: {file_extension}")
+    try:
+        parsed = extract_document_cached(file_path, content_hash)
+        return store_document(file_path, parsed, session)
+    except Exception as e:
+        logger.exception("Error processing document: %s", e)
+        return False
+
+def extract_document_cached(file_path, content_hash=None, progress=None):
+    """extract_document with results cached by the SHA-256 of the file bytes"""
+    if content_hash is None:
+        content_hash = file_sha256(file_path)
+    
+    parsed = parse_cache.get(content_hash)
+    if parsed is not None:
+        logger.info("Parse cache hit for %s (%s)", file_path, content_hash[:12])
+        parsed["from_cache"] = True
+        parsed["cached"] = True
+        return parsed
+    
+    parsed = extract_document(file_path, progress, content_hash)
+    # Results too large for the cache keep their spill files until they are stored
+    parsed["cached"] = parse_cache.put(content_hash, parsed)
+    return parsed
+
+def release_parsed(parsed):
+    """Delete the spill files of a parse result the parse cache did not keep, once it was stored"""
+    if parsed.get("cached") is not False:
+        return
+    for path in parsed.get("spill_files", ()):
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+def extract_document(file_path, progress=None, content_hash=None):
+    """Extract and split a document without touching the store.
+
+    Safe to run in a worker process: the result is a plain dict that
+    store_document() adds to the store in the serving process. Its chunks are
+    (text, metadata) pairs, in a list or, for long documents, in a spill
+    file; its text is None for documents too long to also store whole.
+    progress, if given, is called with the name of each stage as it starts.
+    Spill files are named after content_hash, the SHA-256 of the file, which
+    is computed when not given.
+    """
+    if content_hash is None:
+        content_hash = file_sha256(file_path)
+    _, file_extension = os.path.splitext(file_path)
+    file_extension = file_extension.lower()
+    logger.debug("Detected file type: %s", file_extension)
+    
+    if progress:
+        progress("parsing")
+    
+    segments, separator, excel_data = document_segments(file_path, file_extension, content_hash)
     
+    # Extraction, splitting and spooling run as one stream, a window of text at a time
+    stats = PipelineStats()
+    collector = TextCollector()
+    spool = ChunkSpool(os.path.join(CHUNK_SPILL_DIR, f"{content_hash}.chunks"))
+    splitter = StreamingSplitter()
     try:
-        # Extract text based on file type
-        if file_extension == '.docx':
-            print("Processing Word document...")
-            text = process_docx(file_path)
-        elif file_extension == '.xlsx' or file_extension == '.xls':
-            print("Processing Excel document...")
-            text = process_excel(file_path)
-        elif file_extension == '.pdf':
-            print("Processing PDF document...")
-            text = process_pdf(file_path)
-        elif file_extension == '.txt':
-            print("Processing text document...")
-            text = process_txt(file_path)
-        else:
-            print(f"Unsupported file type: {file_extension}")
-            raise ValueError(f"Unsupported file type: {file_extension}")
-        
-        print(f"Successfully extracted text, length: {len(text)}")
-        
-        # Split text into chunks for vector storage
-        text_splitter = RecursiveCharacterTextSplitter(
-            chunk_size=1000,
-            chunk_overlap=100,
-            length_function=len,
-        )
-        chunks = text_splitter.split_text(text)
-        print(f"Split into {len(chunks)} chunks")
-        
-        # Clear existing documents when uploading a new one
-        clear_document_store()
-        
-        # Store document in memory
-        doc_id = os.path.basename(file_path)
-        
-        # Store the text directly
-        if text and len(text) > 0:
-            print(f"Storing document: {doc_id} (length: {len(text)})")
+        segments = collector.collect(stats.meter("extract", segments))
+        for chunk, metadata in stats.meter("split", splitter.split(segments, separator)):
+            if spool.count == 0 and progress:
+                progress("splitting")
+            spool.append(chunk, metadata)
+        chunks = spool.finish()
+    except BaseException:
+        spool.discard()
+        raise
+    
+    report = stats.report()
+    logger.info("Split %s into %s chunks: %s", file_path, len(chunks), format_report(report))
+    
+    spill_files = []
+    if excel_data:
+        from excel_store import SpilledSheet
+        spill_files = [sheet.path for sheet in excel_data.values() if isinstance(sheet, SpilledSheet)]
+    if isinstance(chunks, SpilledChunks):
+        spill_files.append(chunks.path)
+    return {"type": file_extension, "text": collector.text(separator), "chunks": chunks,
+            "excel_data": excel_data, "stats": report, "spill_files": spill_files}
 
-            add_document(doc_id, text, {"source": file_path, "type": file_extension})
-            print(f"Successfully stored document in memory")
+def _docx_segments(file_path, content_hash):
+    from docx_extract import iter_docx_blocks
+    logger.debug("Processing Word document...")
+    return ((block, None) for block in iter_docx_blocks(file_path)), '\n', None
 
-        else:
-            print("Warning: No text to store from document")
+def _excel_segments(file_path, content_hash):
+    logger.debug("Processing Excel document...")
+    text, excel_data = extract_excel(file_path, content_hash)
+    # Excel extraction reports failures in its return value rather than raising
+    if excel_data is None:
+        raise ValueError(text)
+    return [(text, None)], '\n', excel_data
 
-        
-        # If we have chunks, store them as well for more detailed access
-        if chunks and len(chunks) > 0:
-            print(f"Storing {len(chunks)} chunks from document")
-
-            for i, chunk in enumerate(chunks):
-                chunk_id = f"{doc_id}_chunk_{i}"
-                add_document(chunk_id, chunk, {
-                    "source": file_path,
-                    "chunk_id": i,
-                    "total_chunks": len(chunks),
-                    "parent_doc": doc_id
-                })
-        
-        # Verify storage was successful
-        doc_count = len(document_store)
-        print(f"Document store now has {doc_count} documents/chunks")
+def _pdf_segments(file_path, content_hash):
+    from pdf_extract import iter_pdf_pages
+    logger.debug("Processing PDF document...")
+    # Chunks never span pages, so each one carries the number of its page
+    return ((text, {"page": page_number}) for page_number, text in iter_pdf_pages(file_path)), '\n\n', None
 
-            
-        return True
-    except Exception as e:
-        print(f"Error processing document: {e}")
-        import traceback
-        traceback.print_exc()
-        return False
+def _txt_segments(file_path, content_hash):
+    logger.debug("Processing text document...")
+    return ((block, None) for block in iter_txt_blocks(file_path)), '', None
+
+# Segment reader per file extension. Each one imports its parsing library
+# (python-docx/lxml, pandas/openpyxl, pdfplumber) when it is first called, so
+# a process only loads the libraries of the file types it actually receives.
+FORMAT_HANDLERS = {
+    '.docx': _docx_segments,
+    '.xlsx': _excel_segments,
+    '.xls': _excel_segments,
+    '.pdf': _pdf_segments,
+    '.txt': _txt_segments,
+}
+
+def document_segments(file_path, file_extension, content_hash):
+    """(segments, separator, excel_data) for a document.
+
+    segments yields (text, metadata) pairs as the extractor produces them;
+    separator is what joins consecutive segments into the document text.
+    content_hash names the spill files of streamed workbooks.
+    """
+    handler = FORMAT_HANDLERS.get(file_extension)
+    if handler is None:
+        logger.warning("Unsupported file type: %s", file_extension)
+        raise ValueError(f"Unsupported file type: {file_extension}")
+    return handler(file_path, content_hash)
+
+def parsed_text(parsed, max_chars=DOCUMENT_TEXT_MAX_CHARS):
+    """Text of a parsed document; the leading chunks when it was too long to keep whole"""
+    if parsed["text"] is not None:
+        return parsed["text"]
+    parts = []
+    size = 0
+    for chunk, _ in parsed["chunks"]:
+        if size + len(chunk) > max_chars:
+            break
+        parts.append(chunk)
+        size += len(chunk)
+    return '\n'.join(parts)
+
+def store_document(file_path, parsed, session=None):
+    """Replace a session's documents with one returned by extract_document.
+
+    The document is loaded into a new store which is then swapped into the
+    session, so queries running meanwhile keep reading the previous store.
+    Chunks are read from the parse result (or its spill file) and indexed in
+    batches, so they are never all held twice.
+    """
+    if session is None:
+        session = current_session()
+    text = parsed["text"]
+    chunks = parsed["chunks"]
+    file_extension = parsed["type"]
+    
+    # Extraction may have run in a worker process, so its stage times are recorded here
+    if not parsed.get("from_cache"):
+        for stage in ("extract", "split"):
+            if stage in (parsed.get("stats") or {}):
+                observe_stage(stage, parsed["stats"][stage]["seconds"], file_extension)
+    
+    # A fresh store replaces the existing documents when uploading a new one
+    store = DocumentStore()
+    
+    if parsed["excel_data"] is not None:
+        from excel_store import link_spilled_sheets
+        # Spilled sheets are read through links of the session, which the parse cache does not delete
+        store.set_excel_data(link_spilled_sheets(parsed["excel_data"], session_spill_dir(session.session_id)))
+    
+    # Store document in memory
+    doc_id = os.path.basename(file_path)
+    
+    # Short documents are also stored whole; long ones only as chunks
+    if text:
+        store.add(doc_id, text, {"source": file_path, "type": file_extension}, index=False)
+    
+    total_chunks = len(chunks)
+    if total_chunks > 0:
+        start = time.perf_counter()
+        chars = 0
+        batch_ids = []
+        batch_texts = []
+        for i, (chunk, chunk_metadata) in enumerate(chunks):
+            chunk_id = f"{doc_id}_chunk_{i}"
+            metadata = {
+                "source": file_path,
+                "type": file_extension,
+                "chunk_id": i,
+                "total_chunks": total_chunks,
+                "parent_doc": doc_id
+            }
+            if chunk_metadata:
+                metadata.update(chunk_metadata)
+            store.add(chunk_id, chunk, metadata)
+            chars += len(chunk)
+            batch_ids.append(chunk_id)
+            batch_texts.append(chunk)
+            # Embed chunks in batches rather than one call per chunk
+            if len(batch_ids) >= INDEX_BATCH_SIZE:
+                store.add_vectors(batch_ids, batch_texts)
+                batch_ids, batch_texts = [], []
+        if batch_ids:
+            store.add_vectors(batch_ids, batch_texts)
+        elapsed = time.perf_counter() - start
+        observe_stage("index", elapsed, file_extension)
+        stats = PipelineStats()
+        stats.record("index", chars, elapsed)
+        report = stats.report()
+        if isinstance(parsed.get("stats"), dict):
+            parsed["stats"].update(report)
+        logger.info("Indexed %s chunks of %s: %s", total_chunks, doc_id, format_report(report))
+    elif not text:
+        logger.warning("No text to store from document")
+    
+    session.replace_store(store)
+    session_manager.update_memory(session)
+    release_parsed(parsed)
+    
+    # Verify storage was successful
+    logger.debug("Document store for session %s now has %s documents/chunks", session.session_id, len(store))
+
+    return True
 
 def process_docx(file_path):
-    """Extract text from DOCX file"""
-    doc = docx.Document(file_path)
-    full_text = []
-    for para in doc.paragraphs:
-        full_text.append(para.text)
-    return '\n'.join(full_text)
+    """Extract text from DOCX file, including tables"""
+    from docx_extract import iter_docx_blocks
+    return '\n'.join(iter_docx_blocks(file_path))
 
 def process_excel(file_path):
-    """Extract structured data from Excel file and convert to JSON format"""
-    print(f"Processing Excel file: {file_path}")
+    """Extract structured data from Excel file as text"""
+    text, _ = extract_excel(file_path)
+    return text
+
+def extract_excel(file_path, content_hash=None):
+    """Extract structured text and per-sheet columnar data from an Excel file.
+    On failure the sheet data is None and the text describes the error."""
+    import pandas as pd
+    from excel_store import to_columnar
+    from excel_stream import use_streaming, stream_excel
+    from excel_profile import profile_sheet, format_sheet_header, format_sheet_insights, format_data_rows
+    
+    logger.debug("Processing Excel file: %s", file_path)
     try:
+        # Large workbooks are profiled batch by batch with bounded memory
+        if use_streaming(file_path):
+            result, excel_data = stream_excel(file_path, content_hash=content_hash)
+            logger.debug("Total extracted structured text length: %s", len(result))
+            return result, excel_data
+
         # Read all sheets in the Excel file
         df = pd.read_excel(file_path, sheet_name=None)
         
-        # Store the original data in JSON format for direct API access
-        excel_data_json = {}
-        for sheet_name, sheet_df in df.items():
-            # Convert DataFrame to records format (list of dictionaries)
-            excel_data_json[sheet_name] = sheet_df.to_dict(orient='records')
-        
-        # Store the JSON data for later use
-        global excel_json_data
-        excel_json_data = excel_data_json
-        
         structured_texts = []
-        print(f"Excel file has {len(df)} sheets: {list(df.keys())}")
+        logger.debug("Excel file has %s sheets: %s", len(df), list(df.keys()))
         
         # First add a summary section
         summary = [f"EXCEL FILE SUMMARY: {os.path.basename(file_path)}", 
@@ -167,236 +328,78 @@ def process_excel(file_path):
         
         # Process each sheet
         for sheet_name, sheet_df in df.items():
-            print(f"Processing sheet: {sheet_name} with {len(sheet_df)} rows and {len(sheet_df.columns)} columns")
-            
-            # Add sheet header with statistical summary
-            sheet_header = [f"SHEET: {sheet_name}",
-                          f"Rows: {len(sheet_df)}", 
-                          f"Columns: {len(sheet_df.columns)}",
-                          f"Column names: {', '.join(sheet_df.columns.astype(str))}",
-                          ""]
-            
-            # Enhanced numerical analysis
-            try:
-                # Convert column names to lowercase for case-insensitive matching
-                lower_cols = {col.lower(): col for col in sheet_df.columns}
-                
-                # Try to identify profit or revenue columns
-                profit_keywords = ['profit', 'laba', 'keuntungan', 'revenue', 'pendapatan', 'income']
-                profit_cols = []
-                for keyword in profit_keywords:
-                    matching_cols = [lower_cols[col] for col in lower_cols if keyword in col.lower()]
-                    profit_cols.extend(matching_cols)
-                
-                if profit_cols:
-                    sheet_header.append("PROFIT/REVENUE ANALYSIS:")
-                    for col in profit_cols:
-                        try:
-                            # Get top profit entries
-                            top_n = 5  # Number of top entries to show
-                            top_profit = sheet_df.nlargest(top_n, col)
-                            
-                            sheet_header.append(f"Top {top_n} highest {col}:")
-                            for i, (idx, row) in enumerate(top_profit.iterrows(), 1):
-                                # Try to find identifying columns like name, product, etc.
-                                id_cols = [c for c in sheet_df.columns if any(k in c.lower() for k in ['name', 'nama', 'product', 'produk', 'item', 'description', 'deskripsi', 'id'])]
-                                
-                                if id_cols:
-                                    identifiers = [f"{c}: {row[c]}" for c in id_cols if pd.notna(row[c])]
-                                    item_desc = ", ".join(identifiers)
-                                else:
-                                    # Use row index as identifier
-                                    item_desc = f"Row {idx+1}"
-                                    
-                                sheet_header.append(f"  {i}. {item_desc} = {row[col]}")
-                            sheet_header.append("")
-                            
-                            # Calculate profit distribution
-                            sheet_header.append(f"{col} distribution:")
-                            quartiles = sheet_df[col].quantile([0.25, 0.5, 0.75]).to_dict()
-                            sheet_header.append(f"  25% of values are below: {quartiles[0.25]}")
-                            sheet_header.append(f"  Median value: {quartiles[0.5]}")
-                            sheet_header.append(f"  75% of values are above: {quartiles[0.75]}")
-                            sheet_header.append("")
-                        except Exception as e:
-                            print(f"Error analyzing profit column {col}: {e}")
-            except Exception as e:
-                print(f"Error in enhanced profit analysis: {e}")
-            
-            # Add statistical summaries for numerical columns
-            numerical_cols = sheet_df.select_dtypes(include=['number']).columns
-            if len(numerical_cols) > 0:
-                sheet_header.append("NUMERICAL COLUMN STATISTICS:")
-                for col in numerical_cols:
-                    try:
-                        stats = f"Column '{col}': Min={sheet_df[col].min()}, Max={sheet_df[col].max()}, Mean={sheet_df[col].mean():.2f}, Sum={sheet_df[col].sum()}"
-                        sheet_header.append(stats)
-                    except Exception as e:
-                        print(f"Error calculating stats for {col}: {e}")
-                sheet_header.append("")
-            
-            structured_texts.extend(sheet_header)
-            
-            # Process data in chunks to maintain structure
-            if len(sheet_df) > 0:
-                structured_texts.append("DATA:")
-                
-                # Format as a structured table - first the headers
-                header_row = " | ".join([f"{col}" for col in sheet_df.columns])
-                structured_texts.append(header_row)
-                structured_texts.append("-" * len(header_row))  # Separator line
-                
-                # Then row data in a structured format
-                for i, row in sheet_df.iterrows():
-                    if i < 100:  # Limit rows to prevent massive texts
-                        row_str = " | ".join([f"{val}" for val in row.values])
-                        structured_texts.append(row_str)
-                    else:
-                        structured_texts.append(f"... (Showing first 100 of {len(sheet_df)} rows)")
-                        break
-                
-                structured_texts.append("")  # Blank line after data
-            
-            # Try to identify key insights if possible
-            structured_texts.append("POTENTIAL INSIGHTS:")
-            
-            # Enhanced correlation analysis between columns
-            try:
-                # Calculate correlations between numerical columns
-                if len(numerical_cols) > 1:
-                    corr_matrix = sheet_df[numerical_cols].corr()
-                    # Find strong correlations (absolute value > 0.7)
-                    strong_correlations = []
-                    for i in range(len(numerical_cols)):
-                        for j in range(i+1, len(numerical_cols)):
-                            col1, col2 = numerical_cols[i], numerical_cols[j]
-                            corr_val = corr_matrix.loc[col1, col2]
-                            if abs(corr_val) > 0.7:  # Strong correlation threshold
-                                relation = "positively" if corr_val > 0 else "negatively"
-                                strong_correlations.append(
-                                    f"- Strong {relation} correlation ({corr_val:.2f}) between '{col1}' and '{col2}'"
-                                )
-                    
-                    if strong_correlations:
-                        structured_texts.append("CORRELATIONS:")
-                        structured_texts.extend(strong_correlations)
-                        structured_texts.append("")
-            except Exception as e:
-                print(f"Error analyzing correlations: {e}")
-                
-            # Check for dates to suggest time-series analysis
-            date_cols = sheet_df.select_dtypes(include=['datetime64']).columns
-            if len(date_cols) > 0:
-                structured_texts.append(f"- Time series data detected in columns: {', '.join(date_cols)}")
-                
-                # Try to analyze trends over time if date and numeric columns exist
-                if len(numerical_cols) > 0 and len(date_cols) > 0:
-                    try:
-                        date_col = date_cols[0]  # Use first date column
-                        structured_texts.append(f"TREND ANALYSIS using date column: {date_col}")
-                        
-                        # Sort by date
-                        sorted_df = sheet_df.sort_values(date_col)
-                        
-                        # Look at changes in numerical columns over time
-                        for num_col in numerical_cols[:3]:  # Analyze up to 3 columns
-                            try:
-                                first_val = sorted_df[num_col].iloc[0]
-                                last_val = sorted_df[num_col].iloc[-1]
-                                change = last_val - first_val
-                                pct_change = (change / first_val * 100) if first_val != 0 else float('inf')
-                                
-                                direction = "increased" if change > 0 else "decreased" if change < 0 else "remained the same"
-                                
-                                structured_texts.append(
-                                    f"- '{num_col}' {direction} by {abs(change):.2f} ({abs(pct_change):.1f}%) from "
-                                    f"{sorted_df[date_col].iloc[0]} to {sorted_df[date_col].iloc[-1]}"
-                                )
-                            except:
-                                pass
-                        structured_texts.append("")
-                    except Exception as e:
-                        print(f"Error in trend analysis: {e}")
+            logger.debug("Processing sheet: %s with %s rows and %s columns", sheet_name, len(sheet_df), len(sheet_df.columns))
             
-            # Check for potential ID columns
-            for col in sheet_df.columns:
-                if 'id' in str(col).lower() or 'code' in str(col).lower():
-                    unique_vals = sheet_df[col].nunique()
-                    structured_texts.append(f"- Possible ID column: '{col}' with {unique_vals} unique values")
+            # Statistics for the whole sheet, computed in one vectorized pass
+            profile = profile_sheet(sheet_df)
             
-            structured_texts.append("")  # Blank line
+            # Sheet header with statistical summary, then the data itself, then insights
+            structured_texts.extend(format_sheet_header(sheet_name, profile))
+            structured_texts.extend(format_data_rows(sheet_df, limit=100))
+            structured_texts.extend(format_sheet_insights(profile))
         
         result = '\n'.join(structured_texts)
-        print(f"Total extracted structured text length: {len(result)}")
-        return result
+        logger.debug("Total extracted structured text length: %s", len(result))
+        
+        # Keep the sheet data in compact columnar form for direct API access
+        excel_data = {sheet_name: to_columnar(sheet_df) for sheet_name, sheet_df in df.items()}
+        return result, excel_data
     except Exception as e:
-        print(f"Error in Excel processing: {e}")
-        import traceback
-        traceback.print_exc()
-        return f"Error processing Excel file: {str(e)}"
+        logger.exception("Error in Excel processing: %s", e)
+        return f"Error processing Excel file: {str(e)}", None
 
 def process_pdf(file_path):
     """Extract text from PDF file"""
-    text = []
-    with pdfplumber.open(file_path) as pdf:
-        for page in pdf.pages:
-            text.append(page.extract_text())
-    return '\n\n'.join(text)
+    from pdf_extract import iter_pdf_pages
+    return '\n\n'.join(text for _, text in iter_pdf_pages(file_path))
 
 def process_txt(file_path):
     """Extract text from TXT file"""
+    return ''.join(iter_txt_blocks(file_path))
+
+def iter_txt_blocks(file_path, block_chars=TXT_BLOCK_CHARS):
+    """Yield the text of a TXT file a block at a time"""
     with open(file_path, 'r', encoding='utf-8', errors='ignore') as file:
-        return file.read()
+        for block in iter(lambda: file.read(block_chars), ''):
+            yield block
 
 def get_all_documents(limit=None):
     """Get all documents from the in-memory document store"""
-    global document_store
-    
     try:
-        print(f"Getting all documents from in-memory store")
+        logger.debug("Getting all documents from in-memory store")
+        store = get_store()
         
         # Check if document store is empty
-        if is_document_store_empty():
-            print("Document store is empty")
+        if store.is_empty():
+            logger.debug("Document store is empty")
             return []
         
-        # Get all document contents
-        all_docs = list(document_store.values())
-        
-        # Apply limit if specified
-        if limit and len(all_docs) > limit:
-            all_docs = all_docs[:limit]
+        # Get all document contents, applying limit if specified
+        all_docs = store.all_documents(limit)
             
-        print(f"Returning {len(all_docs)} documents from document store")
+        logger.debug("Returning %s documents from document store", len(all_docs))
         return all_docs
     except Exception as e:
-        print(f"Error getting all documents: {e}")
-        import traceback
-        traceback.print_exc()
+        logger.exception("Error getting all documents: %s", e)
         return []
 
 def get_relevant_documents(query, top_k=5):
-    """Retrieve relevant documents for a query from in-memory store"""
-    global document_store
-    
-    print(f"Searching for documents relevant to query: {query}")
+    """Retrieve the chunks that best match a query using the configured retrieval mode"""
+    logger.debug("Searching for documents relevant to query: %s", query)
     
     try:
+        store = get_store()
+        
         # Check if document store is empty
-        if is_document_store_empty():
-            print("Document store is empty")
+        if store.is_empty():
+            logger.debug("Document store is empty")
             return []
-            
-        # Simple relevance: just return all documents
-        # In a real implementation, you could add simple keyword matching here
-        docs = list(document_store.values())
         
-        print(f"Found {len(docs)} documents in store")
+        docs = store.relevant_documents(query, top_k)
+        
+        logger.debug("Found %s matching chunks in store of %s documents", len(docs), len(store))
         
-        # Return up to top_k documents
-        return docs[:top_k] if top_k < len(docs) else docs
+        return docs
     except Exception as e:
-        print(f"Error searching document store: {e}")
-        import traceback
-        traceback.print_exc()
+        logger.exception("Error searching document store: %s", e)
         return []
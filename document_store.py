@@ -0,0 +1,224 @@
+import os
+import logging
+import time
+import uuid
+import hashlib
+import threading
+
+from search_index import InvertedIndex
+from vector_index import VectorIndex, create_embedder
+from text_table import TextTable, TextView, MappedTextTable
+
+logger = logging.getLogger(__name__)
+
+# Retrieval configuration: "bm25" (lexical only), "dense" or "hybrid"
+RETRIEVAL_MODE = os.getenv("RETRIEVAL_MODE", "hybrid")
+EMBEDDING_BACKEND = os.getenv("EMBEDDING_BACKEND", "hashing")
+HYBRID_ALPHA = float(os.getenv("HYBRID_ALPHA", "0.5"))
+
+# Directory for memory-mapped vector matrices (one file per store); in RAM when unset
+VECTOR_INDEX_DIR = os.getenv("VECTOR_INDEX_DIR")
+
+# Embedders are stateless, so every store shares one instance
+_embedder = None
+_embedder_lock = threading.Lock()
+
+
+def _shared_embedder():
+    global _embedder
+    with _embedder_lock:
+        if _embedder is None:
+            _embedder = create_embedder(EMBEDDING_BACKEND)
+            logger.info("Using %s embeddings for %s retrieval", EMBEDDING_BACKEND, RETRIEVAL_MODE)
+        return _embedder
+
+
+class DocumentStore:
+    """Documents, metadata, Excel data and retrieval indexes of one session.
+
+    Ingestion fills a fresh store and then swaps it into the session, so a
+    store being read by queries is never cleared underneath them. Writes to a
+    live store are serialized by a lock; reads take no lock. Text and
+    metadata are kept in a compact TextTable; `documents` is a read-only
+    doc_id -> text mapping over it.
+    """
+
+    def __init__(self):
+        self.store_id = uuid.uuid4().hex
+        self.texts = TextTable()
+        self.excel_data = {}
+        self._excel_payloads = {}
+        self._content_digest = hashlib.sha1()
+        self.lock = threading.Lock()
+        self.search_index = InvertedIndex()
+        self.vector_index = None
+        if RETRIEVAL_MODE in ("dense", "hybrid"):
+            try:
+                path = None
+                if VECTOR_INDEX_DIR:
+                    os.makedirs(VECTOR_INDEX_DIR, exist_ok=True)
+                    path = os.path.join(VECTOR_INDEX_DIR, f"{self.store_id}.f32")
+                self.vector_index = VectorIndex(_shared_embedder(), path=path)
+            except Exception as e:
+                logger.warning("Error initializing vector index, falling back to BM25: %s", e)
+
+    @property
+    def documents(self):
+        return TextView(self.texts)
+
+    def __len__(self):
+        return len(self.texts)
+
+    def is_empty(self):
+        return len(self.texts) == 0
+
+    def clear(self):
+        with self.lock:
+            self.texts = TextTable()
+            self.excel_data = {}
+            self._excel_payloads = {}
+            self._content_digest = hashlib.sha1()
+            self.search_index.clear()
+            if self.vector_index is not None:
+                self.vector_index.clear()
+        return True
+
+    def _writable(self):
+        """Copy a store loaded from a snapshot into mutable tables before its first write.
+
+        Called with the lock held. Text, postings and vectors of a loaded store
+        are read in place from the mapped file, so they are rebuilt from its
+        rows rather than changed.
+        """
+        if not isinstance(self.texts, MappedTextTable):
+            return
+        copy = DocumentStore()
+        for doc_id, text, metadata, timestamp, indexed in self.rows():
+            copy.add(doc_id, text, metadata, index=indexed, timestamp=timestamp)
+        if self.vector_index is not None and copy.vector_index is not None and len(self.vector_index) > 0:
+            copy.load_vectors(*self.vector_index.live_vectors())
+        self.texts, self._content_digest = copy.texts, copy._content_digest
+        self.search_index, self.vector_index = copy.search_index, copy.vector_index
+        self.store_id = copy.store_id
+
+    def add(self, doc_id, content, metadata=None, index=True, timestamp=None):
+        with self.lock:
+            self._writable()
+            self.texts.add(doc_id, content, metadata, time.time() if timestamp is None else timestamp)
+            self._content_digest.update(f"{doc_id}\0{len(content)}\0".encode('utf-8'))
+            self._content_digest.update(content.encode('utf-8', 'surrogatepass'))
+            # Full-document entries are stored unindexed so that ranking happens over chunks
+            if index:
+                self.search_index.add(doc_id, content)
+            else:
+                self.search_index.remove(doc_id)
+                if self.vector_index is not None:
+                    self.vector_index.remove(doc_id)
+        return True
+
+    def content_version(self):
+        """Digest of everything added since the store was created or cleared.
+
+        Stores holding the same documents have the same version, and every
+        add or clear changes it.
+        """
+        with self.lock:
+            return self._content_digest.hexdigest()
+
+    def add_vectors(self, doc_ids, contents):
+        """Embed stored documents into the vector index in batches"""
+        if self.vector_index is None:
+            return False
+        with self.lock:
+            self._writable()
+            self.vector_index.add(doc_ids, contents)
+        return True
+
+    def load_vectors(self, doc_ids, vectors):
+        """Add vectors embedded earlier (e.g. by another worker) without embedding again"""
+        if self.vector_index is None:
+            return False
+        with self.lock:
+            self._writable()
+            self.vector_index.add_vectors(doc_ids, vectors)
+        return True
+
+    def rows(self):
+        """(doc_id, text, metadata, timestamp, indexed) of every add, in order.
+
+        Adding these rows to an empty store again rebuilds the same table,
+        indexes and content version.
+        """
+        texts = self.texts
+        indexed = self.search_index.doc_numbers
+        for row, doc_id in enumerate(texts.doc_ids):
+            yield doc_id, texts.text(row), texts.metadata(row), texts.timestamps[row], doc_id in indexed
+
+    def set_excel_data(self, sheets):
+        """Attach columnar sheet data (sheet name -> DataFrame)"""
+        with self.lock:
+            self.excel_data = sheets
+            self._excel_payloads = {}
+
+    def excel_payload(self, max_chars=12000):
+        """JSON view of the Excel data for the model, built once per store"""
+        payload = self._excel_payloads.get(max_chars)
+        if payload is None:
+            from excel_store import excel_payload
+            payload = excel_payload(self.excel_data, max_chars)
+            self._excel_payloads[max_chars] = payload
+        return payload
+
+    def get_metadata(self, doc_id):
+        """Metadata a document was added with, or None"""
+        record = self.texts.record(doc_id)
+        return None if record is None else record.metadata
+
+    def record(self, doc_id):
+        """DocumentRecord view (doc_id, text, metadata, timestamp) of a document, or None"""
+        return self.texts.record(doc_id)
+
+    def document_types(self):
+        return {meta.get("type") for meta in self.texts.metas if meta.get("type")}
+
+    def all_documents(self, limit=None):
+        documents = self.documents
+        doc_ids = list(documents)
+        if limit and len(doc_ids) > limit:
+            doc_ids = doc_ids[:limit]
+        return [documents[doc_id] for doc_id in doc_ids]
+
+    def search(self, query, top_k=5):
+        """Return (doc_id, score) pairs using the configured retrieval mode"""
+        vector_index = self.vector_index
+        if vector_index is not None and len(vector_index) > 0 and RETRIEVAL_MODE == "dense":
+            return vector_index.search(query, top_k=top_k)
+        if vector_index is not None and len(vector_index) > 0 and RETRIEVAL_MODE == "hybrid":
+            lexical_hits = self.search_index.search(query, top_k=top_k * 4)
+            return vector_index.hybrid_search(query, lexical_hits, top_k=top_k, alpha=HYBRID_ALPHA)
+        return self.search_index.search(query, top_k=top_k)
+
+    def relevant_documents(self, query, top_k=5):
+        documents = self.documents
+        return [documents[doc_id] for doc_id, _ in self.search(query, top_k) if doc_id in documents]
+
+    def memory_usage(self):
+        """Rough resident size in bytes, used for the session memory cap"""
+        size = self.texts.memory_usage()
+        # Postings and document lengths are 4-byte array entries
+        size += 8 * sum(len(postings) for postings in self.search_index.postings_docs)
+        if self.vector_index is not None and not self.vector_index.path:
+            size += self.vector_index.matrix.nbytes
+        if self.excel_data:
+            # Excel helpers (and pandas) are only loaded for stores that hold sheets
+            from excel_store import sheets_memory_usage
+            size += sheets_memory_usage(self.excel_data)
+        return size
+
+    def close(self):
+        """Release resources held outside the Python heap"""
+        if self.vector_index is not None and self.vector_index.path:
+            try:
+                os.remove(self.vector_index.path)
+            except FileNotFoundError:
+                pass
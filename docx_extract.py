@@ -0,0 +1,125 @@
+import zipfile
+
+from lxml import etree
+
+# Streaming text extraction for .docx files. word/document.xml is read from
+# the zip with an incremental parser that only reports paragraphs, table rows
+# and tables, and each block is yielded in document order as soon as it ends.
+# Finished elements are removed from the tree, so memory stays flat however
+# long the document is. Table rows are pipe-delimited like the DATA section of
+# Excel sheets, with a separator line after the first (header) row; rows of
+# nested tables become text of the enclosing cell.
+
+DOCUMENT_PART = "word/document.xml"
+
+W = "{http://schemas.openxmlformats.org/wordprocessingml/2006/main}"
+MC = "{http://schemas.openxmlformats.org/markup-compatibility/2006}"
+
+BODY = W + "body"
+PARAGRAPH = W + "p"
+TABLE = W + "tbl"
+ROW = W + "tr"
+CELL = W + "tc"
+TEXT = W + "t"
+TAB = W + "tab"
+BREAK = W + "br"
+CARRIAGE_RETURN = W + "cr"
+# Alternate rendering of content that is also present in the mc:Choice branch (e.g. text boxes)
+FALLBACK = MC + "Fallback"
+
+RUN_CONTENT = {TAB: "\t", BREAK: "\n", CARRIAGE_RETURN: "\n"}
+
+
+def paragraph_text(paragraph):
+    return "".join(node.text or "" if node.tag == TEXT else RUN_CONTENT[node.tag]
+                   for node in paragraph.iter(TEXT, TAB, BREAK, CARRIAGE_RETURN))
+
+
+def cell_text(cell):
+    """Paragraphs of a table cell on one line; nested tables as pipe-delimited rows"""
+    parts = []
+    for child in cell.iter(PARAGRAPH, TABLE):
+        if child.getparent() is not cell and not _inside(child, cell):
+            continue
+        if child.tag == TABLE:
+            parts.extend(row_text(row) for row in child.iter(ROW) if _inside(row, child))
+        else:
+            text = paragraph_text(child)
+            if text:
+                parts.append(text)
+    return " ".join(parts)
+
+
+def row_text(row):
+    return " | ".join(cell_text(cell) for cell in row.iter(CELL)
+                      if cell.getparent() is row or _inside(cell, row))
+
+
+def _inside(element, container):
+    """Whether container is the nearest enclosing paragraph, cell, row or table of element"""
+    return next(element.iterancestors(PARAGRAPH, CELL, ROW, TABLE), None) is container
+
+
+def _is_block(element):
+    """Whether element is a paragraph or table of the document body, or a row of such a table"""
+    parent = element.getparent()
+    if element.tag == ROW:
+        parent = parent.getparent()
+    if parent.tag == BODY:
+        return True
+    if parent.tag == CELL:
+        return False
+    # Content controls and other wrappers: look for an enclosing cell or paragraph
+    enclosing = next(element.iterancestors(PARAGRAPH, CELL), None)
+    return enclosing is None
+
+
+def _release(element):
+    """Drop a handled element and the siblings handled before it"""
+    element.clear()
+    parent = element.getparent()
+    if parent is not None:
+        while element.getprevious() is not None:
+            del parent[0]
+
+
+def iter_docx_blocks(file_path):
+    """Yield the paragraphs and table lines of a .docx file in document order"""
+    with zipfile.ZipFile(file_path) as archive:
+        try:
+            stream = archive.open(DOCUMENT_PART)
+        except KeyError:
+            raise ValueError(f"Not a Word document: {DOCUMENT_PART} is missing")
+        with stream:
+            yield from _iter_blocks(stream)
+
+
+def _iter_blocks(stream):
+    table = None    # top-level table whose rows are being emitted
+    for _, elem in etree.iterparse(stream, events=("end",), tag=(PARAGRAPH, ROW, TABLE, FALLBACK)):
+        if elem.tag == FALLBACK:
+            # Dropped before the enclosing paragraph ends, so its text is not read twice
+            elem.getparent().remove(elem)
+            continue
+        if not _is_block(elem):
+            # Handled with its enclosing row or paragraph
+            continue
+        if elem.tag == PARAGRAPH:
+            yield paragraph_text(elem)
+            _release(elem)
+        elif elem.tag == ROW:
+            row = row_text(elem)
+            owner = next(elem.iterancestors(TABLE))
+            if owner is not table:
+                table = owner
+                yield "TABLE:"
+                yield row
+                yield "-" * len(row)
+            else:
+                yield row
+            _release(elem)
+        else:
+            if table is elem:
+                yield ""
+            table = None
+            _release(elem)
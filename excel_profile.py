@@ -0,0 +1,249 @@
+import numpy as np
+import pandas as pd
+
+# Sheet profiling for the Excel text extraction. profile_sheet() computes
+# every per-column statistic from one numeric matrix per sheet, and the
+# format_* functions render a profile into the SHEET / statistics /
+# POTENTIAL INSIGHTS sections of the extracted text. Profiles are plain dicts
+# so that other producers (e.g. a streaming reader) can feed the same
+# formatters.
+
+PROFIT_KEYWORDS = ['profit', 'laba', 'keuntungan', 'revenue', 'pendapatan', 'income']
+IDENTIFIER_KEYWORDS = ['name', 'nama', 'product', 'produk', 'item', 'description', 'deskripsi', 'id']
+ID_COLUMN_KEYWORDS = ['id', 'code']
+
+TOP_N = 5
+QUANTILES = (0.25, 0.5, 0.75)
+STRONG_CORRELATION = 0.7
+TREND_COLUMNS = 3
+
+
+def to_python(value):
+    """Unwrap numpy scalars so they print like the pandas values they came from"""
+    return value.item() if isinstance(value, np.generic) else value
+
+
+def profit_columns(columns):
+    """Columns whose names mention profit or revenue, in keyword order"""
+    found = []
+    for keyword in PROFIT_KEYWORDS:
+        for col in columns:
+            if keyword in str(col).lower() and col not in found:
+                found.append(col)
+    return found
+
+
+def identifier_columns(columns):
+    return [col for col in columns if any(k in str(col).lower() for k in IDENTIFIER_KEYWORDS)]
+
+
+def id_like_columns(columns):
+    return [col for col in columns if any(k in str(col).lower() for k in ID_COLUMN_KEYWORDS)]
+
+
+def strong_correlations(corr, columns, threshold=STRONG_CORRELATION):
+    """(col1, col2, value) for the upper-triangle pairs of a correlation matrix above the threshold"""
+    corr = np.asarray(corr, dtype=np.float64)
+    with np.errstate(invalid='ignore'):
+        mask = np.triu(np.abs(corr) > threshold, k=1)
+    rows, cols = np.nonzero(mask)
+    return [(columns[i], columns[j], float(corr[i, j])) for i, j in zip(rows, cols)]
+
+
+def describe_rows(df, positions, id_cols):
+    """'col: value, ...' descriptions of the given row positions, built column-wise"""
+    if not id_cols:
+        return [f"Row {to_python(df.index[p]) + 1}" for p in positions]
+    parts = []
+    for col in id_cols:
+        values = df[col].iloc[positions]
+        text = (f"{col}: " + values.astype(str)).where(values.notna(), "")
+        parts.append(text.to_numpy())
+    described = []
+    for row_parts in zip(*parts):
+        described.append(", ".join(part for part in row_parts if part))
+    return described
+
+
+def correlation_matrix(matrix, numeric):
+    # BLAS-backed corrcoef when there are no gaps, pairwise-complete pandas otherwise
+    if not np.isnan(matrix).any():
+        with np.errstate(invalid='ignore', divide='ignore'):
+            return np.corrcoef(matrix, rowvar=False)
+    return numeric.corr().to_numpy()
+
+
+def profile_sheet(df):
+    """Compute the statistics used in the sheet text in one vectorized pass per sheet"""
+    columns = list(df.columns)
+    numeric = df.select_dtypes(include=['number'])
+    numeric_cols = list(numeric.columns)
+    profile = {
+        "rows": len(df),
+        "columns": columns,
+        "numeric_columns": numeric_cols,
+        "numeric_stats": {},
+        "profit": [],
+        "correlations": [],
+        "date_columns": [],
+        "trend": None,
+        "id_columns": [],
+    }
+
+    if numeric_cols and len(df) > 0:
+        # One float64 matrix for all numeric columns, reduced along the row axis
+        matrix = numeric.to_numpy(dtype=np.float64, na_value=np.nan)
+        valid = ~np.isnan(matrix)
+        counts = valid.sum(axis=0)
+        with np.errstate(invalid='ignore'):
+            mins = np.where(valid, matrix, np.inf).min(axis=0)
+            maxs = np.where(valid, matrix, -np.inf).max(axis=0)
+            sums = np.where(valid, matrix, 0.0).sum(axis=0)
+        for i, col in enumerate(numeric_cols):
+            is_int = pd.api.types.is_integer_dtype(numeric[col].dtype)
+            if counts[i] == 0:
+                stats = {"min": np.nan, "max": np.nan, "mean": np.nan, "sum": 0 if is_int else 0.0}
+            elif is_int:
+                # Integer sums are taken exactly instead of through float64
+                stats = {"min": int(mins[i]), "max": int(maxs[i]), "mean": sums[i] / counts[i],
+                         "sum": int(numeric[col].to_numpy(dtype=np.int64).sum())}
+            else:
+                stats = {"min": float(mins[i]), "max": float(maxs[i]), "mean": sums[i] / counts[i],
+                         "sum": float(sums[i])}
+            profile["numeric_stats"][col] = stats
+
+        # Top rows and quartiles for profit/revenue columns
+        id_cols = identifier_columns(columns)
+        position = {col: i for i, col in enumerate(numeric_cols)}
+        for col in profit_columns(columns):
+            if col not in position:
+                continue
+            values = matrix[:, position[col]]
+            present = np.flatnonzero(~np.isnan(values))
+            top_n = min(TOP_N, len(present))
+            if top_n == 0:
+                continue
+            candidates = present[np.argpartition(-values[present], top_n - 1)[:top_n]]
+            # Highest first, ties in row order like DataFrame.nlargest
+            top = candidates[np.lexsort((candidates, -values[candidates]))]
+            descriptions = describe_rows(df, top, id_cols)
+            top_values = df[col].iloc[top].to_numpy()
+            profile["profit"].append({
+                "column": col,
+                "top": [(desc, to_python(value)) for desc, value in zip(descriptions, top_values)],
+                "quartiles": dict(zip(QUANTILES, np.quantile(values[present], QUANTILES).tolist())),
+            })
+
+        if len(numeric_cols) > 1:
+            profile["correlations"] = strong_correlations(correlation_matrix(matrix, numeric), numeric_cols)
+
+    date_cols = list(df.select_dtypes(include=['datetime64']).columns)
+    profile["date_columns"] = date_cols
+    if date_cols and numeric_cols and len(df) > 0:
+        date_col = date_cols[0]
+        dates = df[date_col]
+        if dates.notna().any():
+            dates_values = dates.to_numpy()
+            first = int(dates.argmin())
+            # Last occurrence of the latest date, as a stable sort would order it
+            last = len(dates_values) - 1 - int(np.argmax(dates_values[::-1] == dates_values[dates.argmax()]))
+            changes = []
+            for col in numeric_cols[:TREND_COLUMNS]:
+                changes.append((col, to_python(df[col].iloc[first]), to_python(df[col].iloc[last])))
+            profile["trend"] = {
+                "date_column": date_col,
+                "first_date": dates.iloc[first],
+                "last_date": dates.iloc[last],
+                "changes": changes,
+            }
+
+    profile["id_columns"] = [(col, int(df[col].nunique())) for col in id_like_columns(columns)]
+    return profile
+
+
+def format_sheet_header(sheet_name, profile):
+    """SHEET header, profit/revenue analysis and numerical statistics lines"""
+    lines = [f"SHEET: {sheet_name}",
+             f"Rows: {profile['rows']}",
+             f"Columns: {len(profile['columns'])}",
+             f"Column names: {', '.join(str(col) for col in profile['columns'])}",
+             ""]
+
+    if profile["profit"]:
+        lines.append("PROFIT/REVENUE ANALYSIS:")
+        for entry in profile["profit"]:
+            col = entry["column"]
+            lines.append(f"Top {TOP_N} highest {col}:")
+            for i, (desc, value) in enumerate(entry["top"], 1):
+                lines.append(f"  {i}. {desc} = {value}")
+            lines.append("")
+
+            quartiles = entry["quartiles"]
+            lines.append(f"{col} distribution:")
+            lines.append(f"  25% of values are below: {quartiles[0.25]}")
+            lines.append(f"  Median value: {quartiles[0.5]}")
+            lines.append(f"  75% of values are above: {quartiles[0.75]}")
+            lines.append("")
+
+    if profile["numeric_columns"]:
+        lines.append("NUMERICAL COLUMN STATISTICS:")
+        for col in profile["numeric_columns"]:
+            stats = profile["numeric_stats"].get(col, {"min": np.nan, "max": np.nan, "mean": np.nan, "sum": 0.0})
+            lines.append(f"Column '{col}': Min={stats['min']}, Max={stats['max']}, "
+                         f"Mean={stats['mean']:.2f}, Sum={stats['sum']}")
+        lines.append("")
+    return lines
+
+
+def format_sheet_insights(profile):
+    """POTENTIAL INSIGHTS section: correlations, time series trends and ID columns"""
+    lines = ["POTENTIAL INSIGHTS:"]
+
+    if profile["correlations"]:
+        lines.append("CORRELATIONS:")
+        for col1, col2, value in profile["correlations"]:
+            relation = "positively" if value > 0 else "negatively"
+            lines.append(f"- Strong {relation} correlation ({value:.2f}) between '{col1}' and '{col2}'")
+        lines.append("")
+
+    if profile["date_columns"]:
+        lines.append(f"- Time series data detected in columns: {', '.join(str(col) for col in profile['date_columns'])}")
+        trend = profile["trend"]
+        if trend:
+            lines.append(f"TREND ANALYSIS using date column: {trend['date_column']}")
+            for col, first_val, last_val in trend["changes"]:
+                try:
+                    change = last_val - first_val
+                    pct_change = (change / first_val * 100) if first_val != 0 else float('inf')
+                    direction = "increased" if change > 0 else "decreased" if change < 0 else "remained the same"
+                    lines.append(
+                        f"- '{col}' {direction} by {abs(change):.2f} ({abs(pct_change):.1f}%) from "
+                        f"{trend['first_date']} to {trend['last_date']}"
+                    )
+                except Exception:
+                    pass
+            lines.append("")
+
+    for col, unique_vals in profile["id_columns"]:
+        lines.append(f"- Possible ID column: '{col}' with {unique_vals} unique values")
+
+    lines.append("")
+    return lines
+
+
+def format_data_rows(df, limit=100, total_rows=None):
+    """DATA section: header row, separator and the first `limit` rows pipe-delimited"""
+    total_rows = len(df) if total_rows is None else total_rows
+    if total_rows == 0:
+        return []
+    lines = ["DATA:"]
+    header_row = " | ".join(f"{col}" for col in df.columns)
+    lines.append(header_row)
+    lines.append("-" * len(header_row))
+    head = df.head(limit)
+    cells = [[f"{val}" for val in head[col].tolist()] for col in head.columns]
+    lines.extend(" | ".join(row) for row in zip(*cells))
+    if total_rows > limit:
+        lines.append(f"... (Showing first {limit} of {total_rows} rows)")
+    lines.append("")
+    return lines
@@ -0,0 +1,520 @@
+import os
+import logging
+import re
+import json
+
+import numpy as np
+import pandas as pd
+
+from excel_store import SpilledSheet, load_sheet, sheet_head
+from excel_profile import identifier_columns
+from llm_gateway import LLMError
+from search_index import STOPWORDS
+
+logger = logging.getLogger(__name__)
+
+# Structured queries over the uploaded Excel sheets. A query spec is a small
+# dict (filters, group-by, aggregates, sort and a row limit) that is checked
+# against the sheet columns and executed locally with vectorized pandas
+# operations over every row, so only the compact result table has to be sent
+# to the model. Specs come from simple keyword rules (plan_query) or, when
+# EXCEL_QUERY_PLANNER is "model", from the model itself (plan_query_with_model).
+# A spec may name a list of sheets with the same columns ("Sales 2020" and
+# "Sales 2021"), whose rows are then queried together.
+#
+# Example spec:
+#   {"sheet": "Sales",
+#    "filters": [{"column": "Region", "op": "==", "value": "West"}],
+#    "group_by": ["Product"],
+#    "aggregates": [{"column": "Profit", "func": "sum"}],
+#    "sort": {"column": "sum(Profit)", "descending": true},
+#    "limit": 5}
+
+# "rules" plans queries from keywords, "model" falls back to the model when no rule matches, "off" disables queries
+EXCEL_QUERY_PLANNER = os.getenv("EXCEL_QUERY_PLANNER", "rules")
+
+FILTER_OPS = ('==', '!=', '>', '>=', '<', '<=', 'in', 'contains')
+AGGREGATE_FUNCS = ('sum', 'mean', 'median', 'min', 'max', 'count', 'nunique')
+MAX_RESULT_ROWS = 50
+# Categorical columns with more categories are not scanned for filter values by the rule planner
+FILTER_MAX_CATEGORIES = 1000
+
+# Keywords of the rule planner (English and Indonesian), checked in this order
+FUNC_KEYWORDS = [
+    ('mean', ['average', 'avg', 'mean', 'rata-rata', 'rata rata', 'rerata']),
+    ('count', ['how many', 'number of', 'count', 'berapa banyak', 'berapa jumlah', 'banyaknya']),
+    ('max', ['highest', 'maximum', 'max', 'largest', 'biggest', 'most', 'tertinggi', 'terbesar', 'terbanyak']),
+    ('min', ['lowest', 'minimum', 'min', 'smallest', 'least', 'terendah', 'terkecil', 'paling sedikit']),
+    ('sum', ['total', 'sum', 'jumlah', 'keseluruhan']),
+]
+GROUP_PATTERN = re.compile(r"\b(?:per|by|for each|each|every|setiap|tiap|tiap-tiap|berdasarkan|menurut|masing-masing)\s+(.+)")
+TOP_PATTERN = re.compile(r"\b(?:top|first|best|worst|bottom)\s+(\d+)\b|\b(\d+)\s+(?:teratas|tertinggi|terbesar|terendah|terbaik)\b")
+RANKING_WORDS = ['top', 'best', 'teratas', 'terbaik', 'ranking', 'rank', 'peringkat']
+# Words of the keywords above, which are not names even when capitalised
+PLANNER_WORDS = ({word for _, keywords in FUNC_KEYWORDS for keyword in keywords for word in keyword.split()}
+                 | set(RANKING_WORDS))
+
+# Conditions the rule planner cannot express as filters; questions with one are left to the model
+UNSUPPORTED_CONDITIONS = [
+    'more than', 'less than', 'greater than', 'fewer than', 'at least', 'at most', 'above', 'below', 'over',
+    'under', 'between', 'before', 'after', 'since', 'until', 'last', 'previous', 'this year', 'this month',
+    'today', 'yesterday', 'except', 'excluding', 'other than', 'not', 'without',
+    'lebih dari', 'kurang dari', 'di atas', 'di bawah', 'antara', 'sebelum', 'sesudah', 'setelah', 'sejak',
+    'sampai', 'terakhir', 'lalu', 'tahun ini', 'bulan ini', 'hari ini', 'kemarin', 'kecuali', 'selain',
+    'bukan', 'tanpa',
+]
+# Month names restrict the rows unless they are values of a column ("May" is caught as a capitalised name)
+MONTHS = {'january', 'february', 'march', 'april', 'june', 'july', 'august', 'september', 'october',
+          'november', 'december', 'januari', 'februari', 'maret', 'mei', 'juni', 'juli', 'agustus', 'oktober',
+          'desember', 'jan', 'feb', 'mar', 'apr', 'jun', 'jul', 'aug', 'agu', 'sep', 'sept', 'oct', 'okt',
+          'nov', 'dec', 'des'}
+
+
+class QueryError(ValueError):
+    """A query spec that does not fit the uploaded sheets"""
+
+
+def _is_text(series):
+    return not (pd.api.types.is_numeric_dtype(series.dtype) or pd.api.types.is_datetime64_any_dtype(series.dtype))
+
+
+def _is_numeric(series):
+    return pd.api.types.is_numeric_dtype(series.dtype) and not pd.api.types.is_bool_dtype(series.dtype)
+
+
+def _column_sample(sheet):
+    return sheet.sample if isinstance(sheet, SpilledSheet) else sheet
+
+
+def validate_spec(spec, sheets):
+    """Check a spec against the sheets and return it normalized; raises QueryError"""
+    if not isinstance(spec, dict):
+        raise QueryError("query spec must be an object")
+    if not sheets:
+        raise QueryError("no Excel data is loaded")
+    sheet = spec.get("sheet")
+    if sheet is None:
+        sheet = next(iter(sheets))
+    names = sheet if isinstance(sheet, list) else [sheet]
+    if not names:
+        raise QueryError("sheet list is empty")
+    for name in names:
+        if not isinstance(name, str) or name not in sheets:
+            raise QueryError(f"unknown sheet: {name}")
+    columns = list(sheets[names[0]].columns)
+    if any(list(sheets[name].columns) != columns for name in names[1:]):
+        raise QueryError("sheets queried together must have the same columns")
+    sheet = names if len(names) > 1 else names[0]
+    known = {str(col): col for col in columns}
+
+    def column(name):
+        if name in columns:
+            return name
+        if str(name) in known:
+            return known[str(name)]
+        raise QueryError(f"unknown column in sheet {sheet}: {name}")
+
+    filters = []
+    for f in spec.get("filters") or []:
+        op = f.get("op", "==")
+        if op not in FILTER_OPS:
+            raise QueryError(f"unsupported filter operator: {op}")
+        value = f.get("value")
+        if op == 'in' and not isinstance(value, list):
+            raise QueryError("'in' filters need a list value")
+        filters.append({"column": column(f.get("column")), "op": op, "value": value})
+
+    group_by = [column(col) for col in spec.get("group_by") or []]
+
+    aggregates = []
+    for agg in spec.get("aggregates") or []:
+        func = agg.get("func")
+        if func not in AGGREGATE_FUNCS:
+            raise QueryError(f"unsupported aggregate: {func}")
+        col = agg.get("column", "*")
+        if col == "*" and func != "count":
+            raise QueryError(f"'{func}' needs a column")
+        aggregates.append({"column": col if col == "*" else column(col), "func": func})
+
+    select = [column(col) for col in spec.get("select") or []]
+
+    sort = spec.get("sort")
+    if sort:
+        outputs = {aggregate_name(agg) for agg in aggregates}
+        name = sort.get("column")
+        if name not in outputs:
+            name = column(name)
+        sort = {"column": name, "descending": bool(sort.get("descending", True))}
+
+    try:
+        limit = int(spec.get("limit") or MAX_RESULT_ROWS)
+    except (TypeError, ValueError):
+        raise QueryError("limit must be a number")
+    limit = max(1, min(limit, MAX_RESULT_ROWS))
+
+    return {"sheet": sheet, "filters": filters, "group_by": group_by, "aggregates": aggregates,
+            "select": select, "sort": sort, "limit": limit}
+
+
+def aggregate_name(agg):
+    return "count" if agg["column"] == "*" else f"{agg['func']}({agg['column']})"
+
+
+def _filter_mask(series, op, value):
+    if op == 'contains':
+        return series.astype(str).str.contains(str(value), case=False, regex=False).to_numpy()
+    if op == 'in':
+        values = list(value)
+        if _is_text(series):
+            lowered = {str(v).lower() for v in values}
+            return _text_mask(series, lambda text: text.isin(lowered))
+        return series.isin(values).to_numpy()
+    if pd.api.types.is_datetime64_any_dtype(series.dtype):
+        value = pd.Timestamp(value)
+    elif _is_numeric(series) and isinstance(value, str):
+        try:
+            value = float(value)
+        except ValueError:
+            raise QueryError(f"cannot compare numeric column {series.name} with '{value}'")
+    if _is_text(series) and op in ('==', '!='):
+        # Text equality ignores case, since rule-planned values come from the question
+        mask = _text_mask(series, lambda text: text == str(value).lower())
+        return mask if op == '==' else ~mask
+    if _is_text(series):
+        series = series.astype(str)
+        value = str(value)
+    compare = {'==': np.equal, '!=': np.not_equal, '>': np.greater, '>=': np.greater_equal,
+               '<': np.less, '<=': np.less_equal}[op]
+    with np.errstate(invalid='ignore'):
+        return np.asarray(compare(series, value), dtype=bool)
+
+
+def _text_mask(series, predicate):
+    """Apply a predicate to lowercased text; categoricals only evaluate their categories"""
+    if isinstance(series.dtype, pd.CategoricalDtype):
+        matches = np.asarray(predicate(pd.Series(series.cat.categories.astype(str).str.lower())), dtype=bool)
+        codes = series.cat.codes.to_numpy()
+        return np.where(codes >= 0, matches[codes], False)
+    return np.asarray(predicate(series.astype(str).str.lower()), dtype=bool) & series.notna().to_numpy()
+
+
+def spec_sheets(spec):
+    """Names of the sheets a normalized spec runs over"""
+    return spec["sheet"] if isinstance(spec["sheet"], list) else [spec["sheet"]]
+
+
+def execute_query(spec, sheets):
+    """Run a spec over all rows of its sheet (or sheets).
+
+    Returns a dict with the normalized spec, the result table, the number of
+    rows scanned and matched, and whether the table was cut at the limit.
+    """
+    spec = validate_spec(spec, sheets)
+    names = spec_sheets(spec)
+    sheet = sheets[names[0]]
+
+    needed = []
+    for col in ([f["column"] for f in spec["filters"]] + spec["group_by"] + spec["select"]
+                + [agg["column"] for agg in spec["aggregates"]]
+                + ([spec["sort"]["column"]] if spec["sort"] else [])):
+        if col != "*" and col in sheet.columns and col not in needed:
+            needed.append(col)
+    if not needed:
+        needed = list(sheet.columns)
+    # Spilled sheets only read the columns the query touches
+    frames = [load_sheet(sheets[name], needed) for name in names]
+    df = frames[0] if len(frames) == 1 else pd.concat(frames, ignore_index=True)
+    rows = len(df)
+
+    if spec["filters"]:
+        mask = np.ones(rows, dtype=bool)
+        for f in spec["filters"]:
+            mask &= _filter_mask(df[f["column"]], f["op"], f["value"])
+        df = df[mask]
+    matched = len(df)
+
+    if spec["aggregates"]:
+        named = {}
+        for agg in spec["aggregates"]:
+            col = agg["column"]
+            if agg["func"] in ('sum', 'mean', 'median') and not _is_numeric(df[col]):
+                raise QueryError(f"cannot {agg['func']} non-numeric column {col}")
+            if col == "*":
+                col = spec["group_by"][0] if spec["group_by"] else df.columns[0]
+                named[aggregate_name(agg)] = pd.NamedAgg(column=col, aggfunc='size')
+            else:
+                named[aggregate_name(agg)] = pd.NamedAgg(column=col, aggfunc=agg["func"])
+        if spec["group_by"]:
+            table = df.groupby(spec["group_by"], observed=True, sort=False, dropna=False).agg(**named).reset_index()
+        else:
+            table = pd.DataFrame({name: [_aggregate(df, named_agg)] for name, named_agg in named.items()})
+    else:
+        table = df[spec["select"] or needed]
+
+    sort = spec["sort"]
+    if sort is None and spec["aggregates"] and spec["group_by"]:
+        sort = {"column": aggregate_name(spec["aggregates"][0]), "descending": True}
+    if sort is not None:
+        table = table.sort_values(sort["column"], ascending=not sort["descending"], kind='stable')
+
+    truncated = len(table) > spec["limit"]
+    return {"spec": spec, "table": table.head(spec["limit"]), "rows": rows, "matched": matched,
+            "truncated": truncated, "groups": len(table)}
+
+
+def _aggregate(df, named_agg):
+    if named_agg.aggfunc == 'size':
+        return len(df)
+    return getattr(df[named_agg.column], named_agg.aggfunc)()
+
+
+def _describe_sheets(spec):
+    names = spec_sheets(spec)
+    if len(names) == 1:
+        return f"sheet '{names[0]}'"
+    return "sheets " + ", ".join(f"'{name}'" for name in names) + " combined"
+
+
+def _describe_filters(spec):
+    return " and ".join(f"{f['column']} {f['op']} {f['value']!r}" for f in spec["filters"])
+
+
+def describe_scope(spec):
+    """The sheets and rows a normalized spec was computed over, for the prompt"""
+    if spec["filters"]:
+        return f"the rows of {_describe_sheets(spec)} where {_describe_filters(spec)}"
+    return f"all rows of {_describe_sheets(spec)}, without filters"
+
+
+def describe_spec(spec):
+    """One-line human readable description of a normalized spec"""
+    parts = [_describe_sheets(spec)]
+    if spec["filters"]:
+        parts.append("where " + _describe_filters(spec))
+    if spec["group_by"]:
+        parts.append("grouped by " + ", ".join(str(col) for col in spec["group_by"]))
+    if spec["aggregates"]:
+        parts.append("computing " + ", ".join(aggregate_name(agg) for agg in spec["aggregates"]))
+    if spec["sort"]:
+        order = "descending" if spec["sort"]["descending"] else "ascending"
+        parts.append(f"sorted by {spec['sort']['column']} {order}")
+    parts.append(f"limit {spec['limit']}")
+    return ", ".join(parts)
+
+
+def format_result(result):
+    """Result table as pipe-delimited text with a line about rows scanned and matched"""
+    table = result["table"]
+    lines = [f"Rows scanned: {result['rows']}, rows matched: {result['matched']}"]
+    header = " | ".join(f"{col}" for col in table.columns)
+    lines.append(header)
+    lines.append("-" * len(header))
+    cells = []
+    for col in table.columns:
+        values = table[col].tolist()
+        if _is_numeric(table[col]) and not pd.api.types.is_integer_dtype(table[col].dtype):
+            cells.append([f"{val:.4f}".rstrip('0').rstrip('.') if pd.notna(val) else "" for val in values])
+        else:
+            cells.append([f"{val}" for val in values])
+    lines.extend(" | ".join(row) for row in zip(*cells))
+    if result["truncated"]:
+        lines.append(f"... (showing {len(table)} of {result['groups']} result rows)")
+    return "\n".join(lines)
+
+
+def _mentions(question, name):
+    """Whether a column, sheet or value name appears (possibly pluralized) in the lowercased question"""
+    name = str(name).lower().strip()
+    if not name:
+        return False
+    return re.search(r"(?<!\w)" + re.escape(name) + r"(?:s|es)?(?!\w)", question) is not None
+
+
+def _mentioned_columns(question, columns):
+    # Longer names first so 'Product Name' wins over 'Product'
+    found = []
+    for col in sorted(columns, key=lambda c: -len(str(c))):
+        if _mentions(question, col) and not any(_mentions(str(other).lower(), col) for other in found):
+            found.append(col)
+    return found
+
+
+def _name_words(name):
+    return set(re.findall(r"\w+", str(name).lower()))
+
+
+def _named_sheets(question, sheets):
+    """Sheets the question names, in full or by the words that set their names apart ("2021")"""
+    named = [name for name in sheets if _mentions(question, name)]
+    if named or len(sheets) == 1:
+        return named
+    common = set.intersection(*(_name_words(name) for name in sheets))
+    scores = {name: sum(_mentions(question, word) for word in _name_words(name) - common) for name in sheets}
+    best = max(scores.values())
+    return [name for name in sheets if scores[name] == best] if best else []
+
+
+def _unmapped_terms(question, names):
+    """Numbers, month names and capitalised names in the question that are not part of any of names"""
+    names = [str(name).lower() for name in names]
+    unmapped = []
+    for sentence in re.split(r"[.!?]", question):
+        for i, word in enumerate(re.findall(r"\w+", sentence)):
+            lower = word.lower()
+            # The first word of a sentence is capitalised whatever it is
+            capitalised = i > 0 and word[0].isupper() and lower not in STOPWORDS and lower not in PLANNER_WORDS
+            if not (any(c.isdigit() for c in word) or lower in MONTHS or capitalised):
+                continue
+            if not any(_mentions(name, lower) or _mentions(lower, name) for name in names):
+                unmapped.append(word)
+    return unmapped
+
+
+def plan_query(question, sheets):
+    """Build a query spec from keywords in the question, or None when no rule applies.
+
+    Every condition, number and name in the question has to map to the
+    sheets, a filter, the grouping or the limit of the spec; otherwise the
+    question is left to the model instead of being answered over the wrong rows.
+    """
+    if not sheets:
+        return None
+    q = question.lower()
+    if any(_mentions(q, condition) for condition in UNSUPPORTED_CONDITIONS):
+        return None
+
+    named = _named_sheets(q, sheets)
+    candidates = named or list(sheets)
+    mentioned_counts = {name: len(_mentioned_columns(q, sheets[name].columns)) for name in candidates}
+    best = max(mentioned_counts.values())
+    sheet_names = [name for name in candidates if mentioned_counts[name] == best]
+    columns = list(sheets[sheet_names[0]].columns)
+    # Sheets with the same columns ("Sales 2020", "Sales 2021") are queried together; others are ambiguous
+    if any(list(sheets[name].columns) != columns for name in sheet_names[1:]):
+        return None
+    samples = [_column_sample(sheets[name]) for name in sheet_names]
+    sample = samples[0]
+    mentioned = _mentioned_columns(q, columns)
+    numeric = [col for col in mentioned if _is_numeric(sample[col])]
+    text = [col for col in mentioned if _is_text(sample[col])]
+
+    func = None
+    for name, keywords in FUNC_KEYWORDS:
+        if any(_mentions(q, keyword) for keyword in keywords):
+            func = name
+            break
+
+    group_by = []
+    group_match = GROUP_PATTERN.search(q)
+    if group_match:
+        tail = group_match.group(1)
+        for col in sorted(text, key=lambda c: tail.find(str(c).lower()) if str(c).lower() in tail else len(tail)):
+            if str(col).lower() in tail:
+                group_by = [col]
+                break
+        # "by profit" names the sort key; any other grouping that matched no column cannot be computed
+        if not group_by and not any(str(col).lower() in tail for col in numeric):
+            return None
+
+    top_match = TOP_PATTERN.search(q)
+    top_n = int(top_match.group(1) or top_match.group(2)) if top_match else None
+    ranking = top_n is not None or any(_mentions(q, word) for word in RANKING_WORDS)
+
+    # Values of categorical columns named in the question become filters ("... in the West region")
+    filters = []
+    for col in columns:
+        if col in group_by or not all(isinstance(s[col].dtype, pd.CategoricalDtype) for s in samples):
+            continue
+        categories = list(dict.fromkeys(value for s in samples for value in s[col].cat.categories))
+        if len(categories) > FILTER_MAX_CATEGORIES:
+            continue
+        values = [value for value in categories if _mentions(q, value) and str(value).lower() != str(col).lower()]
+        if values:
+            filters.append({"column": col, "op": "in" if len(values) > 1 else "==",
+                            "value": values if len(values) > 1 else values[0]})
+    # A text column named in a ranking question ("top 5 products by profit") is what gets ranked
+    ranked = False
+    if not group_by and numeric and (ranking or func in ('max', 'min')):
+        filtered = {f["column"] for f in filters}
+        group_by = [col for col in text if col not in filtered][:1]
+        ranked = bool(group_by)
+
+    sheet = sheet_names if len(sheet_names) > 1 else sheet_names[0]
+    if numeric and not group_by and func != 'count' and (top_n or (ranking and not func)):
+        # Row listing: the highest (or lowest) rows of the numeric column with their identifiers
+        select = [col for col in identifier_columns(columns) if col not in numeric] + numeric
+        spec = {"sheet": sheet, "filters": filters, "select": select,
+                "sort": {"column": numeric[0], "descending": func != 'min'}, "limit": top_n or 5}
+    else:
+        if func == 'count':
+            aggregates = [{"column": "*", "func": "count"}]
+        elif numeric and (func or group_by):
+            # "Which region has the highest profit" compares the regions' totals, not their largest rows
+            agg_func = 'sum' if ranked and func in ('max', 'min') else func or 'sum'
+            aggregates = [{"column": col, "func": agg_func} for col in numeric]
+        else:
+            return None
+        spec = {"sheet": sheet, "filters": filters, "group_by": group_by, "aggregates": aggregates}
+        if group_by:
+            spec["sort"] = {"column": aggregate_name(aggregates[0]), "descending": func != 'min'}
+            spec["limit"] = top_n or MAX_RESULT_ROWS
+
+    # Every column the question names has to be used, and every number or name has to be accounted for
+    used = ({f["column"] for f in filters} | set(spec.get("group_by", [])) | set(spec.get("select", []))
+            | {agg["column"] for agg in spec.get("aggregates", [])})
+    if any(col not in used for col in mentioned):
+        return None
+    values = [value for f in filters for value in (f["value"] if isinstance(f["value"], list) else [f["value"]])]
+    if _unmapped_terms(question, named + list(used - {"*"}) + values + ([top_n] if top_n else [])):
+        return None
+    return spec
+
+
+def _schema(sheets):
+    lines = []
+    for name, sheet in sheets.items():
+        sample = _column_sample(sheet)
+        columns = ", ".join(f"{col} ({sample[col].dtype})" for col in sample.columns)
+        lines.append(f"Sheet '{name}' ({len(sheet)} rows): {columns}")
+    return "\n".join(lines)
+
+
+def plan_query_with_model(question, sheets, gateway, model):
+    """Ask the model to translate the question into a spec; None when it declines or the spec is invalid"""
+    prompt = f"""
+    Translate the question into a JSON query over the Excel sheets below, or answer {{"query": null}}
+    if the question cannot be answered by filtering, grouping and aggregating the rows.
+
+    JSON format: {{"query": {{"sheet": str or [str], "filters": [{{"column": str, "op": one of {list(FILTER_OPS)}, "value": any}}],
+    "group_by": [str], "aggregates": [{{"column": str or "*", "func": one of {list(AGGREGATE_FUNCS)}}}],
+    "select": [str], "sort": {{"column": str, "descending": bool}}, "limit": int}}}}
+    Aggregate results are named like "sum(Profit)"; use that name to sort by an aggregate.
+    A list of sheets with the same columns queries their rows together.
+
+    SHEETS:
+    {_schema(sheets)}
+
+    QUESTION:
+    {question}
+    """
+    try:
+        content = gateway.complete([{"role": "user", "content": prompt}], model,
+                                   response_format={"type": "json_object"})
+        spec = json.loads(content).get("query")
+        if not spec:
+            return None
+        return validate_spec(spec, sheets)
+    except (LLMError, QueryError, ValueError, AttributeError) as e:
+        logger.warning("Model query plan rejected: %s", e)
+        return None
+
+
+def sheet_schema_preview(sheets, rows=3):
+    """Compact description of the sheets (columns, types, row counts and a few rows)"""
+    lines = [_schema(sheets)]
+    for name, sheet in sheets.items():
+        head = sheet_head(sheet, rows)
+        if len(head):
+            lines.append(f"First rows of '{name}':")
+            lines.append(head.to_string(index=False))
+    return "\n".join(lines)
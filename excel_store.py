@@ -0,0 +1,180 @@
+import os
+import json
+import pickle
+import shutil
+import numpy as np
+import pandas as pd
+
+# Excel sheets are kept as compact column-oriented DataFrames instead of a
+# list of dicts per row: repeated strings become categoricals, integers are
+# downcast and, when pyarrow is installed, other text columns use Arrow
+# strings. The JSON sent to the model is produced on demand from these
+# frames, and only for as many rows as fit in the payload budget.
+
+try:
+    import pyarrow  # noqa: F401
+    TEXT_DTYPE = "string[pyarrow]"
+except ImportError:
+    TEXT_DTYPE = None
+
+# Object columns whose distinct values are at most this fraction of the rows
+# are dictionary encoded as categoricals
+CATEGORY_MAX_RATIO = 0.5
+
+# Rows serialized to estimate the JSON size of a whole sheet
+SIZE_SAMPLE_ROWS = 50
+SAMPLE_RECORDS = 5
+
+
+def to_columnar(df):
+    """Return a memory-compact copy of a sheet DataFrame"""
+    columns = {}
+    for col in df.columns:
+        series = df[col]
+        if pd.api.types.is_integer_dtype(series.dtype):
+            series = pd.to_numeric(series, downcast='integer')
+        elif series.dtype == object and len(series) > 0:
+            non_null = series.dropna()
+            # Mixed-type columns stay as they are, so values round-trip unchanged
+            if len(non_null) and non_null.map(type).eq(str).all():
+                if series.nunique() <= CATEGORY_MAX_RATIO * len(series):
+                    series = series.astype('category')
+                elif TEXT_DTYPE:
+                    series = series.astype(TEXT_DTYPE)
+        columns[col] = series
+    return pd.DataFrame(columns, index=df.index)
+
+
+class SpilledSheet:
+    """A sheet whose full columns live in an on-disk spill file.
+
+    Written by the streaming Excel reader: only the first rows are held in
+    memory, and load() reads back the blocks of the requested columns using
+    the per-column offset index kept here.
+    """
+
+    def __init__(self, path, columns, rows, sample, blocks):
+        self.path = path
+        self.columns = columns
+        self.rows = rows
+        self.sample = sample
+        # column -> list of (offset, length) of its pickled blocks in the spill file
+        self.blocks = blocks
+
+    def __len__(self):
+        return self.rows
+
+    def load(self, columns=None):
+        """Read the full sheet (or only some columns) back into a DataFrame"""
+        columns = self.columns if columns is None else list(columns)
+        data = {}
+        with open(self.path, 'rb') as f:
+            for col in columns:
+                parts = []
+                for offset, length in self.blocks[col]:
+                    f.seek(offset)
+                    parts.append(pickle.loads(f.read(length)))
+                values = np.concatenate(parts) if parts else np.array([], dtype=object)
+                series = pd.Series(values, name=col)
+                if series.dtype == object:
+                    series = series.infer_objects()
+                data[col] = series
+        return to_columnar(pd.DataFrame(data, columns=columns))
+
+    def remove(self):
+        try:
+            os.remove(self.path)
+        except FileNotFoundError:
+            pass
+
+
+def link_spilled_sheets(sheets, directory):
+    """Copy of sheets whose spill files are hard links in directory.
+
+    A store reading its sheets through its own links is unaffected when the
+    parse cache deletes the files it links to; the data is freed with the last link.
+    """
+    linked = {}
+    for name, sheet in sheets.items():
+        if isinstance(sheet, SpilledSheet):
+            os.makedirs(directory, exist_ok=True)
+            path = os.path.join(directory, os.path.basename(sheet.path))
+            if os.path.abspath(path) != os.path.abspath(sheet.path):
+                temp_path = f"{path}.{os.getpid()}.tmp"
+                try:
+                    os.link(sheet.path, temp_path)
+                except OSError:
+                    # File systems without hard links get a copy
+                    shutil.copyfile(sheet.path, temp_path)
+                os.replace(temp_path, path)
+            sheet = SpilledSheet(path, sheet.columns, sheet.rows, sheet.sample, sheet.blocks)
+        linked[name] = sheet
+    return linked
+
+
+def sheet_head(sheet, limit):
+    """First rows of a sheet without loading a spilled sheet from disk"""
+    if isinstance(sheet, SpilledSheet):
+        if limit <= len(sheet.sample):
+            return sheet.sample.head(limit)
+        return sheet.load().head(limit)
+    return sheet.head(limit)
+
+
+def load_sheet(sheet, columns=None):
+    """Full sheet as a DataFrame, reading spilled columns back from disk"""
+    if isinstance(sheet, SpilledSheet):
+        return sheet.load(columns)
+    return sheet if columns is None else sheet[list(columns)]
+
+
+def sheet_records(df, limit=None):
+    """Rows of a sheet as JSON-ready dicts, optionally only the first `limit`"""
+    if limit is not None:
+        df = sheet_head(df, limit)
+    elif isinstance(df, SpilledSheet):
+        df = df.load()
+    return df.astype(object).where(df.notna(), None).to_dict(orient='records')
+
+
+def estimate_json_size(sheets):
+    """Estimate the indented JSON size of all records from a sample of each sheet"""
+    total = 0
+    for df in sheets.values():
+        if len(df) == 0:
+            continue
+        sample = sheet_records(df, SIZE_SAMPLE_ROWS)
+        sample_size = len(json.dumps(sample, indent=2, default=str))
+        total += sample_size * len(df) / len(sample)
+    return total
+
+
+def excel_payload(sheets, max_chars=12000):
+    """JSON text describing the sheets for the model.
+
+    All records when they fit in max_chars, otherwise the first few records,
+    the row count and the column names of each sheet.
+    """
+    if estimate_json_size(sheets) <= max_chars:
+        full = {name: sheet_records(df) for name, df in sheets.items()}
+        payload = json.dumps(full, indent=2, default=str)
+        if len(payload) <= max_chars:
+            return payload
+
+    summary = {}
+    for name, df in sheets.items():
+        summary[name] = {
+            "sample_records": sheet_records(df, SAMPLE_RECORDS),
+            "total_records": len(df),
+            "columns": [str(col) for col in df.columns]
+        }
+    return json.dumps(summary, indent=2, default=str)
+
+
+def sheets_memory_usage(sheets):
+    """Resident bytes of the sheets; spilled sheets only count their in-memory sample"""
+    total = 0
+    for sheet in sheets.values():
+        frame = sheet.sample if isinstance(sheet, SpilledSheet) else sheet
+        total += int(frame.memory_usage(deep=True).sum())
+    return total
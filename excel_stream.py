@@ -0,0 +1,345 @@
+import os
+import logging
+import pickle
+
+import numpy as np
+import pandas as pd
+import openpyxl
+
+from excel_store import SpilledSheet, to_columnar
+from excel_profile import (TOP_N, QUANTILES, TREND_COLUMNS, to_python, profit_columns, identifier_columns,
+                           id_like_columns, strong_correlations, describe_rows, correlation_matrix,
+                           format_sheet_header, format_sheet_insights, format_data_rows)
+from parse_cache import file_sha256
+
+logger = logging.getLogger(__name__)
+
+# Bounded-memory reader for large .xlsx workbooks. Rows are read with
+# openpyxl in read-only mode, a batch at a time, and folded into running
+# statistics: exact count/min/max/sum per column, the top rows of profit
+# columns, the first/last rows by date and a capped distinct set for ID
+# columns. Quartiles and correlations come from a fixed-size reservoir sample
+# of the rows. Only the first DATA_ROWS rows stay in memory; every column is
+# appended to an on-disk spill file that SpilledSheet can read back later.
+#
+# Peak memory is roughly EXCEL_BATCH_ROWS x columns cells for the batch being
+# processed plus EXCEL_SAMPLE_ROWS x columns floats for the reservoir.
+
+# "auto" streams .xlsx files of at least EXCEL_STREAMING_MIN_MB, "always" streams every .xlsx, "never" disables it
+EXCEL_STREAMING = os.getenv("EXCEL_STREAMING", "auto")
+EXCEL_STREAMING_MIN_BYTES = int(float(os.getenv("EXCEL_STREAMING_MIN_MB", "20")) * 1024 * 1024)
+EXCEL_BATCH_ROWS = int(os.getenv("EXCEL_BATCH_ROWS", "5000"))
+EXCEL_SAMPLE_ROWS = int(os.getenv("EXCEL_SAMPLE_ROWS", "10000"))
+EXCEL_DISTINCT_LIMIT = int(os.getenv("EXCEL_DISTINCT_LIMIT", "100000"))
+EXCEL_SPILL_DIR = os.getenv("EXCEL_SPILL_DIR", os.path.join("cache", "spill"))
+
+# Rows kept in memory for the DATA section and the payload samples
+DATA_ROWS = 100
+
+
+def use_streaming(file_path):
+    """Whether an Excel file should go through the streaming reader"""
+    if EXCEL_STREAMING == "never" or not file_path.lower().endswith('.xlsx'):
+        return False
+    return EXCEL_STREAMING == "always" or os.path.getsize(file_path) >= EXCEL_STREAMING_MIN_BYTES
+
+
+def _header_names(header):
+    """Column names as pandas would give them: unnamed and duplicate headers are renamed"""
+    header = list(header)
+    while header and header[-1] is None:
+        header.pop()
+    names = []
+    seen = {}
+    for i, value in enumerate(header):
+        name = f"Unnamed: {i}" if value is None else value
+        if name in seen:
+            seen[name] += 1
+            name = f"{name}.{seen[name]}"
+        else:
+            seen[name] = 0
+        names.append(name)
+    return names
+
+
+def _column_kind(series):
+    if series.isna().all():
+        return None
+    if pd.api.types.is_bool_dtype(series.dtype):
+        return "other"
+    if pd.api.types.is_numeric_dtype(series.dtype):
+        return "numeric"
+    if pd.api.types.is_datetime64_any_dtype(series.dtype):
+        return "date"
+    return "other"
+
+
+class SheetAccumulator:
+    """Running profile of one sheet, fed a DataFrame batch at a time"""
+
+    def __init__(self, columns, spill_file, sample_rows=EXCEL_SAMPLE_ROWS, distinct_limit=EXCEL_DISTINCT_LIMIT):
+        self.columns = columns
+        self.position = {col: i for i, col in enumerate(columns)}
+        self.spill_file = spill_file
+        self.blocks = {col: [] for col in columns}
+        self.rows = 0
+        self.head = None
+
+        # Kind of values seen per column: None until a value appears, then numeric/date/other
+        self.kinds = {col: None for col in columns}
+        self.is_int = {col: True for col in columns}
+        self.counts = {col: 0 for col in columns}
+        self.mins = {}
+        self.maxs = {}
+        self.sums = {col: 0.0 for col in columns}
+        self.int_sums = {col: 0 for col in columns}
+
+        self.profit_cols = profit_columns(columns)
+        self.id_cols = identifier_columns(columns)
+        self.top = {col: [] for col in self.profit_cols}
+
+        # date column -> ((first date, row values), (last date, row values))
+        self.date_rows = {}
+
+        self.distinct_limit = distinct_limit
+        self.distinct = {col: set() for col in id_like_columns(columns)}
+        self.distinct_overflow = set()
+
+        self.rng = np.random.default_rng(0)
+        self.sample_rows = sample_rows
+        self.reservoir = np.full((sample_rows, len(columns)), np.nan)
+
+    def add(self, batch):
+        start = self.rows
+        batch.index = pd.RangeIndex(start, start + len(batch))
+        if self.head is None or len(self.head) < DATA_ROWS:
+            head = batch.head(DATA_ROWS - (0 if self.head is None else len(self.head)))
+            self.head = head if self.head is None else pd.concat([self.head, head])
+
+        for col in self.columns:
+            values = batch[col].to_numpy()
+            offset = self.spill_file.tell()
+            pickle.dump(values, self.spill_file, protocol=pickle.HIGHEST_PROTOCOL)
+            self.blocks[col].append((offset, self.spill_file.tell() - offset))
+
+        matrix = np.full((len(batch), len(self.columns)), np.nan)
+        for col in self.columns:
+            series = batch[col]
+            kind = _column_kind(series)
+            if series.isna().any():
+                self.is_int[col] = False
+            if kind is None:
+                continue
+            if self.kinds[col] is None:
+                self.kinds[col] = kind
+            elif self.kinds[col] != kind:
+                self.kinds[col] = "other"
+            if self.kinds[col] == "numeric":
+                self._add_numeric(col, series, matrix)
+            elif self.kinds[col] == "date":
+                self._add_dates(col, series, batch)
+            if col in self.distinct and col not in self.distinct_overflow:
+                self.distinct[col].update(series.dropna().unique().tolist())
+                if len(self.distinct[col]) > self.distinct_limit:
+                    self.distinct_overflow.add(col)
+                    self.distinct[col] = set()
+
+        for col in self.profit_cols:
+            if self.kinds[col] == "numeric":
+                self._add_top(col, matrix[:, self.position[col]], batch)
+
+        self._sample(matrix)
+        self.rows += len(batch)
+
+    def _add_numeric(self, col, series, matrix):
+        if not pd.api.types.is_integer_dtype(series.dtype):
+            self.is_int[col] = False
+        values = series.to_numpy(dtype=np.float64, na_value=np.nan)
+        matrix[:, self.position[col]] = values
+        present = values[~np.isnan(values)]
+        if len(present) == 0:
+            return
+        self.counts[col] += len(present)
+        low, high = present.min(), present.max()
+        self.mins[col] = low if col not in self.mins else min(self.mins[col], low)
+        self.maxs[col] = high if col not in self.maxs else max(self.maxs[col], high)
+        self.sums[col] += float(present.sum())
+        if self.is_int[col]:
+            # Integer sums are taken exactly instead of through float64
+            self.int_sums[col] += int(series.to_numpy(dtype=np.int64).sum())
+
+    def _add_dates(self, col, series, batch):
+        first_pos, last_pos = int(series.argmin()), int(series.argmax())
+        first_date, last_date = series.iloc[first_pos], series.iloc[last_pos]
+        # Last occurrence of the latest date, as a stable sort would order it
+        last_pos = len(series) - 1 - int(np.argmax(series.to_numpy()[::-1] == series.to_numpy()[last_pos]))
+        first, last = self.date_rows.get(col, (None, None))
+        if first is None or first_date < first[0]:
+            first = (first_date, batch.iloc[first_pos].to_dict())
+        if last is None or last_date >= last[0]:
+            last = (last_date, batch.iloc[last_pos].to_dict())
+        self.date_rows[col] = (first, last)
+
+    def _add_top(self, col, values, batch):
+        present = np.flatnonzero(~np.isnan(values))
+        top_n = min(TOP_N, len(present))
+        if top_n == 0:
+            return
+        candidates = present[np.argpartition(-values[present], top_n - 1)[:top_n]]
+        descriptions = describe_rows(batch, candidates, self.id_cols)
+        raw = batch[col].iloc[candidates].to_numpy()
+        for pos, desc, value in zip(candidates, descriptions, raw):
+            self.top[col].append((-values[pos], self.rows + int(pos), desc, to_python(value)))
+        # Highest first, ties in row order like DataFrame.nlargest
+        self.top[col] = sorted(self.top[col])[:TOP_N]
+
+    def _sample(self, matrix):
+        """Reservoir sampling (algorithm R) of the batch rows, vectorized per batch"""
+        fill = max(0, min(self.sample_rows - self.rows, len(matrix)))
+        if fill:
+            self.reservoir[self.rows:self.rows + fill] = matrix[:fill]
+        rest = np.arange(fill, len(matrix))
+        if len(rest):
+            slots = self.rng.integers(0, self.rows + rest + 1)
+            keep = slots < self.sample_rows
+            self.reservoir[slots[keep]] = matrix[rest[keep]]
+
+    def profile(self):
+        """Profile dict in the shape produced by excel_profile.profile_sheet"""
+        # Columns that never held a value are all-NaN floats, which pandas counts as numeric
+        numeric_cols = [col for col in self.columns if self.kinds[col] in ("numeric", None)]
+        profile = {
+            "rows": self.rows,
+            "columns": list(self.columns),
+            "numeric_columns": numeric_cols,
+            "numeric_stats": {},
+            "profit": [],
+            "correlations": [],
+            "date_columns": [],
+            "trend": None,
+            "id_columns": [],
+        }
+        if self.rows == 0:
+            return profile
+
+        for col in numeric_cols:
+            is_int = self.is_int[col] and self.kinds[col] == "numeric"
+            count = self.counts[col]
+            if count == 0:
+                stats = {"min": np.nan, "max": np.nan, "mean": np.nan, "sum": 0.0}
+            elif is_int:
+                stats = {"min": int(self.mins[col]), "max": int(self.maxs[col]),
+                         "mean": self.sums[col] / count, "sum": self.int_sums[col]}
+            else:
+                stats = {"min": float(self.mins[col]), "max": float(self.maxs[col]),
+                         "mean": self.sums[col] / count, "sum": self.sums[col]}
+            profile["numeric_stats"][col] = stats
+
+        sample = self.reservoir[:min(self.rows, self.sample_rows), [self.position[col] for col in numeric_cols]]
+        for col in self.profit_cols:
+            if col not in numeric_cols or not self.top[col]:
+                continue
+            values = sample[:, numeric_cols.index(col)]
+            values = values[~np.isnan(values)]
+            if len(values) == 0:
+                continue
+            as_float = not self.is_int[col]
+            profile["profit"].append({
+                "column": col,
+                "top": [(desc, float(value) if as_float else value) for _, _, desc, value in self.top[col]],
+                "quartiles": dict(zip(QUANTILES, np.quantile(values, QUANTILES).tolist())),
+            })
+
+        if len(numeric_cols) > 1:
+            corr = correlation_matrix(sample, pd.DataFrame(sample, columns=numeric_cols))
+            profile["correlations"] = strong_correlations(corr, numeric_cols)
+
+        date_cols = [col for col in self.columns if self.kinds[col] == "date"]
+        profile["date_columns"] = date_cols
+        if date_cols and numeric_cols and date_cols[0] in self.date_rows:
+            date_col = date_cols[0]
+            (first_date, first_row), (last_date, last_row) = self.date_rows[date_col]
+            changes = []
+            for col in numeric_cols[:TREND_COLUMNS]:
+                changes.append((col, to_python(first_row.get(col)), to_python(last_row.get(col))))
+            profile["trend"] = {
+                "date_column": date_col,
+                "first_date": first_date,
+                "last_date": last_date,
+                "changes": changes,
+            }
+
+        for col, values in self.distinct.items():
+            unique = f"at least {self.distinct_limit}" if col in self.distinct_overflow else len(values)
+            profile["id_columns"].append((col, unique))
+        return profile
+
+    def spilled_sheet(self, path):
+        sample = to_columnar(self.head) if self.head is not None else pd.DataFrame(columns=self.columns)
+        return SpilledSheet(path, list(self.columns), self.rows, sample, self.blocks)
+
+
+def _batches(rows, columns, batch_rows):
+    width = len(columns)
+    batch = []
+    for row in rows:
+        if row is None or all(value is None for value in row):
+            # Blank rows are skipped, as pandas does
+            continue
+        row = tuple(row[:width]) + (None,) * (width - len(row))
+        batch.append(row)
+        if len(batch) >= batch_rows:
+            yield pd.DataFrame.from_records(batch, columns=columns)
+            batch = []
+    if batch:
+        yield pd.DataFrame.from_records(batch, columns=columns)
+
+
+def stream_sheet(worksheet, spill_path, batch_rows=EXCEL_BATCH_ROWS):
+    """Profile one worksheet batch by batch, spilling its columns to spill_path.
+
+    Returns (profile, SpilledSheet).
+    """
+    rows = worksheet.iter_rows(values_only=True)
+    header = next(rows, None)
+    columns = _header_names(header) if header else []
+    # Another worker may be streaming the same workbook into the same spill path
+    tmp_path = f"{spill_path}.{os.getpid()}.tmp"
+    try:
+        with open(tmp_path, 'wb') as spill_file:
+            accumulator = SheetAccumulator(columns, spill_file)
+            if columns:
+                for batch in _batches(rows, columns, batch_rows):
+                    accumulator.add(batch)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+    os.replace(tmp_path, spill_path)
+    return accumulator.profile(), accumulator.spilled_sheet(spill_path)
+
+
+def stream_excel(file_path, batch_rows=EXCEL_BATCH_ROWS, content_hash=None):
+    """Streaming counterpart of extract_excel: (text, {sheet name: SpilledSheet}).
+    Spill files are named after content_hash, hashed from the file when not given."""
+    os.makedirs(EXCEL_SPILL_DIR, exist_ok=True)
+    spill_prefix = os.path.join(EXCEL_SPILL_DIR, content_hash or file_sha256(file_path))
+    workbook = openpyxl.load_workbook(file_path, read_only=True, data_only=True)
+    try:
+        sheet_names = workbook.sheetnames
+        logger.info("Streaming Excel file with %s sheets: %s", len(sheet_names), sheet_names)
+        structured_texts = [f"EXCEL FILE SUMMARY: {os.path.basename(file_path)}",
+                            f"Total sheets: {len(sheet_names)}",
+                            f"Sheet names: {', '.join(sheet_names)}",
+                            ""]
+        excel_data = {}
+        for i, sheet_name in enumerate(sheet_names):
+            profile, sheet = stream_sheet(workbook[sheet_name], f"{spill_prefix}-{i}.spill", batch_rows)
+            logger.debug("Processed sheet: %s with %s rows and %s columns", sheet_name, profile['rows'], len(profile['columns']))
+            structured_texts.extend(format_sheet_header(sheet_name, profile))
+            structured_texts.extend(format_data_rows(sheet.sample, limit=DATA_ROWS, total_rows=profile["rows"]))
+            structured_texts.extend(format_sheet_insights(profile))
+            excel_data[sheet_name] = sheet
+    finally:
+        workbook.close()
+    return '\n'.join(structured_texts), excel_data
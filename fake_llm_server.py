@@ -0,0 +1,185 @@
+"""
+Local stand-in for the OpenAI chat completions API.
+
+Answers POST /v1/chat/completions with a canned reply that echoes the last
+user message, either as a single JSON response or, with "stream": true, as a
+server-sent event stream of chat.completion.chunk objects. Point the app at
+it with OPENAI_BASE_URL=http://127.0.0.1:8001/v1 to exercise /chat and
+/chat/stream without network access or an API key.
+
+Latency and failures can be injected to test throughput, tail latency and
+the retry/hedging behaviour of llm_gateway: every request waits --latency
+seconds, a --tail-probability fraction waits --tail-latency seconds more, and
+an --error-rate fraction is answered with --error-status (429 responses carry
+a Retry-After header). For deterministic tests, the first --slow-first
+requests always get the tail latency and the first --fail-first always fail.
+
+Usage: python fake_llm_server.py [--port 8001] [--chunk-delay 0.02] [--latency 0.1]
+       [--tail-latency 2 --tail-probability 0.05] [--error-rate 0.1 --error-status 503]
+       [--slow-first 1] [--fail-first 2]
+"""
+import json
+import time
+import uuid
+import random
+import itertools
+import argparse
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+def _reply_for(messages):
+    question = ""
+    for message in reversed(messages):
+        if message.get("role") == "user":
+            question = message.get("content", "")
+            break
+    question = " ".join(question.split())
+    return f"This is a fake answer to: {question[-200:]}"
+
+
+class FakeCompletionHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    chunk_delay = 0.02
+    words_per_chunk = 3
+    latency = 0.0
+    tail_latency = 0.0
+    tail_probability = 0.0
+    error_rate = 0.0
+    error_status = 500
+    retry_after = 1
+    slow_first = 0
+    fail_first = 0
+    # Numbers the requests of a configured server, shared by its handler threads
+    counter = itertools.count()
+
+    def log_message(self, format, *args):
+        pass
+
+    def _send_json(self, status, payload, headers=None):
+        body = json.dumps(payload).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _inject_faults(self):
+        """Sleep for the configured latency; answer with an error and return True for injected failures"""
+        number = next(self.counter)
+        delay = self.latency
+        if number < self.slow_first or (self.tail_probability and random.random() < self.tail_probability):
+            delay += self.tail_latency
+        if delay:
+            time.sleep(delay)
+        if number < self.fail_first or (self.error_rate and random.random() < self.error_rate):
+            headers = {"Retry-After": str(self.retry_after)} if self.error_status == 429 else None
+            self._send_json(self.error_status, {"error": {"message": "Injected failure", "type": "fake_error"}}, headers)
+            return True
+        return False
+
+    def do_POST(self):
+        if not self.path.rstrip("/").endswith("/chat/completions"):
+            self._send_json(404, {"error": {"message": f"Unknown path {self.path}"}})
+            return
+
+        length = int(self.headers.get("Content-Length", 0))
+        request = json.loads(self.rfile.read(length) or b"{}")
+        if self._inject_faults():
+            return
+        model = request.get("model", "fake-model")
+        reply = _reply_for(request.get("messages", []))
+        completion_id = f"chatcmpl-{uuid.uuid4().hex}"
+        created = int(time.time())
+
+        if not request.get("stream"):
+            self._send_json(200, {
+                "id": completion_id,
+                "object": "chat.completion",
+                "created": created,
+                "model": model,
+                "choices": [{
+                    "index": 0,
+                    "message": {"role": "assistant", "content": reply},
+                    "finish_reason": "stop",
+                }],
+                "usage": {"prompt_tokens": 0, "completion_tokens": 0, "total_tokens": 0},
+            })
+            return
+
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Cache-Control", "no-cache")
+        self.send_header("Connection", "close")
+        self.end_headers()
+
+        def send_chunk(delta, finish_reason=None):
+            chunk = {
+                "id": completion_id,
+                "object": "chat.completion.chunk",
+                "created": created,
+                "model": model,
+                "choices": [{"index": 0, "delta": delta, "finish_reason": finish_reason}],
+            }
+            self.wfile.write(f"data: {json.dumps(chunk)}\n\n".encode("utf-8"))
+            self.wfile.flush()
+
+        send_chunk({"role": "assistant", "content": ""})
+        words = reply.split(" ")
+        for start in range(0, len(words), self.words_per_chunk):
+            time.sleep(self.chunk_delay)
+            piece = " ".join(words[start:start + self.words_per_chunk])
+            send_chunk({"content": piece if start == 0 else " " + piece})
+        send_chunk({}, finish_reason="stop")
+        self.wfile.write(b"data: [DONE]\n\n")
+        self.wfile.flush()
+        self.close_connection = True
+
+
+class FakeServer(ThreadingHTTPServer):
+    # The socketserver default backlog of 5 drops connections under concurrent load
+    request_queue_size = 128
+    daemon_threads = True
+
+
+def _handler_class(**options):
+    """FakeCompletionHandler subclass with the given class attributes (chunk_delay, latency, ...)"""
+    unknown = set(options) - set(vars(FakeCompletionHandler))
+    if unknown:
+        raise TypeError(f"Unknown fake server options: {sorted(unknown)}")
+    return type("ConfiguredHandler", (FakeCompletionHandler,), dict(options, counter=itertools.count()))
+
+
+def start_server(host="127.0.0.1", port=0, chunk_delay=0.02, **options):
+    """Start the fake server on a background thread and return it.
+    Options are latency, tail_latency, tail_probability, error_rate,
+    error_status, retry_after, slow_first, fail_first and words_per_chunk. The bound port is
+    available as server.server_address[1]."""
+    handler = _handler_class(chunk_delay=chunk_delay, **options)
+    server = FakeServer((host, port), handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Fake OpenAI-compatible chat completion server")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8001)
+    parser.add_argument("--chunk-delay", type=float, default=0.02, help="Seconds between streamed chunks")
+    parser.add_argument("--latency", type=float, default=0.0, help="Seconds before every response")
+    parser.add_argument("--tail-latency", type=float, default=0.0, help="Extra seconds for slow responses")
+    parser.add_argument("--tail-probability", type=float, default=0.0, help="Fraction of responses that are slow")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="Fraction of requests that fail")
+    parser.add_argument("--error-status", type=int, default=500, help="HTTP status of injected failures")
+    parser.add_argument("--slow-first", type=int, default=0, help="Number of first requests that are slow")
+    parser.add_argument("--fail-first", type=int, default=0, help="Number of first requests that fail")
+    args = parser.parse_args()
+
+    handler = _handler_class(chunk_delay=args.chunk_delay, latency=args.latency, tail_latency=args.tail_latency,
+                             tail_probability=args.tail_probability, error_rate=args.error_rate,
+                             error_status=args.error_status, slow_first=args.slow_first, fail_first=args.fail_first)
+    server = FakeServer((args.host, args.port), handler)
+    print(f"Fake completion server listening on http://{args.host}:{args.port}/v1")
+    server.serve_forever()
@@ -0,0 +1,212 @@
+import os
+import logging
+import time
+import uuid
+import threading
+import multiprocessing
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor
+
+import metrics
+import document_processor
+from parse_cache import parse_cache
+from sessions import session_manager
+from upload_manifest import upload_manifest
+
+logger = logging.getLogger(__name__)
+
+# Background ingestion for /upload. Parsing and splitting run on a bounded
+# process pool so a large workbook or PDF never holds a request thread, and
+# the parsed result is handed to a single indexing thread in the serving
+# process that owns the document store.
+
+INGEST_WORKERS = int(os.getenv("INGEST_WORKERS", "2"))
+INGEST_MAX_PENDING = int(os.getenv("INGEST_MAX_PENDING", "8"))
+INGEST_JOB_HISTORY = 200
+
+# Rough completion fraction reported for each stage
+STAGE_PROGRESS = {
+    "queued": 0.0,
+    "parsing": 0.1,
+    "splitting": 0.6,
+    "indexing": 0.8,
+    "done": 1.0,
+    "failed": 1.0,
+}
+
+
+class QueueFullError(Exception):
+    """Raised when the ingestion queue has no room for another job"""
+
+
+# Progress queue of the current worker process, set by the pool initializer
+_progress_queue = None
+
+
+def _init_worker(progress_queue):
+    global _progress_queue
+    _progress_queue = progress_queue
+
+
+def _run_extraction(job_id, file_path, content_hash):
+    """Pool task: parse and split a document, reporting stage changes"""
+    def progress(stage):
+        _progress_queue.put((job_id, stage))
+    return document_processor.extract_document_cached(file_path, content_hash, progress=progress)
+
+
+class IngestionQueue:
+    """Bounded queue of document ingestion jobs"""
+
+    def __init__(self, workers=INGEST_WORKERS, max_pending=INGEST_MAX_PENDING):
+        self.workers = max(1, workers)
+        self.max_pending = max(0, max_pending)
+        self.jobs = {}
+        self.lock = threading.Lock()
+        self.executor = None
+        self.indexer = None
+        self.progress_queue = None
+
+    def _start(self):
+        # The pool starts from a request thread of a process that already runs
+        # other threads and holds SQLite connections; a child forked from it
+        # could inherit locks held at that moment. Workers are forked from a
+        # single-threaded fork server instead, or spawned where there is none.
+        method = "forkserver" if "forkserver" in multiprocessing.get_all_start_methods() else "spawn"
+        context = multiprocessing.get_context(method)
+        self.progress_queue = context.Queue()
+        self.executor = ProcessPoolExecutor(
+            max_workers=self.workers,
+            mp_context=context,
+            initializer=_init_worker,
+            initargs=(self.progress_queue,),
+        )
+        # Store updates are serialized on one thread; the store is not shared-writer safe
+        self.indexer = ThreadPoolExecutor(max_workers=1, thread_name_prefix="ingest-index")
+        threading.Thread(target=self._watch_progress, name="ingest-progress", daemon=True).start()
+
+    def _watch_progress(self):
+        while True:
+            job_id, stage = self.progress_queue.get()
+            self._set_stage(job_id, stage, advance_only=True)
+
+    def _set_stage(self, job_id, stage, error=None, advance_only=False):
+        with self.lock:
+            job = self.jobs.get(job_id)
+            if job is None:
+                return
+            # Worker progress events can arrive after the indexing thread moved the job on
+            if advance_only and STAGE_PROGRESS.get(stage, 0.0) < job["progress"]:
+                return
+            job["stage"] = stage
+            job["progress"] = STAGE_PROGRESS.get(stage, job["progress"])
+            if stage in ("done", "failed"):
+                job["status"] = stage
+                job["finished_at"] = time.time()
+            else:
+                job["status"] = "running" if stage != "queued" else "queued"
+            if error:
+                job["error"] = error
+        self._share(job_id)
+
+    def _share(self, job_id):
+        """Write a job to the shared backend, where status requests reaching other workers find it"""
+        if not session_manager.backend.shared:
+            return
+        with self.lock:
+            job = self.jobs.get(job_id)
+            job = dict(job) if job else None
+        if job is not None:
+            session_manager.backend.save_job(job)
+
+    def submit(self, file_path, filename=None, content_hash=None, session_id=None):
+        """Queue a document for ingestion into a session and return its job record"""
+        with self.lock:
+            active = sum(1 for job in self.jobs.values() if job["status"] in ("queued", "running"))
+            if active >= self.workers + self.max_pending:
+                raise QueueFullError(f"Ingestion queue is full ({active} jobs in progress)")
+            if self.executor is None:
+                self._start()
+
+            job_id = uuid.uuid4().hex
+            job = {
+                "job_id": job_id,
+                "filename": filename or os.path.basename(file_path),
+                "session_id": session_id,
+                "status": "queued",
+                "stage": "queued",
+                "progress": 0.0,
+                "error": None,
+                "stats": None,
+                "created_at": time.time(),
+                "finished_at": None,
+            }
+            self.jobs[job_id] = job
+            self._prune()
+        self._share(job_id)
+
+        # A document seen before goes straight to indexing from the parse cache
+        cached = parse_cache.get(content_hash) if content_hash else None
+        if cached is not None:
+            logger.info("Parse cache hit for %s, skipping extraction", file_path)
+            cached["from_cache"] = True
+            future = Future()
+            future.set_result(cached)
+            self.indexer.submit(self._finish, job_id, file_path, session_id, future)
+            return dict(job)
+
+        future = self.executor.submit(_run_extraction, job_id, file_path, content_hash)
+        future.add_done_callback(lambda f: self.indexer.submit(self._finish, job_id, file_path, session_id, f))
+        return dict(job)
+
+    def _finish(self, job_id, file_path, session_id, future):
+        try:
+            parsed = future.result()
+            self._set_stage(job_id, "indexing")
+            session = session_manager.get(session_id) if session_id else None
+            document_processor.store_document(file_path, parsed, session)
+            with self.lock:
+                if job_id in self.jobs:
+                    # Throughput of each pipeline stage, in MB of text per second
+                    self.jobs[job_id]["stats"] = parsed.get("stats")
+            self._set_stage(job_id, "done")
+            upload_manifest.set_status(file_path, "done")
+            logger.info("Ingestion job %s finished for %s", job_id, file_path)
+        except Exception as e:
+            logger.error("Ingestion job %s failed for %s: %s", job_id, file_path, e)
+            self._set_stage(job_id, "failed", error=str(e))
+            upload_manifest.set_status(file_path, "failed", error=str(e))
+
+    def _prune(self):
+        finished = [job for job in self.jobs.values() if job["status"] in ("done", "failed")]
+        excess = len(self.jobs) - INGEST_JOB_HISTORY
+        if excess > 0:
+            finished.sort(key=lambda job: job["finished_at"])
+            for job in finished[:excess]:
+                del self.jobs[job["job_id"]]
+
+    def get(self, job_id):
+        with self.lock:
+            job = self.jobs.get(job_id)
+            if job:
+                return dict(job)
+        # Jobs submitted to another worker
+        return session_manager.backend.load_job(job_id)
+
+    def status_counts(self):
+        """Number of retained jobs per status"""
+        counts = {"queued": 0, "running": 0, "done": 0, "failed": 0}
+        with self.lock:
+            for job in self.jobs.values():
+                counts[job["status"]] = counts.get(job["status"], 0) + 1
+        return counts
+
+
+ingestion_queue = IngestionQueue()
+
+
+def _collect_metrics():
+    return [("chatbot_ingest_jobs", "gauge", "Ingestion jobs by status (finished jobs as far as they are retained)",
+             [({"status": status}, count) for status, count in ingestion_queue.status_counts().items()])]
+
+
+metrics.register_collector(_collect_metrics)
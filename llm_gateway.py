@@ -0,0 +1,490 @@
+import os
+import logging
+import time
+import random
+import asyncio
+import threading
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+
+from dotenv import load_dotenv
+
+import metrics
+
+logger = logging.getLogger(__name__)
+
+# Single entry point for calls to the OpenAI API. One client with a tuned
+# connection pool is shared by all requests, and each call gets:
+#   - a deadline covering queueing, retries and the request itself
+#   - retries with jittered exponential backoff on 429, 5xx, timeouts and
+#     connection errors (honouring Retry-After)
+#   - a global concurrency cap and an optional requests-per-minute token bucket
+#   - optional hedging: a second identical request is sent when the first has
+#     not answered after LLM_HEDGE_AFTER_SECONDS, and the first answer wins
+# Streams are retried only until their first chunk arrives.
+#
+# The a-prefixed methods (acomplete, astream) do the same on an asyncio event
+# loop with AsyncOpenAI, for the ASGI server: a call waiting for the model
+# holds no thread, so their concurrency cap (LLM_ASYNC_MAX_CONCURRENCY) can be
+# far higher than the thread-based one.
+
+load_dotenv()
+
+LLM_TIMEOUT_SECONDS = float(os.getenv("LLM_TIMEOUT_SECONDS", "60"))
+LLM_CONNECT_TIMEOUT_SECONDS = float(os.getenv("LLM_CONNECT_TIMEOUT_SECONDS", "5"))
+LLM_MAX_RETRIES = int(os.getenv("LLM_MAX_RETRIES", "3"))
+LLM_BACKOFF_BASE_SECONDS = float(os.getenv("LLM_BACKOFF_BASE_SECONDS", "0.5"))
+LLM_BACKOFF_MAX_SECONDS = float(os.getenv("LLM_BACKOFF_MAX_SECONDS", "8"))
+LLM_MAX_CONCURRENCY = int(os.getenv("LLM_MAX_CONCURRENCY", "8"))
+# Requests per minute allowed by the token bucket; 0 disables it
+LLM_RATE_LIMIT_RPM = float(os.getenv("LLM_RATE_LIMIT_RPM", "0"))
+# Send a duplicate request when the first has not answered after this many seconds; 0 disables hedging
+LLM_HEDGE_AFTER_SECONDS = float(os.getenv("LLM_HEDGE_AFTER_SECONDS", "0"))
+LLM_POOL_CONNECTIONS = int(os.getenv("LLM_POOL_CONNECTIONS", "20"))
+LLM_POOL_KEEPALIVE = int(os.getenv("LLM_POOL_KEEPALIVE", "10"))
+# Model calls in flight at once from the event loop, which is also its connection pool size
+LLM_ASYNC_MAX_CONCURRENCY = int(os.getenv("LLM_ASYNC_MAX_CONCURRENCY", "256"))
+
+
+def _openai():
+    """The openai package, imported on first use: with httpx it takes a few hundred ms to load"""
+    import openai
+    return openai
+
+
+def _retryable_errors():
+    openai = _openai()
+    return (openai.RateLimitError, openai.InternalServerError, openai.APITimeoutError, openai.APIConnectionError)
+
+
+class LLMError(Exception):
+    """A model call that failed after retries or could not be made"""
+
+
+class LLMTimeoutError(LLMError):
+    """The call deadline passed while waiting for capacity or for the model"""
+
+
+class TokenBucket:
+    """Token bucket refilled at rate tokens per second, holding at most capacity tokens"""
+
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def _take(self):
+        """Take one token if there is one; otherwise the seconds until there will be"""
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return 0.0
+            return (1 - self.tokens) / self.rate
+
+    def acquire(self, deadline):
+        """Take one token, waiting until the deadline at most; returns False on timeout"""
+        while True:
+            wait_seconds = self._take()
+            if not wait_seconds:
+                return True
+            if time.monotonic() + wait_seconds > deadline:
+                return False
+            time.sleep(wait_seconds)
+
+    async def acquire_async(self, deadline):
+        while True:
+            wait_seconds = self._take()
+            if not wait_seconds:
+                return True
+            if time.monotonic() + wait_seconds > deadline:
+                return False
+            await asyncio.sleep(wait_seconds)
+
+
+def _retry_after(error):
+    response = getattr(error, "response", None)
+    if response is None:
+        return None
+    try:
+        return float(response.headers.get("retry-after"))
+    except (TypeError, ValueError):
+        return None
+
+
+class LLMGateway:
+    """Pooled, rate limited OpenAI client with deadlines, retries and hedging"""
+
+    def __init__(self, api_key=None, base_url=None, timeout=LLM_TIMEOUT_SECONDS, max_retries=LLM_MAX_RETRIES,
+                 max_concurrency=LLM_MAX_CONCURRENCY, rate_limit_rpm=LLM_RATE_LIMIT_RPM,
+                 hedge_after=LLM_HEDGE_AFTER_SECONDS, async_max_concurrency=LLM_ASYNC_MAX_CONCURRENCY):
+        self.api_key = api_key
+        self.base_url = base_url
+        self.timeout = timeout
+        self.max_retries = max_retries
+        self.hedge_after = hedge_after
+        self.semaphore = threading.BoundedSemaphore(max_concurrency)
+        self.bucket = TokenBucket(rate_limit_rpm / 60.0, max(1.0, max_concurrency)) if rate_limit_rpm > 0 else None
+        self._client = None
+        self._client_lock = threading.Lock()
+        self._hedge_pool = None
+        self.async_max_concurrency = max(1, async_max_concurrency)
+        # AsyncOpenAI client and semaphore, bound to the event loop they were created on
+        self._async_loop = None
+        self._async_client = None
+        self._async_semaphore = None
+        self.stats_lock = threading.Lock()
+        self.counters = {"calls": 0, "failures": 0, "retries": 0, "hedges": 0, "hedge_wins": 0, "timeouts": 0}
+
+    @property
+    def client(self):
+        with self._client_lock:
+            if self._client is None:
+                import httpx
+                from openai import OpenAI
+
+                http_client = httpx.Client(
+                    limits=httpx.Limits(max_connections=LLM_POOL_CONNECTIONS,
+                                        max_keepalive_connections=LLM_POOL_KEEPALIVE,
+                                        keepalive_expiry=30),
+                    timeout=httpx.Timeout(self.timeout, connect=LLM_CONNECT_TIMEOUT_SECONDS),
+                )
+                # Retries are done here, with the call deadline in mind, not by the SDK
+                self._client = OpenAI(api_key=self.api_key or os.getenv("OPENAI_API_KEY"),
+                                      base_url=self.base_url or os.getenv("OPENAI_BASE_URL"),
+                                      max_retries=0, http_client=http_client)
+            return self._client
+
+    def _async_resources(self):
+        """(AsyncOpenAI client, semaphore) for the running event loop"""
+        loop = asyncio.get_running_loop()
+        with self._client_lock:
+            if self._async_loop is not loop:
+                import httpx
+                from openai import AsyncOpenAI
+
+                http_client = httpx.AsyncClient(
+                    limits=httpx.Limits(max_connections=self.async_max_concurrency,
+                                        max_keepalive_connections=LLM_POOL_KEEPALIVE,
+                                        keepalive_expiry=30),
+                    timeout=httpx.Timeout(self.timeout, connect=LLM_CONNECT_TIMEOUT_SECONDS),
+                )
+                self._async_client = AsyncOpenAI(api_key=self.api_key or os.getenv("OPENAI_API_KEY"),
+                                                 base_url=self.base_url or os.getenv("OPENAI_BASE_URL"),
+                                                 max_retries=0, http_client=http_client)
+                self._async_semaphore = asyncio.Semaphore(self.async_max_concurrency)
+                self._async_loop = loop
+            return self._async_client, self._async_semaphore
+
+    async def aclose(self):
+        """Close the connections of the async client, e.g. when the server shuts down"""
+        with self._client_lock:
+            client = self._async_client
+            self._async_loop = self._async_client = self._async_semaphore = None
+        if client is not None:
+            await client.close()
+
+    def _count(self, name, amount=1):
+        with self.stats_lock:
+            self.counters[name] += amount
+
+    def _acquire(self, deadline):
+        if self.bucket is not None and not self.bucket.acquire(deadline):
+            self._count("timeouts")
+            raise LLMTimeoutError("Timed out waiting for the model rate limit")
+        if not self.semaphore.acquire(timeout=max(0.0, deadline - time.monotonic())):
+            self._count("timeouts")
+            raise LLMTimeoutError("Timed out waiting for a free model connection")
+
+    async def _acquire_async(self, semaphore, deadline):
+        if self.bucket is not None and not await self.bucket.acquire_async(deadline):
+            self._count("timeouts")
+            raise LLMTimeoutError("Timed out waiting for the model rate limit")
+        try:
+            await asyncio.wait_for(semaphore.acquire(), timeout=max(0.0, deadline - time.monotonic()))
+        except asyncio.TimeoutError:
+            self._count("timeouts")
+            raise LLMTimeoutError("Timed out waiting for a free model connection") from None
+
+    def _backoff_delay(self, attempt, error, deadline):
+        """Seconds to wait before the next attempt; None when the deadline leaves no time for it"""
+        delay = _retry_after(error)
+        if delay is None:
+            delay = min(LLM_BACKOFF_MAX_SECONDS, LLM_BACKOFF_BASE_SECONDS * 2 ** attempt)
+            # Full jitter keeps clients that failed together from retrying together
+            delay = random.uniform(0, delay)
+        if time.monotonic() + delay >= deadline:
+            return None
+        self._count("retries")
+        return delay
+
+    def _failure(self, error):
+        """The LLMError to raise for an error that is not retried (again)"""
+        self._count("failures")
+        if isinstance(error, _openai().APITimeoutError):
+            return LLMTimeoutError(f"Model call timed out: {error}")
+        return LLMError(f"Model call failed: {error}")
+
+    def _with_retries(self, call, deadline):
+        openai, retryable_errors = _openai(), _retryable_errors()
+        attempt = 0
+        while True:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                self._count("timeouts")
+                raise LLMTimeoutError("Model call deadline exceeded")
+            try:
+                return call(remaining)
+            except retryable_errors as e:
+                logger.warning("Model call failed (attempt %s): %s", attempt + 1, e)
+                delay = self._backoff_delay(attempt, e, deadline) if attempt < self.max_retries else None
+                if delay is None:
+                    raise self._failure(e) from e
+                time.sleep(delay)
+                attempt += 1
+            except openai.OpenAIError as e:
+                self._count("failures")
+                raise LLMError(f"Model call failed: {e}") from e
+
+    async def _with_retries_async(self, call, deadline):
+        openai, retryable_errors = _openai(), _retryable_errors()
+        attempt = 0
+        while True:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                self._count("timeouts")
+                raise LLMTimeoutError("Model call deadline exceeded")
+            try:
+                return await call(remaining)
+            except retryable_errors as e:
+                logger.warning("Model call failed (attempt %s): %s", attempt + 1, e)
+                delay = self._backoff_delay(attempt, e, deadline) if attempt < self.max_retries else None
+                if delay is None:
+                    raise self._failure(e) from e
+                await asyncio.sleep(delay)
+                attempt += 1
+            except openai.OpenAIError as e:
+                self._count("failures")
+                raise LLMError(f"Model call failed: {e}") from e
+
+    def _create(self, remaining, **kwargs):
+        deadline = time.monotonic() + remaining
+        self._acquire(deadline)
+        try:
+            return self.client.chat.completions.create(timeout=max(0.001, deadline - time.monotonic()), **kwargs)
+        finally:
+            self.semaphore.release()
+
+    def _hedged_create(self, remaining, **kwargs):
+        with self._client_lock:
+            if self._hedge_pool is None:
+                self._hedge_pool = ThreadPoolExecutor(max_workers=LLM_POOL_CONNECTIONS, thread_name_prefix="llm-hedge")
+        pool = self._hedge_pool
+        deadline = time.monotonic() + remaining
+        primary = pool.submit(self._create, remaining, **kwargs)
+        done, _ = wait([primary], timeout=min(self.hedge_after, remaining))
+        if done or time.monotonic() >= deadline:
+            return primary.result()
+        self._count("hedges")
+        hedge = pool.submit(self._create, deadline - time.monotonic(), **kwargs)
+        pending = {primary, hedge}
+        error = None
+        while pending:
+            done, pending = wait(pending, timeout=max(0.0, deadline - time.monotonic()), return_when=FIRST_COMPLETED)
+            if not done:
+                break
+            for future in done:
+                if future.exception() is None:
+                    if future is hedge:
+                        self._count("hedge_wins")
+                    return future.result()
+                error = future.exception()
+        if error is not None:
+            raise error
+        self._count("timeouts")
+        raise LLMTimeoutError("Model call deadline exceeded")
+
+    async def _create_async(self, remaining, **kwargs):
+        deadline = time.monotonic() + remaining
+        client, semaphore = self._async_resources()
+        await self._acquire_async(semaphore, deadline)
+        try:
+            return await client.chat.completions.create(timeout=max(0.001, deadline - time.monotonic()), **kwargs)
+        finally:
+            semaphore.release()
+
+    async def _hedged_create_async(self, remaining, **kwargs):
+        deadline = time.monotonic() + remaining
+        primary = asyncio.ensure_future(self._create_async(remaining, **kwargs))
+        done, _ = await asyncio.wait({primary}, timeout=min(self.hedge_after, remaining))
+        if done or time.monotonic() >= deadline:
+            return await primary
+        self._count("hedges")
+        hedge = asyncio.ensure_future(self._create_async(deadline - time.monotonic(), **kwargs))
+        pending = {primary, hedge}
+        error = None
+        try:
+            while pending:
+                done, pending = await asyncio.wait(pending, timeout=max(0.0, deadline - time.monotonic()),
+                                                   return_when=asyncio.FIRST_COMPLETED)
+                if not done:
+                    break
+                for task in done:
+                    if task.exception() is None:
+                        if task is hedge:
+                            self._count("hedge_wins")
+                        return task.result()
+                    error = task.exception()
+        finally:
+            # Unlike threads, the losing request can be cancelled
+            for task in pending:
+                task.cancel()
+        if error is not None:
+            raise error
+        self._count("timeouts")
+        raise LLMTimeoutError("Model call deadline exceeded")
+
+    def complete(self, messages, model, timeout=None, **kwargs):
+        """Text of a chat completion; raises LLMError when it cannot be obtained"""
+        self._count("calls")
+        start = time.perf_counter()
+        deadline = time.monotonic() + (timeout or self.timeout)
+        create = self._hedged_create if self.hedge_after > 0 else self._create
+        response = self._with_retries(lambda remaining: create(remaining, model=model, messages=messages, **kwargs),
+                                      deadline)
+        metrics.observe_stage("llm_total", time.perf_counter() - start, "complete")
+        return (response.choices[0].message.content or "").strip()
+
+    def stream(self, messages, model, timeout=None, **kwargs):
+        """Generator of text deltas of a streamed chat completion.
+
+        Opening the stream is retried; once text has been produced, errors are
+        raised as LLMError since the caller has already used part of the answer.
+        """
+        openai = _openai()
+        self._count("calls")
+        start = time.perf_counter()
+        deadline = time.monotonic() + (timeout or self.timeout)
+
+        def open_stream(remaining):
+            self._acquire(time.monotonic() + remaining)
+            try:
+                stream = self.client.chat.completions.create(model=model, messages=messages, stream=True,
+                                                             timeout=remaining, **kwargs)
+                # Wait for the first chunk here so that failures before any output are retried
+                iterator = iter(stream)
+                first = next(iterator, None)
+                return stream, iterator, first
+            except BaseException:
+                self.semaphore.release()
+                raise
+
+        stream, iterator, first = self._with_retries(open_stream, deadline)
+        metrics.observe_stage("llm_first_token", time.perf_counter() - start, "stream")
+        try:
+            chunk = first
+            while chunk is not None:
+                if chunk.choices:
+                    delta = chunk.choices[0].delta.content
+                    if delta:
+                        yield delta
+                if time.monotonic() > deadline:
+                    self._count("timeouts")
+                    raise LLMTimeoutError("Model stream deadline exceeded")
+                chunk = next(iterator, None)
+        except openai.OpenAIError as e:
+            self._count("failures")
+            raise LLMError(f"Model stream failed: {e}") from e
+        finally:
+            self.semaphore.release()
+            response = getattr(stream, "response", None)
+            if response is not None:
+                response.close()
+            metrics.observe_stage("llm_total", time.perf_counter() - start, "stream")
+
+    async def acomplete(self, messages, model, timeout=None, **kwargs):
+        """Coroutine version of complete()"""
+        self._count("calls")
+        start = time.perf_counter()
+        deadline = time.monotonic() + (timeout or self.timeout)
+        create = self._hedged_create_async if self.hedge_after > 0 else self._create_async
+        response = await self._with_retries_async(
+            lambda remaining: create(remaining, model=model, messages=messages, **kwargs), deadline)
+        metrics.observe_stage("llm_total", time.perf_counter() - start, "complete")
+        return (response.choices[0].message.content or "").strip()
+
+    async def astream(self, messages, model, timeout=None, **kwargs):
+        """Async generator version of stream(); closing it early releases the connection"""
+        openai = _openai()
+        self._count("calls")
+        start = time.perf_counter()
+        deadline = time.monotonic() + (timeout or self.timeout)
+        client, semaphore = self._async_resources()
+
+        async def open_stream(remaining):
+            await self._acquire_async(semaphore, time.monotonic() + remaining)
+            try:
+                stream = await client.chat.completions.create(model=model, messages=messages, stream=True,
+                                                              timeout=remaining, **kwargs)
+                first = await anext(stream, None)
+                return stream, first
+            except BaseException:
+                semaphore.release()
+                raise
+
+        stream, first = await self._with_retries_async(open_stream, deadline)
+        metrics.observe_stage("llm_first_token", time.perf_counter() - start, "stream")
+        try:
+            chunk = first
+            while chunk is not None:
+                if chunk.choices:
+                    delta = chunk.choices[0].delta.content
+                    if delta:
+                        yield delta
+                if time.monotonic() > deadline:
+                    self._count("timeouts")
+                    raise LLMTimeoutError("Model stream deadline exceeded")
+                chunk = await anext(stream, None)
+        except openai.OpenAIError as e:
+            self._count("failures")
+            raise LLMError(f"Model stream failed: {e}") from e
+        finally:
+            semaphore.release()
+            await stream.response.aclose()
+            metrics.observe_stage("llm_total", time.perf_counter() - start, "stream")
+
+    def embed(self, texts, model):
+        """Embedding vectors (lists of floats) for the texts"""
+        self._count("calls")
+        start = time.perf_counter()
+        deadline = time.monotonic() + self.timeout
+
+        def create(remaining):
+            self._acquire(time.monotonic() + remaining)
+            try:
+                return self.client.embeddings.create(model=model, input=list(texts), timeout=remaining)
+            finally:
+                self.semaphore.release()
+
+        response = self._with_retries(create, deadline)
+        metrics.observe_stage("llm_total", time.perf_counter() - start, "embed")
+        return [item.embedding for item in response.data]
+
+    def stats(self):
+        with self.stats_lock:
+            return dict(self.counters)
+
+
+llm_gateway = LLMGateway()
+
+
+def _collect_metrics():
+    counters = llm_gateway.stats()
+    return [("chatbot_llm_events_total", "counter", "Model calls, failures, retries, hedges and timeouts of the gateway",
+             [({"event": name}, value) for name, value in counters.items()])]
+
+
+metrics.register_collector(_collect_metrics)
@@ -0,0 +1,134 @@
+import os
+import time
+import bisect
+import threading
+import contextlib
+
+# In-process metrics served in the Prometheus text format from /metrics.
+# Histograms keep fixed cumulative buckets per label set, so observing a
+# value is a bisect and three additions under a lock. Values that other
+# modules already count (LLM gateway, caches, ingestion queue) are read at
+# scrape time through registered collector functions.
+
+METRICS_ENABLED = os.getenv("METRICS_ENABLED", "true").lower() not in ("0", "false", "no")
+
+# Seconds; spans a cache hit to a slow model answer
+DEFAULT_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0)
+
+_histograms = []
+_collectors = []
+_registry_lock = threading.Lock()
+
+
+def _format_labels(labels):
+    if not labels:
+        return ""
+    escaped = (str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"') for value in labels.values())
+    return "{" + ",".join(f'{name}="{value}"' for name, value in zip(labels, escaped)) + "}"
+
+
+def _format_value(value):
+    if value == float("inf"):
+        return "+Inf"
+    if isinstance(value, float) and value.is_integer() and abs(value) < 1e15:
+        return str(int(value))
+    return repr(value) if isinstance(value, float) else str(value)
+
+
+class Histogram:
+    """Cumulative-bucket histogram with one series per combination of label values"""
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(sorted(buckets))
+        # label values -> [per-bucket counts (last is +Inf), sum]
+        self.series = {}
+        self.lock = threading.Lock()
+        with _registry_lock:
+            _histograms.append(self)
+
+    def observe(self, value, *labelvalues):
+        if not METRICS_ENABLED:
+            return
+        index = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            series = self.series.get(labelvalues)
+            if series is None:
+                series = self.series[labelvalues] = [[0] * (len(self.buckets) + 1), 0.0]
+            series[0][index] += 1
+            series[1] += value
+
+    @contextlib.contextmanager
+    def time(self, *labelvalues):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, *labelvalues)
+
+    def snapshot(self, *labelvalues):
+        """(count, sum) of one series"""
+        with self.lock:
+            series = self.series.get(labelvalues)
+            return (sum(series[0]), series[1]) if series else (0, 0.0)
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} histogram"]
+        with self.lock:
+            series = [(values, list(counts), total) for values, (counts, total) in self.series.items()]
+        for values, counts, total in sorted(series):
+            labels = dict(zip(self.labelnames, values))
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += count
+                bucket_labels = _format_labels(dict(labels, le=_format_value(float(bound))))
+                lines.append(f"{self.name}_bucket{bucket_labels} {cumulative}")
+            lines.append(f"{self.name}_sum{_format_labels(labels)} {_format_value(total)}")
+            lines.append(f"{self.name}_count{_format_labels(labels)} {cumulative}")
+        return lines
+
+
+def register_collector(collector):
+    """Add a function returning [(name, type, help, [(labels dict, value)])] read on every scrape"""
+    with _registry_lock:
+        _collectors.append(collector)
+
+
+def render():
+    """All metrics in the Prometheus text exposition format"""
+    with _registry_lock:
+        histograms = list(_histograms)
+        collectors = list(_collectors)
+    lines = []
+    for histogram in histograms:
+        lines.extend(histogram.render())
+    for collector in collectors:
+        try:
+            families = collector()
+        except Exception as e:
+            # One failing source must not break the whole scrape
+            lines.append(f"# collector {getattr(collector, '__name__', collector)} failed: {e}")
+            continue
+        for name, kind, documentation, samples in families:
+            lines.append(f"# HELP {name} {documentation}")
+            lines.append(f"# TYPE {name} {kind}")
+            for labels, value in samples:
+                lines.append(f"{name}{_format_labels(labels)} {_format_value(value)}")
+    return "\n".join(lines) + "\n"
+
+
+# Duration of every stage of uploads, ingestion and chat requests. kind is the
+# file type for ingestion stages and the call type for model stages.
+STAGE_SECONDS = Histogram("chatbot_stage_seconds", "Duration of request and ingestion stages in seconds",
+                          ("stage", "kind"))
+
+
+def observe_stage(stage, seconds, kind=""):
+    STAGE_SECONDS.observe(seconds, stage, kind)
+
+
+def stage_timer(stage, kind=""):
+    """Context manager recording the duration of its block as a stage"""
+    return STAGE_SECONDS.time(stage, kind)
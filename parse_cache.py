@@ -0,0 +1,211 @@
+import os
+import glob
+import logging
+import pickle
+import hashlib
+import threading
+
+import metrics
+from text_pipeline import CHUNK_SPILL_DIR
+
+logger = logging.getLogger(__name__)
+
+# Persistent cache of extraction results keyed by the SHA-256 of the file
+# bytes, so a re-uploaded document (or a cold-store query against an
+# uploaded file) skips parsing entirely. Entries are pickled files in
+# PARSE_CACHE_DIR; reads refresh the file mtime and the oldest entries are
+# evicted once they grow past PARSE_CACHE_MAX_MB. An entry includes the chunk
+# and sheet spill files named after its hash, which count towards the limit
+# and are deleted with it. A result larger than the limit by itself is not
+# cached, and the entry just written is never the one evicted. Stores read
+# spilled sheets through hard links of their own (see
+# excel_store.link_spilled_sheets), so eviction never removes their data.
+
+PARSE_CACHE_DIR = os.getenv("PARSE_CACHE_DIR", os.path.join("cache", "parse"))
+PARSE_CACHE_MAX_BYTES = int(os.getenv("PARSE_CACHE_MAX_MB", "512")) * 1024 * 1024
+
+# Bump whenever extract_document changes its output, so stale entries are ignored
+PARSER_VERSION = 6
+
+HASH_BLOCK_SIZE = 1024 * 1024
+
+# path -> (size, mtime_ns, sha256) for files already hashed by this process
+_hash_memo = {}
+_hash_lock = threading.Lock()
+
+
+def file_sha256(file_path):
+    """SHA-256 hex digest of a file, read in blocks and memoized by size/mtime"""
+    stat = os.stat(file_path)
+    with _hash_lock:
+        memo = _hash_memo.get(file_path)
+    if memo and memo[0] == stat.st_size and memo[1] == stat.st_mtime_ns:
+        return memo[2]
+
+    sha = hashlib.sha256()
+    with open(file_path, 'rb') as f:
+        for block in iter(lambda: f.read(HASH_BLOCK_SIZE), b''):
+            sha.update(block)
+    digest = sha.hexdigest()
+    with _hash_lock:
+        _hash_memo[file_path] = (stat.st_size, stat.st_mtime_ns, digest)
+    return digest
+
+
+def remember_file_hash(file_path, digest):
+    """Record a hash computed elsewhere (e.g. while the upload was written)"""
+    stat = os.stat(file_path)
+    with _hash_lock:
+        _hash_memo[file_path] = (stat.st_size, stat.st_mtime_ns, digest)
+
+
+class ParseCache:
+    """Size-bounded LRU cache of parsed documents on disk"""
+
+    def __init__(self, directory=PARSE_CACHE_DIR, max_bytes=PARSE_CACHE_MAX_BYTES, spill_dir=CHUNK_SPILL_DIR):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.spill_dir = spill_dir
+        self.hits = 0
+        self.misses = 0
+
+    def _path(self, content_hash):
+        return os.path.join(self.directory, f"{content_hash}-v{PARSER_VERSION}.pkl")
+
+    def get(self, content_hash):
+        """Return the cached parse result for a content hash, or None"""
+        path = self._path(content_hash)
+        try:
+            with open(path, 'rb') as f:
+                parsed = pickle.load(f)
+            os.utime(path)
+        except FileNotFoundError:
+            self.misses += 1
+            return None
+        except Exception as e:
+            logger.warning("Discarding unreadable parse cache entry %s: %s", path, e)
+            self.discard(content_hash)
+            self.misses += 1
+            return None
+        # Entries whose spilled chunks or sheets were removed from disk can no longer be used
+        missing = [p for p in parsed.get("spill_files", ()) if not os.path.exists(p)]
+        if missing:
+            logger.warning("Discarding parse cache entry %s: spill file %s is gone", path, missing[0])
+            self.discard(content_hash)
+            self.misses += 1
+            return None
+        self.hits += 1
+        return parsed
+
+    def put(self, content_hash, parsed):
+        """Store a parse result, then evict least recently used entries over the size cap.
+        Returns whether it was stored; the spill files of a result that was not are left alone."""
+        os.makedirs(self.directory, exist_ok=True)
+        path = self._path(content_hash)
+        temp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        try:
+            with open(temp_path, 'wb') as f:
+                pickle.dump(parsed, f, protocol=pickle.HIGHEST_PROTOCOL)
+            size = os.path.getsize(temp_path) + sum(os.path.getsize(p) for p in parsed.get("spill_files", ()))
+            if size > self.max_bytes:
+                logger.info("Not caching parse result %s of %s bytes, over the cache size", content_hash[:12], size)
+                os.remove(temp_path)
+                return False
+            os.replace(temp_path, path)
+        except Exception as e:
+            logger.warning("Error writing parse cache entry %s: %s", path, e)
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+            return False
+        self._evict(keep=content_hash)
+        return True
+
+    def discard(self, content_hash):
+        """Delete the entry of a content hash and its spill files; False when there was no entry"""
+        _remove_files(path for path in glob.glob(os.path.join(self.spill_dir, f"{content_hash}*"))
+                      if not path.endswith('.tmp'))
+        try:
+            os.remove(self._path(content_hash))
+            return True
+        except FileNotFoundError:
+            return False
+
+    def _spill_files(self):
+        """content hash -> (total size, paths) of the spill files named after it"""
+        spills = {}
+        if not os.path.isdir(self.spill_dir):
+            return spills
+        for entry in os.scandir(self.spill_dir):
+            # Files still being written end in .tmp and belong to a running extraction
+            content_hash = entry.name[:64]
+            if entry.name.endswith('.tmp') or len(content_hash) < 64:
+                continue
+            try:
+                size = entry.stat().st_size
+            except FileNotFoundError:
+                continue
+            total, paths = spills.setdefault(content_hash, (0, []))
+            paths.append(entry.path)
+            spills[content_hash] = (total + size, paths)
+        return spills
+
+    def _evict(self, keep=None):
+        """Delete least recently used entries until the cache fits, except the entry of keep"""
+        entries = []
+        total = 0
+        for entry in os.scandir(self.directory):
+            if not entry.name.endswith('.pkl'):
+                continue
+            try:
+                stat = entry.stat()
+            except FileNotFoundError:
+                continue
+            content_hash = entry.name.split('-v', 1)[0]
+            entries.append((stat.st_mtime, stat.st_size, entry.path, content_hash))
+            total += stat.st_size
+        spills = self._spill_files()
+        # Spill files of hashes without an entry are not the cache's to delete
+        spills = {content_hash: spills[content_hash] for _, _, _, content_hash in entries if content_hash in spills}
+        total += sum(size for size, _ in spills.values())
+
+        if total <= self.max_bytes:
+            return
+        entries.sort()
+        for _, size, path, content_hash in entries:
+            if total <= self.max_bytes:
+                break
+            if content_hash == keep:
+                continue
+            if _remove_files([path]):
+                total -= size
+            spill_size, spill_paths = spills.pop(content_hash, (0, ()))
+            _remove_files(spill_paths)
+            total -= spill_size
+
+    def stats(self):
+        return {"hits": self.hits, "misses": self.misses}
+
+
+def _remove_files(paths):
+    """Delete files that may already be gone; returns how many were deleted"""
+    removed = 0
+    for path in paths:
+        try:
+            os.remove(path)
+            removed += 1
+        except FileNotFoundError:
+            pass
+    return removed
+
+
+parse_cache = ParseCache()
+
+
+def _collect_metrics():
+    # Lookups made by ingestion workers are counted in their own processes
+    stats = parse_cache.stats()
+    return [("chatbot_parse_cache_lookups_total", "counter", "Parse cache lookups of the serving process by result",
+             [({"result": "hit"}, stats["hits"]), ({"result": "miss"}, stats["misses"])])]
+
+
+metrics.register_collector(_collect_metrics)
@@ -0,0 +1,116 @@
+import os
+import logging
+import signal
+import threading
+import contextlib
+from concurrent.futures import ProcessPoolExecutor
+
+import pdfplumber
+
+logger = logging.getLogger(__name__)
+
+# Page-streaming PDF text extraction. Large PDFs are split into page ranges
+# that a process pool extracts in parallel; pages are yielded in order as
+# soon as their range is done, so callers can split and index them without
+# waiting for the whole document. Empty or unreadable pages yield "", a page
+# that takes longer than PDF_PAGE_TIMEOUT_SECONDS is skipped, and files over
+# the size cap are rejected while pages beyond the page cap are ignored.
+
+PDF_MAX_BYTES = int(float(os.getenv("PDF_MAX_MB", "100")) * 1024 * 1024)
+PDF_MAX_PAGES = int(os.getenv("PDF_MAX_PAGES", "1000"))
+PDF_PAGE_TIMEOUT_SECONDS = float(os.getenv("PDF_PAGE_TIMEOUT_SECONDS", "30"))
+PDF_WORKERS = int(os.getenv("PDF_WORKERS", str(min(4, os.cpu_count() or 1))))
+# Pages extracted per pool task, and the page count below which no pool is started
+PDF_PAGES_PER_TASK = 16
+PDF_PARALLEL_MIN_PAGES = 32
+
+
+class PageTimeout(Exception):
+    pass
+
+
+def _raise_page_timeout(signum, frame):
+    raise PageTimeout()
+
+
+@contextlib.contextmanager
+def _page_deadline(seconds):
+    """Interrupt the block after `seconds` using SIGALRM, where that is possible.
+
+    Signals only reach the main thread, so in threads (and on platforms
+    without SIGALRM) the block runs without a timeout.
+    """
+    usable = (seconds > 0 and hasattr(signal, "SIGALRM")
+              and threading.current_thread() is threading.main_thread())
+    if not usable:
+        yield
+        return
+    previous = signal.signal(signal.SIGALRM, _raise_page_timeout)
+    signal.setitimer(signal.ITIMER_REAL, seconds)
+    try:
+        yield
+    finally:
+        signal.setitimer(signal.ITIMER_REAL, 0)
+        signal.signal(signal.SIGALRM, previous)
+
+
+def extract_page_range(file_path, start, end, page_timeout=PDF_PAGE_TIMEOUT_SECONDS):
+    """[(page_number, text)] for pages start..end-1 (page numbers start at 1)"""
+    pages = []
+    with pdfplumber.open(file_path) as pdf:
+        for index in range(start, end):
+            page = pdf.pages[index]
+            try:
+                with _page_deadline(page_timeout):
+                    text = page.extract_text() or ""
+            except PageTimeout:
+                logger.warning("Skipping page %s of %s: no text after %ss", index + 1, file_path, page_timeout)
+                text = ""
+            except Exception as e:
+                logger.warning("Skipping page %s of %s: %s", index + 1, file_path, e)
+                text = ""
+            finally:
+                # Drop the parsed page objects; long documents otherwise keep every page in memory
+                page.flush_cache()
+            pages.append((index + 1, text))
+    return pages
+
+
+def page_count(file_path):
+    with pdfplumber.open(file_path) as pdf:
+        return len(pdf.pages)
+
+
+def iter_pdf_pages(file_path, workers=PDF_WORKERS, max_pages=PDF_MAX_PAGES, page_timeout=PDF_PAGE_TIMEOUT_SECONDS):
+    """Yield (page_number, text) for the pages of a PDF, in page order"""
+    size = os.path.getsize(file_path)
+    if size > PDF_MAX_BYTES:
+        raise ValueError(f"PDF file is too large: {size / (1024 * 1024):.1f} MB "
+                         f"(limit {PDF_MAX_BYTES / (1024 * 1024):.0f} MB)")
+
+    total = page_count(file_path)
+    if total > max_pages:
+        logger.warning("PDF has %s pages, only the first %s are extracted", total, max_pages)
+        total = max_pages
+
+    if workers <= 1 or total < PDF_PARALLEL_MIN_PAGES:
+        for start in range(0, total, PDF_PAGES_PER_TASK):
+            yield from extract_page_range(file_path, start, min(start + PDF_PAGES_PER_TASK, total), page_timeout)
+        return
+
+    ranges = [(start, min(start + PDF_PAGES_PER_TASK, total)) for start in range(0, total, PDF_PAGES_PER_TASK)]
+    logger.info("Extracting %s PDF pages in %s ranges with %s processes", total, len(ranges), workers)
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        # A bounded window of submitted ranges keeps finished-but-unconsumed pages few
+        window = workers * 2
+        futures = [pool.submit(extract_page_range, file_path, start, end, page_timeout)
+                   for start, end in ranges[:window]]
+        next_range = len(futures)
+        for i in range(len(ranges)):
+            pages = futures[i].result()
+            futures[i] = None
+            if next_range < len(ranges):
+                start, end = ranges[next_range]
+                futures.append(pool.submit(extract_page_range, file_path, start, end, page_timeout))
+                next_range += 1
+            yield from pages
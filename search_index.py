@@ -0,0 +1,130 @@
+import re
+import math
+import heapq
+from array import array
+
+# Tokenizer shared by the lexical index. Documents and questions arrive in both
+# English and Indonesian, so stopwords for both languages are dropped and the
+# most common Indonesian clitics (-nya, -lah, -kah, ...) are stripped so that
+# "laporannya" and "laporan" land on the same term.
+TOKEN_PATTERN = re.compile(r"[^\W_]+", re.UNICODE)
+
+STOPWORDS = frozenset("""
+a an and are as at be s t been but by can could did do does for from had has have how i if in into is it
+its me my of on or our so than that the their them then there these they this those to was we were
+what when where which who whom why will with would you your
+ada adalah agar akan aku anda apa apakah atau bagaimana bagi bahwa banyak belum berapa bisa dalam
+dan dari dengan di dia ini itu jika juga kami kamu karena ke kenapa kita mana masih mereka oleh
+pada para saja sama saya sebagai sedang sejak sudah supaya tapi tentang tersebut untuk yaitu yang
+""".split())
+
+INDONESIAN_SUFFIXES = ("nya", "lah", "kah", "pun", "tah", "ku", "mu")
+
+
+def tokenize(text):
+    """Split text into lowercase index terms"""
+    terms = []
+    for token in TOKEN_PATTERN.findall(text.lower()):
+        if token in STOPWORDS:
+            continue
+        if len(token) > 5:
+            for suffix in INDONESIAN_SUFFIXES:
+                if token.endswith(suffix):
+                    token = token[:-len(suffix)]
+                    break
+        terms.append(token)
+    return terms
+
+
+class InvertedIndex:
+    """Incremental BM25 index over stored documents.
+
+    Postings are kept per term in two parallel unsigned int arrays (internal
+    document number and term frequency) and document lengths in a third, so
+    the index stays compact even for thousands of chunks.
+    """
+
+    def __init__(self, k1=1.5, b=0.75):
+        self.k1 = k1
+        self.b = b
+        self.clear()
+
+    def clear(self):
+        self.vocabulary = {}
+        self.postings_docs = []
+        self.postings_freqs = []
+        self.doc_lengths = array('I')
+        self.doc_ids = []
+        self.doc_numbers = {}
+        self.deleted = set()
+        self.total_length = 0
+
+    def __len__(self):
+        return len(self.doc_ids) - len(self.deleted)
+
+    def add(self, doc_id, text):
+        """Index a document, replacing any previous version with the same id"""
+        if doc_id in self.doc_numbers:
+            self.remove(doc_id)
+
+        doc_number = len(self.doc_ids)
+        self.doc_ids.append(doc_id)
+        self.doc_numbers[doc_id] = doc_number
+
+        terms = tokenize(text)
+        frequencies = {}
+        for term in terms:
+            frequencies[term] = frequencies.get(term, 0) + 1
+
+        for term, frequency in frequencies.items():
+            term_id = self.vocabulary.get(term)
+            if term_id is None:
+                term_id = len(self.postings_docs)
+                self.vocabulary[term] = term_id
+                self.postings_docs.append(array('I'))
+                self.postings_freqs.append(array('I'))
+            self.postings_docs[term_id].append(doc_number)
+            self.postings_freqs[term_id].append(frequency)
+
+        self.doc_lengths.append(len(terms))
+        self.total_length += len(terms)
+
+    def remove(self, doc_id):
+        """Hide a document from search results"""
+        doc_number = self.doc_numbers.pop(doc_id, None)
+        if doc_number is None:
+            return False
+        self.deleted.add(doc_number)
+        self.total_length -= self.doc_lengths[doc_number]
+        return True
+
+    def search(self, query, top_k=5):
+        """Return up to top_k (doc_id, score) pairs ranked by BM25"""
+        live_docs = len(self)
+        if live_docs == 0 or top_k <= 0:
+            return []
+
+        avg_length = (self.total_length / live_docs) or 1.0
+        k1, b = self.k1, self.b
+        doc_lengths = self.doc_lengths
+        deleted = self.deleted
+        scores = {}
+
+        for term in set(tokenize(query)):
+            term_id = self.vocabulary.get(term)
+            if term_id is None:
+                continue
+            docs = self.postings_docs[term_id]
+            freqs = self.postings_freqs[term_id]
+            doc_freq = len(docs) - (sum(1 for d in docs if d in deleted) if deleted else 0)
+            if doc_freq <= 0:
+                continue
+            idf = math.log(1 + (live_docs - doc_freq + 0.5) / (doc_freq + 0.5))
+            for doc_number, frequency in zip(docs, freqs):
+                if doc_number in deleted:
+                    continue
+                norm = k1 * (1 - b + b * doc_lengths[doc_number] / avg_length)
+                scores[doc_number] = scores.get(doc_number, 0.0) + idf * frequency * (k1 + 1) / (frequency + norm)
+
+        best = heapq.nlargest(top_k, scores.items(), key=lambda item: item[1])
+        return [(self.doc_ids[doc_number], score) for doc_number, score in best]
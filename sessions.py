@@ -0,0 +1,244 @@
+import os
+import shutil
+import logging
+import time
+import threading
+import contextvars
+from collections import OrderedDict
+
+import metrics
+from document_store import DocumentStore
+from shared_store import create_backend, STORE_BACKEND
+from snapshot import snapshots
+from text_pipeline import session_spill_dir
+
+logger = logging.getLogger(__name__)
+
+# Per-user state: each browser session gets its own document store and
+# conversation history, so one user's upload never replaces another user's
+# context. Idle sessions are evicted least recently used first once the
+# process holds too many of them or too much document data. With a shared
+# store backend (see shared_store.py) documents and history are also kept
+# where every worker process can read them, and a session's store is
+# reloaded whenever another worker published a newer one. Every published
+# store is also written as a snapshot (see snapshot.py), from which a session
+# gets its documents back after a restart or eviction.
+
+SESSION_MAX_COUNT = int(os.getenv("SESSION_MAX_COUNT", "1000"))
+SESSION_MAX_MEMORY_BYTES = int(os.getenv("SESSION_MAX_MEMORY_MB", "1024")) * 1024 * 1024
+SESSION_IDLE_SECONDS = int(os.getenv("SESSION_IDLE_SECONDS", "3600"))
+
+DEFAULT_SESSION_ID = "default"
+
+# Number of messages kept in the conversation history (10 exchanges)
+HISTORY_MAX_MESSAGES = 20
+
+
+class Session:
+    """Document store and conversation history of one user"""
+
+    def __init__(self, session_id, backend=None):
+        self.session_id = session_id
+        self.backend = backend or create_backend("memory")
+        self._store = DocumentStore()
+        # Version of the shared store that _store was loaded from or published as
+        self.version = 0
+        # Whether the snapshot of the session was looked for
+        self.restored = False
+        self.history = []
+        self.lock = threading.Lock()
+        self.load_lock = threading.Lock()
+        self.last_used = time.time()
+        self.memory_bytes = 0
+
+    @property
+    def store(self):
+        if self.backend.shared:
+            self._refresh()
+        if not self.restored:
+            self._restore()
+        return self._store
+
+    def _restore(self):
+        """Load the snapshot written before a restart or eviction into a new session.
+
+        With a shared backend the snapshot is only used when the backend has
+        no store for the session (it was pruned, or the database is new). It
+        is kept as version 0, so the next store a worker publishes replaces it.
+        """
+        with self.load_lock:
+            if self.restored:
+                return
+            if not self.version:
+                loaded = snapshots.load(self.session_id)
+                if loaded is not None:
+                    self._swap(loaded[1], 0 if self.backend.shared else loaded[0])
+            self.restored = True
+
+    def _refresh(self):
+        """Load the shared store when another worker published a newer version"""
+        if self.backend.version(self.session_id) == self.version:
+            return
+        # One thread loads; the others wait and then see the loaded version
+        with self.load_lock:
+            version = self.backend.version(self.session_id)
+            if version == self.version:
+                return
+            # The snapshot of the same version, when there is one, is mapped instead of rebuilt
+            loaded = (snapshots.load(self.session_id, version) if version else None) or \
+                self.backend.load(self.session_id)
+            if loaded is None:
+                # Pruned (or never published): the session starts over without documents
+                version, store = 0, DocumentStore()
+            else:
+                version, store = loaded
+                logger.info("Loaded store version %s of session %s (%s documents)",
+                            version, self.session_id, len(store))
+            self._swap(store, version)
+
+    def _swap(self, store, version):
+        with self.lock:
+            old_store = self._store
+            self._store = store
+            self.version = version
+            self.memory_bytes = store.memory_usage()
+        if old_store is not store:
+            old_store.close()
+
+    def replace_store(self, store):
+        """Swap in a fully built store; readers holding the old one are unaffected"""
+        with self.load_lock:
+            version = self.backend.publish(self.session_id, store)
+            self._swap(store, version)
+            self.restored = True
+        snapshots.save(self.session_id, store, version)
+
+    def close(self):
+        """Release the local copy of the store; shared data stays in the backend"""
+        self._store.close()
+
+    def recent_history(self, limit):
+        if self.backend.shared:
+            return self.backend.history(self.session_id, limit)
+        with self.lock:
+            return list(self.history[-limit:]) if limit > 0 else []
+
+    def record_exchange(self, query, answer):
+        messages = [{"role": "user", "content": query}, {"role": "assistant", "content": answer}]
+        if self.backend.shared:
+            return self.backend.append_history(self.session_id, messages, HISTORY_MAX_MESSAGES)
+        with self.lock:
+            self.history.extend(messages)
+            # Limit history size to prevent context overflow
+            if len(self.history) > HISTORY_MAX_MESSAGES:
+                self.history = self.history[-HISTORY_MAX_MESSAGES:]
+            return len(self.history)
+
+
+class SessionManager:
+    """LRU map of session id to Session with count, memory and idle limits"""
+
+    def __init__(self, max_sessions=SESSION_MAX_COUNT, max_memory_bytes=SESSION_MAX_MEMORY_BYTES,
+                 idle_seconds=SESSION_IDLE_SECONDS, backend=None):
+        self.backend = backend or create_backend("memory")
+        self.max_sessions = max_sessions
+        self.max_memory_bytes = max_memory_bytes
+        self.idle_seconds = idle_seconds
+        self.sessions = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, session_id):
+        """Return the session for an id, creating it if needed"""
+        with self.lock:
+            session = self.sessions.get(session_id)
+            if session is None:
+                session = Session(session_id, self.backend)
+                self.sessions[session_id] = session
+            else:
+                self.sessions.move_to_end(session_id)
+            session.last_used = time.time()
+            evicted = self._evict_locked(keep=session_id)
+        for old in evicted:
+            logger.info("Evicted idle session %s", old.session_id)
+            old.close()
+        return session
+
+    def update_memory(self, session):
+        """Refresh a session's memory estimate after its store changed, evicting others if needed"""
+        session.memory_bytes = session.store.memory_usage()
+        with self.lock:
+            evicted = self._evict_locked(keep=session.session_id)
+        for old in evicted:
+            logger.info("Evicted idle session %s to stay under the memory cap", old.session_id)
+            old.close()
+
+    def _evict_locked(self, keep):
+        evicted = []
+        now = time.time()
+        total_memory = sum(session.memory_bytes for session in self.sessions.values())
+        for session_id in list(self.sessions):
+            if session_id == keep:
+                continue
+            session = self.sessions[session_id]
+            over_count = len(self.sessions) > self.max_sessions
+            over_memory = total_memory > self.max_memory_bytes
+            idle = now - session.last_used > self.idle_seconds
+            if not (over_count or over_memory or idle):
+                # Sessions are in LRU order, so later ones are all more recent
+                break
+            del self.sessions[session_id]
+            total_memory -= session.memory_bytes
+            evicted.append(session)
+        return evicted
+
+    def drop(self, session_id):
+        """Forget a session's documents: in this process, in the shared backend and on disk"""
+        with self.lock:
+            session = self.sessions.pop(session_id, None)
+        if session is not None:
+            session.close()
+        self.backend.remove(session_id)
+        snapshots.remove(session_id)
+        # Nothing reads the session's sheets any more
+        shutil.rmtree(session_spill_dir(session_id), ignore_errors=True)
+        return session is not None
+
+    def stats(self):
+        with self.lock:
+            return {
+                "sessions": len(self.sessions),
+                "memory_bytes": sum(session.memory_bytes for session in self.sessions.values()),
+            }
+
+
+session_manager = SessionManager(backend=create_backend(STORE_BACKEND, idle_seconds=SESSION_IDLE_SECONDS))
+
+
+def _collect_metrics():
+    stats = session_manager.stats()
+    families = [
+        ("chatbot_sessions", "gauge", "Sessions held in memory", [({}, stats["sessions"])]),
+        ("chatbot_session_memory_bytes", "gauge", "Estimated document memory of all sessions",
+         [({}, stats["memory_bytes"])]),
+    ]
+    if session_manager.backend.shared:
+        backend_stats = session_manager.backend.stats()
+        families.append(("chatbot_shared_store_operations_total", "counter",
+                         "Stores published to and loaded from the shared backend by this worker",
+                         [({"operation": "publish"}, backend_stats["publishes"]),
+                          ({"operation": "load"}, backend_stats["loads"])]))
+    return families
+
+
+metrics.register_collector(_collect_metrics)
+
+# Session used by module-level helpers (add_document, get_relevant_documents, ...)
+_current_session_id = contextvars.ContextVar("current_session_id", default=DEFAULT_SESSION_ID)
+
+
+def set_current_session(session_id):
+    _current_session_id.set(session_id)
+
+
+def current_session():
+    return session_manager.get(_current_session_id.get())
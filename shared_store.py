@@ -0,0 +1,310 @@
+import os
+import json
+import time
+import pickle
+import sqlite3
+import logging
+import threading
+
+import numpy as np
+
+from metrics import stage_timer
+from document_store import DocumentStore
+
+logger = logging.getLogger(__name__)
+
+# Where session documents, conversation history and ingestion jobs are kept
+# so that every worker process can see them. The "memory" backend keeps them
+# only in the process that created them, which is all a single worker needs.
+# The "sqlite" backend also writes them to one SQLite database in WAL mode
+# that all workers on the node open: readers never block each other or the
+# writer, and a finished upload is published in a single transaction.
+#
+# Each session row carries a version that is bumped whenever its documents
+# are replaced. Workers check it on access (a PRAGMA data_version read tells
+# them when any other connection committed, so unchanged databases cost no
+# query) and rebuild their in-memory copy of a store whose version moved.
+# The copy is rebuilt from the stored rows and vectors without re-embedding,
+# and search keeps running on the in-process BM25 and vector indexes, so
+# every worker ranks exactly as the one that ingested the document.
+#
+# Sessions nobody has read or written for idle_seconds are pruned when a
+# store is published. Reads mark a session used at most every
+# STORE_TOUCH_SECONDS per connection, so checking versions stays a read.
+
+STORE_BACKEND = os.getenv("STORE_BACKEND", "memory")
+STORE_DB_PATH = os.getenv("STORE_DB_PATH", os.path.join("cache", "store.db"))
+STORE_BUSY_TIMEOUT_SECONDS = 30
+STORE_TOUCH_SECONDS = 60
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS sessions (
+    session_id TEXT PRIMARY KEY,
+    version INTEGER NOT NULL,
+    last_used REAL NOT NULL,
+    excel_data BLOB,
+    vector_ids TEXT,
+    vectors BLOB
+);
+CREATE TABLE IF NOT EXISTS documents (
+    session_id TEXT NOT NULL,
+    position INTEGER NOT NULL,
+    doc_id TEXT NOT NULL,
+    content TEXT NOT NULL,
+    metadata TEXT NOT NULL,
+    timestamp REAL NOT NULL,
+    indexed INTEGER NOT NULL,
+    PRIMARY KEY (session_id, position)
+);
+CREATE TABLE IF NOT EXISTS history (
+    session_id TEXT NOT NULL,
+    position INTEGER NOT NULL,
+    role TEXT NOT NULL,
+    content TEXT NOT NULL,
+    PRIMARY KEY (session_id, position)
+);
+CREATE TABLE IF NOT EXISTS jobs (
+    job_id TEXT PRIMARY KEY,
+    record TEXT NOT NULL,
+    updated REAL NOT NULL
+);
+"""
+
+
+class MemoryBackend:
+    """Stores, history and jobs live only in the process that created them"""
+
+    shared = False
+
+    def version(self, session_id):
+        return 0
+
+    def publish(self, session_id, store):
+        return 0
+
+    def load(self, session_id):
+        return None
+
+    def remove(self, session_id):
+        pass
+
+    def save_job(self, job):
+        pass
+
+    def load_job(self, job_id):
+        return None
+
+
+class SQLiteBackend:
+    """Session data in a SQLite database shared by the worker processes of a node.
+
+    Every thread has its own connection. Versions read on a connection are
+    remembered until PRAGMA data_version reports a commit by another
+    connection.
+    """
+
+    shared = True
+
+    def __init__(self, path=STORE_DB_PATH, idle_seconds=3600):
+        self.path = path
+        self.idle_seconds = idle_seconds
+        self.loads = 0
+        self.publishes = 0
+        self._local = threading.local()
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        connection = self._connection()
+        connection.executescript(SCHEMA)
+
+    def _connection(self):
+        local = self._local
+        connection = getattr(local, "connection", None)
+        if connection is None:
+            # Autocommit mode; transactions are opened explicitly below
+            connection = sqlite3.connect(self.path, timeout=STORE_BUSY_TIMEOUT_SECONDS, isolation_level=None)
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("PRAGMA synchronous=NORMAL")
+            local.connection = connection
+            local.data_version = None
+            local.versions = {}
+            local.touched = {}
+        return connection
+
+    def _transaction(self, connection, body, immediate=False):
+        connection.execute("BEGIN IMMEDIATE" if immediate else "BEGIN")
+        try:
+            result = body()
+        except BaseException:
+            connection.execute("ROLLBACK")
+            raise
+        connection.execute("COMMIT")
+        return result
+
+    def version(self, session_id):
+        """Version of the session's published store, 0 when it has none"""
+        connection = self._connection()
+        local = self._local
+        data_version = connection.execute("PRAGMA data_version").fetchone()[0]
+        if data_version != local.data_version or len(local.versions) > 10000:
+            local.data_version = data_version
+            local.versions = {}
+        version = local.versions.get(session_id)
+        if version is None:
+            row = connection.execute("SELECT version FROM sessions WHERE session_id = ?", (session_id,)).fetchone()
+            version = local.versions[session_id] = row[0] if row else 0
+        self._touch(connection, session_id)
+        return version
+
+    def _touch(self, connection, session_id):
+        """Mark a session used so that it is not pruned while it is being read"""
+        now = time.time()
+        touched = self._local.touched
+        if now - touched.get(session_id, 0) < min(STORE_TOUCH_SECONDS, self.idle_seconds / 4):
+            return
+        if len(touched) > 10000:
+            touched.clear()
+        touched[session_id] = now
+        try:
+            connection.execute("UPDATE sessions SET last_used = ? WHERE session_id = ? AND last_used < ?",
+                               (now, session_id, now))
+        except sqlite3.OperationalError as e:
+            # A busy database only delays the mark; the session is read either way
+            logger.warning("Error marking session %s used: %s", session_id, e)
+
+    def publish(self, session_id, store):
+        """Replace the session's documents with the contents of a store; returns the new version"""
+        connection = self._connection()
+        excel_data = pickle.dumps(store.excel_data, protocol=pickle.HIGHEST_PROTOCOL) if store.excel_data else None
+        vector_ids = vectors = None
+        if store.vector_index is not None and len(store.vector_index) > 0:
+            ids, matrix = store.vector_index.live_vectors()
+            vector_ids, vectors = json.dumps(ids), matrix.tobytes()
+        rows = ((session_id, position, doc_id, text, json.dumps(metadata, default=str), timestamp, int(indexed))
+                for position, (doc_id, text, metadata, timestamp, indexed) in enumerate(store.rows()))
+
+        def write():
+            now = time.time()
+            connection.execute("DELETE FROM documents WHERE session_id = ?", (session_id,))
+            connection.executemany("INSERT INTO documents VALUES (?, ?, ?, ?, ?, ?, ?)", rows)
+            # Versions come from the clock so that a session pruned and uploaded to
+            # again never repeats a version a worker still holds
+            connection.execute(
+                "INSERT INTO sessions VALUES (?, ?, ?, ?, ?, ?) ON CONFLICT (session_id) DO UPDATE SET "
+                "version = MAX(excluded.version, version + 1), last_used = excluded.last_used, "
+                "excel_data = excluded.excel_data, vector_ids = excluded.vector_ids, vectors = excluded.vectors",
+                (session_id, time.time_ns(), now, excel_data, vector_ids, vectors))
+            self._prune(connection, now)
+            return connection.execute("SELECT version FROM sessions WHERE session_id = ?", (session_id,)).fetchone()[0]
+
+        with stage_timer("store_publish"):
+            version = self._transaction(connection, write, immediate=True)
+        # Commits on this connection do not change its data_version
+        self._local.versions[session_id] = version
+        self.publishes += 1
+        return version
+
+    def load(self, session_id):
+        """(version, DocumentStore) of the session's published store, or None"""
+        connection = self._connection()
+
+        def read():
+            row = connection.execute("SELECT version, excel_data, vector_ids, vectors FROM sessions "
+                                     "WHERE session_id = ?", (session_id,)).fetchone()
+            if row is None or row[0] == 0:
+                return None
+            version, excel_data, vector_ids, vectors = row
+            store = DocumentStore()
+            for doc_id, content, metadata, timestamp, indexed in connection.execute(
+                    "SELECT doc_id, content, metadata, timestamp, indexed FROM documents "
+                    "WHERE session_id = ? ORDER BY position", (session_id,)):
+                store.add(doc_id, content, json.loads(metadata), index=bool(indexed), timestamp=timestamp)
+            if excel_data is not None:
+                store.set_excel_data(pickle.loads(excel_data))
+            if vector_ids and store.vector_index is not None:
+                ids = json.loads(vector_ids)
+                matrix = np.frombuffer(vectors, dtype=np.float32)
+                if matrix.size == len(ids) * store.vector_index.dim:
+                    store.load_vectors(ids, matrix.reshape(len(ids), -1))
+                else:
+                    logger.warning("Stored vectors of session %s do not match the embedder, embedding again",
+                                   session_id)
+                    documents = store.documents
+                    store.add_vectors(ids, [documents[doc_id] for doc_id in ids])
+            return version, store
+
+        with stage_timer("store_load"):
+            loaded = self._transaction(connection, read)
+        self.loads += 1
+        return loaded
+
+    def remove(self, session_id):
+        """Delete the session's published store; workers holding it load an empty one"""
+        connection = self._connection()
+
+        def write():
+            connection.execute("DELETE FROM documents WHERE session_id = ?", (session_id,))
+            connection.execute("UPDATE sessions SET version = 0, excel_data = NULL, vector_ids = NULL, vectors = NULL "
+                               "WHERE session_id = ?", (session_id,))
+
+        self._transaction(connection, write, immediate=True)
+        self._local.versions[session_id] = 0
+
+    def history(self, session_id, limit):
+        """Last limit messages of the session's conversation, oldest first"""
+        if limit <= 0:
+            return []
+        rows = self._connection().execute(
+            "SELECT role, content FROM history WHERE session_id = ? ORDER BY position DESC LIMIT ?",
+            (session_id, limit)).fetchall()
+        return [{"role": role, "content": content} for role, content in reversed(rows)]
+
+    def append_history(self, session_id, messages, max_messages):
+        """Append messages, keep the newest max_messages and return how many are kept"""
+        connection = self._connection()
+
+        def write():
+            now = time.time()
+            start = connection.execute("SELECT COALESCE(MAX(position) + 1, 0) FROM history WHERE session_id = ?",
+                                       (session_id,)).fetchone()[0]
+            connection.executemany("INSERT INTO history VALUES (?, ?, ?, ?)",
+                                   [(session_id, start + i, message["role"], message["content"])
+                                    for i, message in enumerate(messages)])
+            end = start + len(messages)
+            connection.execute("DELETE FROM history WHERE session_id = ? AND position < ?",
+                               (session_id, end - max_messages))
+            connection.execute("INSERT INTO sessions (session_id, version, last_used) VALUES (?, 0, ?) "
+                               "ON CONFLICT (session_id) DO UPDATE SET last_used = excluded.last_used",
+                               (session_id, now))
+            return connection.execute("SELECT COUNT(*) FROM history WHERE session_id = ?",
+                                      (session_id,)).fetchone()[0]
+
+        return self._transaction(connection, write, immediate=True)
+
+    def save_job(self, job):
+        self._connection().execute("INSERT OR REPLACE INTO jobs VALUES (?, ?, ?)",
+                                   (job["job_id"], json.dumps(job, default=str), time.time()))
+
+    def load_job(self, job_id):
+        row = self._connection().execute("SELECT record FROM jobs WHERE job_id = ?", (job_id,)).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def _prune(self, connection, now):
+        """Drop sessions not read or written for idle_seconds, as workers evict them from memory"""
+        cutoff = now - self.idle_seconds
+        idle = "SELECT session_id FROM sessions WHERE last_used < ?"
+        connection.execute(f"DELETE FROM documents WHERE session_id IN ({idle})", (cutoff,))
+        connection.execute(f"DELETE FROM history WHERE session_id IN ({idle})", (cutoff,))
+        connection.execute("DELETE FROM sessions WHERE last_used < ?", (cutoff,))
+        connection.execute("DELETE FROM jobs WHERE updated < ?", (cutoff,))
+
+    def stats(self):
+        return {"loads": self.loads, "publishes": self.publishes}
+
+
+def create_backend(name=STORE_BACKEND, idle_seconds=3600):
+    if name == "memory":
+        return MemoryBackend()
+    if name == "sqlite":
+        return SQLiteBackend(STORE_DB_PATH, idle_seconds)
+    raise ValueError(f"Unknown store backend: {name}")
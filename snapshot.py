@@ -0,0 +1,348 @@
+import os
+import sys
+import json
+import mmap
+import time
+import zlib
+import pickle
+import struct
+import logging
+from array import array
+
+import numpy as np
+
+from metrics import stage_timer
+from document_store import DocumentStore, EMBEDDING_BACKEND
+from text_table import MappedTextTable
+
+logger = logging.getLogger(__name__)
+
+# On-disk snapshots of session stores, so a restarted worker answers from the
+# documents uploaded before the restart instead of parsing them again. Every
+# published store is written to SNAPSHOT_DIR as one file:
+#
+#   header   b"CHATSNAP", format version (uint32)
+#   sections row arrays, UTF-8 text, BM25 postings, vectors and pickled
+#            sheets, each 64-byte aligned
+#   manifest JSON: per section offset, length, item format and CRC32, plus
+#            the store version and content version
+#   footer   manifest offset (uint64), manifest length and CRC32 (uint32),
+#            b"CHATSNAP"
+#
+# Nothing is read at startup. A session's snapshot is opened on first access
+# and memory-mapped: the checksum of every section (text included) is
+# verified, so a corrupt file is caught at load rather than mid-query, then
+# row arrays, postings and vectors are used in place and chunk text stays in
+# the page cache, decoded row by row when read. A snapshot that fails any
+# check is deleted and the session starts empty. The first write to a loaded
+# store copies it into mutable tables (DocumentStore._writable).
+
+SNAPSHOT_DIR = os.getenv("SNAPSHOT_DIR", os.path.join("cache", "snapshots"))
+SNAPSHOT_FORMAT_VERSION = 1
+SNAPSHOT_MAGIC = b"CHATSNAP"
+SNAPSHOT_ALIGNMENT = 64
+
+HEADER = struct.Struct("<8sI")
+FOOTER = struct.Struct("<QII8s")
+
+
+class SnapshotError(Exception):
+    """Raised when a snapshot file is truncated, corrupt or of another format"""
+
+
+def _byte_offsets(text, positions):
+    """Character position -> UTF-8 byte offset for sorted positions, in one pass over text"""
+    offsets = {}
+    previous = count = 0
+    for position in positions:
+        count += len(text[previous:position].encode("utf-8", "surrogatepass"))
+        offsets[position] = count
+        previous = position
+    return offsets
+
+
+def _text_section(texts):
+    """(encoded parent buffers, byte starts, byte ends) of a TextTable"""
+    rows_by_buffer = {}
+    for row, buffer_index in enumerate(texts.buffer_index):
+        rows_by_buffer.setdefault(buffer_index, []).append(row)
+    byte_starts = array("q", bytes(8 * len(texts.doc_ids)))
+    byte_ends = array("q", bytes(8 * len(texts.doc_ids)))
+    parts = []
+    base = 0
+    for buffer_index, buffer in enumerate(texts.buffers):
+        with texts.lock:
+            text = buffer.text
+        data = text.encode("utf-8", "surrogatepass")
+        rows = rows_by_buffer.get(buffer_index, ())
+        if len(data) == len(text):
+            # ASCII text: byte offsets are character offsets
+            for row in rows:
+                byte_starts[row] = base + texts.starts[row]
+                byte_ends[row] = base + texts.ends[row]
+        else:
+            positions = sorted({texts.starts[row] for row in rows} | {texts.ends[row] for row in rows})
+            offsets = _byte_offsets(text, positions)
+            for row in rows:
+                byte_starts[row] = base + offsets[texts.starts[row]]
+                byte_ends[row] = base + offsets[texts.ends[row]]
+        parts.append(data)
+        base += len(data)
+    return parts, byte_starts, byte_ends
+
+
+class _Writer:
+    def __init__(self, f):
+        self.f = f
+        self.sections = {}
+
+    def section(self, name, parts, item_format="B"):
+        padding = -self.f.tell() % SNAPSHOT_ALIGNMENT
+        self.f.write(b"\0" * padding)
+        offset = self.f.tell()
+        crc = 0
+        for part in parts:
+            crc = zlib.crc32(part, crc)
+            self.f.write(part)
+        self.sections[name] = {"offset": offset, "length": self.f.tell() - offset, "crc32": crc,
+                               "format": item_format}
+
+    def array(self, name, values):
+        self.section(name, [memoryview(values).cast("B")], values.typecode)
+
+    def json(self, name, value):
+        self.section(name, [json.dumps(value, default=str).encode("utf-8")])
+
+
+def write_snapshot(path, store, version=0):
+    """Write a store to path atomically"""
+    if isinstance(store.texts, MappedTextTable):
+        raise SnapshotError("Store was itself loaded from a snapshot")
+    temp_path = f"{path}.{os.getpid()}.tmp"
+    with stage_timer("snapshot_write"):
+        try:
+            _write(temp_path, store, version)
+        except BaseException:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+            raise
+        os.replace(temp_path, path)
+
+
+def _write(temp_path, store, version):
+    """Write the snapshot file: header, sections, manifest and footer"""
+    texts = store.texts
+    index = store.search_index
+    with open(temp_path, "wb") as f:
+        f.write(HEADER.pack(SNAPSHOT_MAGIC, SNAPSHOT_FORMAT_VERSION))
+        writer = _Writer(f)
+
+        parts, byte_starts, byte_ends = _text_section(texts)
+        writer.section("text", parts)
+        writer.json("doc_ids", texts.doc_ids)
+        writer.json("metas", texts.metas)
+        writer.array("byte_starts", byte_starts)
+        writer.array("byte_ends", byte_ends)
+        writer.array("chunk_numbers", texts.chunk_numbers)
+        writer.array("meta_index", texts.meta_index)
+        writer.array("timestamps", texts.timestamps)
+
+        # Postings of all terms back to back, with the offset of each term's run
+        offsets = array("q", [0])
+        for postings in index.postings_docs:
+            offsets.append(offsets[-1] + len(postings))
+        writer.json("index_terms", sorted(index.vocabulary, key=index.vocabulary.get))
+        writer.array("index_offsets", offsets)
+        writer.section("index_docs", [memoryview(p).cast("B") for p in index.postings_docs], "I")
+        writer.section("index_freqs", [memoryview(p).cast("B") for p in index.postings_freqs], "I")
+        writer.array("index_doc_lengths", index.doc_lengths)
+        writer.json("index_doc_ids", index.doc_ids)
+        writer.json("index_deleted", sorted(index.deleted))
+
+        vector_dim = None
+        if store.vector_index is not None and len(store.vector_index) > 0:
+            vector_ids, matrix = store.vector_index.live_vectors()
+            vector_dim = int(matrix.shape[1])
+            writer.json("vector_ids", vector_ids)
+            writer.section("vectors", [memoryview(np.ascontiguousarray(matrix)).cast("B")], "f")
+        if store.excel_data:
+            writer.section("excel_data", [pickle.dumps(store.excel_data, protocol=pickle.HIGHEST_PROTOCOL)])
+
+        manifest = json.dumps({
+            "store_version": version,
+            "content_version": store.content_version(),
+            "created": time.time(),
+            "byteorder": sys.byteorder,
+            "index": {"k1": index.k1, "b": index.b, "total_length": index.total_length},
+            "vectors": {"backend": EMBEDDING_BACKEND, "dim": vector_dim},
+            "sections": writer.sections,
+        }).encode("utf-8")
+        manifest_offset = f.tell()
+        f.write(manifest)
+        f.write(FOOTER.pack(manifest_offset, len(manifest), zlib.crc32(manifest), SNAPSHOT_MAGIC))
+        f.flush()
+        os.fsync(f.fileno())
+
+
+class _Reader:
+    """Memory-mapped snapshot file with checked access to its sections"""
+
+    def __init__(self, path):
+        with open(path, "rb") as f:
+            size = os.fstat(f.fileno()).st_size
+            if size < HEADER.size + FOOTER.size:
+                raise SnapshotError("File is truncated")
+            self.data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, format_version = HEADER.unpack_from(self.data, 0)
+        if magic != SNAPSHOT_MAGIC:
+            raise SnapshotError("Not a snapshot file")
+        if format_version != SNAPSHOT_FORMAT_VERSION:
+            raise SnapshotError(f"Snapshot format {format_version} is not supported")
+        manifest_offset, manifest_length, manifest_crc, magic = FOOTER.unpack_from(self.data, size - FOOTER.size)
+        manifest = self.data[manifest_offset:manifest_offset + manifest_length]
+        if magic != SNAPSHOT_MAGIC or len(manifest) != manifest_length or zlib.crc32(manifest) != manifest_crc:
+            raise SnapshotError("Manifest is truncated or corrupt")
+        self.manifest = json.loads(manifest)
+        if self.manifest["byteorder"] != sys.byteorder:
+            raise SnapshotError("Snapshot was written on a machine of another byte order")
+        self.view = memoryview(self.data)
+
+    def has(self, name):
+        return name in self.manifest["sections"]
+
+    def raw(self, name):
+        section = self.manifest["sections"][name]
+        view = self.view[section["offset"]:section["offset"] + section["length"]]
+        if len(view) != section["length"] or zlib.crc32(view) != section["crc32"]:
+            raise SnapshotError(f"Section {name} is corrupt")
+        return view
+
+    def array(self, name):
+        section = self.manifest["sections"][name]
+        return self.raw(name).cast(section["format"])
+
+    def json(self, name):
+        return json.loads(bytes(self.raw(name)))
+
+
+def snapshot_version(path):
+    """Store version recorded in a snapshot, reading only its manifest"""
+    return _Reader(path).manifest["store_version"]
+
+
+def read_snapshot(path):
+    """(store version, read-only DocumentStore) of a snapshot file"""
+    with stage_timer("snapshot_load"):
+        reader = _Reader(path)
+        manifest = reader.manifest
+        store = DocumentStore()
+        store.texts = MappedTextTable(
+            reader.raw("text"), reader.json("doc_ids"), reader.array("byte_starts"), reader.array("byte_ends"),
+            reader.array("chunk_numbers"), reader.array("meta_index"), reader.array("timestamps"),
+            reader.json("metas"))
+        store._content_digest = _RecordedDigest(manifest["content_version"])
+
+        index = store.search_index
+        index.k1, index.b = manifest["index"]["k1"], manifest["index"]["b"]
+        index.total_length = manifest["index"]["total_length"]
+        terms = reader.json("index_terms")
+        offsets = reader.array("index_offsets")
+        docs, freqs = reader.array("index_docs"), reader.array("index_freqs")
+        index.vocabulary = {term: term_id for term_id, term in enumerate(terms)}
+        index.postings_docs = [docs[offsets[i]:offsets[i + 1]] for i in range(len(terms))]
+        index.postings_freqs = [freqs[offsets[i]:offsets[i + 1]] for i in range(len(terms))]
+        index.doc_lengths = reader.array("index_doc_lengths")
+        index.doc_ids = reader.json("index_doc_ids")
+        index.deleted = set(reader.json("index_deleted"))
+        index.doc_numbers = {doc_id: number for number, doc_id in enumerate(index.doc_ids)
+                             if number not in index.deleted}
+
+        vectors = manifest["vectors"]
+        if store.vector_index is not None and reader.has("vectors"):
+            if vectors["backend"] == EMBEDDING_BACKEND and vectors["dim"] == store.vector_index.dim:
+                vector_ids = reader.json("vector_ids")
+                matrix = np.frombuffer(reader.raw("vectors"), dtype=np.float32).reshape(len(vector_ids), -1)
+                _attach_vectors(store, vector_ids, matrix)
+            else:
+                logger.warning("Snapshot %s has %s vectors, dense retrieval disabled for it",
+                               path, vectors["backend"])
+        if reader.has("excel_data"):
+            store.excel_data = pickle.loads(reader.raw("excel_data"))
+    return manifest["store_version"], store
+
+
+class _RecordedDigest:
+    """Content digest of a loaded store, as recorded when it was written"""
+
+    def __init__(self, hexdigest):
+        self._hexdigest = hexdigest
+
+    def hexdigest(self):
+        return self._hexdigest
+
+
+def _attach_vectors(store, doc_ids, matrix):
+    """Search the mapped matrix in place instead of a copy of it"""
+    # A memory-mapped index file created for the new store is not needed
+    store.close()
+    vector_index = store.vector_index
+    vector_index.path = None
+    vector_index.matrix = matrix
+    vector_index.doc_ids = list(doc_ids)
+    vector_index.rows = {doc_id: row for row, doc_id in enumerate(doc_ids)}
+    vector_index.size = len(doc_ids)
+    vector_index.live = np.ones(max(len(doc_ids), 1), dtype=bool)
+
+
+class SnapshotDirectory:
+    """One snapshot file per session in a directory"""
+
+    def __init__(self, directory=SNAPSHOT_DIR):
+        self.directory = directory
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+
+    def path(self, session_id):
+        return os.path.join(self.directory, f"{session_id}.snap")
+
+    def save(self, session_id, store, version=0):
+        if not self.directory:
+            return False
+        try:
+            write_snapshot(self.path(session_id), store, version)
+            return True
+        except Exception as e:
+            logger.warning("Error writing snapshot of session %s: %s", session_id, e)
+            return False
+
+    def load(self, session_id, version=None):
+        """(version, store) from the session's snapshot, or None.
+
+        With a version given, a snapshot of any other version is ignored.
+        """
+        if not self.directory:
+            return None
+        path = self.path(session_id)
+        if not os.path.exists(path):
+            return None
+        try:
+            if version is not None and snapshot_version(path) != version:
+                return None
+            loaded = read_snapshot(path)
+        except (SnapshotError, ValueError, KeyError, OSError, pickle.UnpicklingError) as e:
+            logger.warning("Discarding snapshot %s: %s", path, e)
+            self.remove(session_id)
+            return None
+        logger.info("Loaded snapshot of session %s (%s documents)", session_id, len(loaded[1]))
+        return loaded
+
+    def remove(self, session_id):
+        if not self.directory:
+            return
+        try:
+            os.remove(self.path(session_id))
+        except FileNotFoundError:
+            pass
+
+
+snapshots = SnapshotDirectory()
@@ -93,32 +93,17 @@ document.addEventListener('DOMContentLoaded', function() {
         console.log(`Uploading file: ${file.name}`);
         addMessage(`Uploading file: ${file.name}...`, 'system');
         
-        // Send file to server
-        const formData = new FormData();
-        formData.append('file', file);
+        // Send file to server, in resumable chunks when it is large
+        const upload = file.size > CHUNKED_UPLOAD_BYTES ? uploadInChunks(file) : uploadWhole(file);
         
-        fetch('/upload', {
-            method: 'POST',
-            body: formData
-        })
-        .then(response => {
-            console.log('Response status:', response.status);
-            return response.json().catch(err => {
-                console.error('Error parsing JSON:', err);
-                throw new Error('Invalid server response');
-            });
-        })
+        upload
         .then(data => {
             console.log('Response data:', data);
             const fileStatus = document.querySelector(`#${fileId} .file-status`);
             
             if (data && data.success) {
-                // Update UI to show success
-                fileStatus.innerHTML = '<i class="bi bi-check-circle me-1"></i> Processed';
-                fileStatus.classList.add('success');
-                
-                // Add system message about successful upload
-                addMessage('Great! I\'ve processed your document. You can now ask questions about it.', 'system');
+                // Processing continues in the background, follow the job until it finishes
+                pollUploadStatus(data.status_url, fileId);
             } else {
                 // Update UI to show error
                 const errorMsg = data && data.error ? data.error : 'Unknown error';
@@ -140,6 +125,102 @@ document.addEventListener('DOMContentLoaded', function() {
         });
     }
     
+    function readJson(response) {
+        console.log('Response status:', response.status);
+        return response.json().catch(err => {
+            console.error('Error parsing JSON:', err);
+            throw new Error('Invalid server response');
+        });
+    }
+    
+    function uploadWhole(file) {
+        const formData = new FormData();
+        formData.append('file', file);
+        return fetch('/upload', { method: 'POST', body: formData }).then(readJson);
+    }
+    
+    // Files above this size are sent with the resumable upload API
+    const CHUNKED_UPLOAD_BYTES = 32 * 1024 * 1024;
+    const CHUNK_RETRIES = 5;
+    
+    // Send a file in chunks; after a failed chunk, ask the server where to continue
+    async function uploadInChunks(file) {
+        const created = await fetch('/upload/resumable', {
+            method: 'POST',
+            headers: { 'Content-Type': 'application/json' },
+            body: JSON.stringify({ filename: file.name, size: file.size })
+        }).then(readJson);
+        if (!created.upload_id) {
+            return created;
+        }
+        let offset = 0;
+        let failures = 0;
+        while (true) {
+            try {
+                const response = await fetch(created.upload_url, {
+                    method: 'PUT',
+                    headers: { 'Upload-Offset': String(offset) },
+                    body: file.slice(offset, offset + created.chunk_size)
+                });
+                const data = await readJson(response);
+                if (response.status !== 200) {
+                    return data;
+                }
+                offset = data.offset;
+                failures = 0;
+            } catch (error) {
+                if (++failures > CHUNK_RETRIES) {
+                    throw error;
+                }
+                await new Promise(resolve => setTimeout(resolve, 1000 * failures));
+                const status = await fetch(created.upload_url).then(readJson);
+                offset = status.offset;
+            }
+        }
+    }
+    
+    // Poll the ingestion job of an upload until it is done or failed
+    const stageLabels = {
+        queued: 'Queued...',
+        parsing: 'Reading document...',
+        splitting: 'Splitting text...',
+        indexing: 'Indexing...'
+    };
+    
+    function pollUploadStatus(statusUrl, fileId) {
+        fetch(statusUrl)
+        .then(response => response.json())
+        .then(job => {
+            const fileStatus = document.querySelector(`#${fileId} .file-status`);
+            
+            if (job.status === 'done') {
+                // Update UI to show success
+                fileStatus.innerHTML = '<i class="bi bi-check-circle me-1"></i> Processed';
+                fileStatus.classList.add('success');
+                
+                // Add system message about successful upload
+                addMessage('Great! I\'ve processed your document. You can now ask questions about it.', 'system');
+            } else if (job.status === 'failed' || job.error) {
+                const errorMsg = job.error || 'Unknown error';
+                fileStatus.innerHTML = `<i class="bi bi-x-circle me-1"></i> ${errorMsg}`;
+                fileStatus.classList.add('error');
+                
+                addMessage(`Sorry, there was an issue processing your document: ${errorMsg}`, 'system');
+            } else {
+                // Still in progress, show the current stage and check again
+                const label = fileStatus.querySelector('span.ms-1');
+                if (label) {
+                    label.textContent = stageLabels[job.stage] || 'Processing...';
+                }
+                setTimeout(() => pollUploadStatus(statusUrl, fileId), 1000);
+            }
+        })
+        .catch(error => {
+            console.error('Error checking upload status:', error);
+            setTimeout(() => pollUploadStatus(statusUrl, fileId), 3000);
+        });
+    }
+    
     // Handle chat submission
     chatForm.addEventListener('submit', function(e) {
         e.preventDefault();
@@ -170,29 +251,26 @@ document.addEventListener('DOMContentLoaded', function() {
         // Scroll to bottom
         chatMessages.scrollTop = chatMessages.scrollHeight;
         
-        // Send message to server
-        fetch('/chat', {
+        // Send message to server and render the answer as it streams in
+        fetch('/chat/stream', {
             method: 'POST',
             headers: {
                 'Content-Type': 'application/json',
             },
             body: JSON.stringify({ message: message })
         })
-        .then(response => response.json())
-        .then(data => {
-            // Remove loading message
-            document.getElementById(loadingId).remove();
-            
-            // Add bot response
-            if (data.response) {
-                addMessage(data.response, 'bot');
-            } else {
-                addMessage('Sorry, I couldn\'t process your request.', 'bot');
+        .then(response => {
+            if (!response.ok || !response.body) {
+                throw new Error(`Unexpected response status: ${response.status}`);
             }
+            return readChatStream(response, loadingId);
         })
         .catch(error => {
             // Remove loading message
-            document.getElementById(loadingId).remove();
+            const loadingDiv = document.getElementById(loadingId);
+            if (loadingDiv) {
+                loadingDiv.remove();
+            }
             
             // Add error message
             addMessage('Sorry, there was an error processing your request.', 'bot');
@@ -200,6 +278,65 @@ document.addEventListener('DOMContentLoaded', function() {
         });
     });
     
+    // Read server-sent events from /chat/stream, growing one bot message as deltas arrive
+    function readChatStream(response, loadingId) {
+        const reader = response.body.getReader();
+        const decoder = new TextDecoder();
+        let buffer = '';
+        let answer = '';
+        let messageParagraph = null;
+        
+        function handleEvent(rawEvent) {
+            let eventType = 'message';
+            let data = '';
+            rawEvent.split('\n').forEach(line => {
+                if (line.startsWith('event:')) {
+                    eventType = line.slice(6).trim();
+                } else if (line.startsWith('data:')) {
+                    data += line.slice(5).trim();
+                }
+            });
+            
+            if (eventType === 'error') {
+                throw new Error(JSON.parse(data).error);
+            }
+            if (eventType !== 'message' || !data) {
+                return;
+            }
+            
+            answer += JSON.parse(data).delta;
+            if (!messageParagraph) {
+                // Swap the loading dots for the answer on the first delta
+                document.getElementById(loadingId).remove();
+                addMessage(answer, 'bot');
+                messageParagraph = chatMessages.lastElementChild.querySelector('.message-content p');
+            } else {
+                messageParagraph.innerHTML = formatBotMessage(answer);
+                chatMessages.scrollTop = chatMessages.scrollHeight;
+            }
+        }
+        
+        function pump() {
+            return reader.read().then(({ done, value }) => {
+                if (done) {
+                    if (!messageParagraph) {
+                        document.getElementById(loadingId).remove();
+                        addMessage('Sorry, I couldn\'t process your request.', 'bot');
+                    }
+                    return;
+                }
+                
+                buffer += decoder.decode(value, { stream: true });
+                const events = buffer.split('\n\n');
+                buffer = events.pop();
+                events.forEach(handleEvent);
+                return pump();
+            });
+        }
+        
+        return pump();
+    }
+    
     // Function to add message to chat
     function addMessage(message, type) {
         const messageDiv = document.createElement('div');
@@ -0,0 +1,35 @@
+import os
+import sys
+
+import pytest
+
+# The application modules are flat files in the repository root
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from fake_llm_server import start_server
+
+
+@pytest.fixture(scope="session", autouse=True)
+def workdir(tmp_path_factory):
+    """Run in a scratch directory: uploads, caches and snapshots are created relative to it"""
+    previous = os.getcwd()
+    os.chdir(tmp_path_factory.mktemp("work"))
+    yield
+    os.chdir(previous)
+
+
+@pytest.fixture
+def fake_llm():
+    """Start fake completion servers with the given options; returns their base URL"""
+    servers = []
+
+    def start(**options):
+        options.setdefault("chunk_delay", 0)
+        server = start_server(**options)
+        servers.append(server)
+        return f"http://127.0.0.1:{server.server_address[1]}/v1"
+
+    yield start
+    for server in servers:
+        server.shutdown()
+        server.server_close()
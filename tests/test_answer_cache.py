@@ -0,0 +1,39 @@
+import numpy as np
+import pytest
+
+from answer_cache import AnswerCache, normalize_query, key_terms
+
+
+@pytest.mark.parametrize("first, second", [
+    ("Which stores had sales > 100?", "Which stores had sales < 100?"),
+    ("Rows where growth >= 5", "Rows where growth = 5"),
+    ("Regions with a margin of -5%", "Regions with a margin of 5%"),
+    ("Regions with a margin of 5%", "Regions with a margin of 5"),
+    ("Status != closed", "Status closed"),
+])
+def test_operators_and_signs_change_the_key(first, second):
+    assert normalize_query(first) != normalize_query(second)
+    assert key_terms(first) != key_terms(second)
+
+
+def test_punctuation_and_case_do_not_change_the_key():
+    assert normalize_query("What was the  year-end revenue?") == normalize_query("what was the year end revenue")
+    assert normalize_query("Sales > 1.5 million?") == "sales > 1.5 million"
+
+
+def test_cached_answer_is_not_reused_for_the_opposite_comparison():
+    cache = AnswerCache(similarity=0)
+    cache.put("Which stores had sales > 100?", "v1", "Stores 3 and 7")
+    assert cache.get("which stores had sales > 100", "v1") == "Stores 3 and 7"
+    assert cache.get("Which stores had sales < 100?", "v1") is None
+
+
+def test_near_duplicate_needs_the_same_operators():
+    class SameVector:
+        def embed(self, texts):
+            return [np.ones(4, dtype=np.float32) / 2 for _ in texts]
+
+    cache = AnswerCache(similarity=0.9)
+    cache.put("show regions with growth above -5%", "v1", "North and West", embedder=SameVector())
+    assert cache.get("list the regions whose growth is above -5%", "v1", embedder=SameVector()) == "North and West"
+    assert cache.get("list the regions whose growth is above 5%", "v1", embedder=SameVector()) is None
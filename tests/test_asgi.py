@@ -0,0 +1,20 @@
+import asyncio
+
+
+def test_lifespan_startup_starts_upload_retention(monkeypatch):
+    import asgi
+
+    started = []
+    monkeypatch.setattr(asgi.upload_manifest, "start_retention", lambda: started.append(True))
+    messages = [{"type": "lifespan.startup"}, {"type": "lifespan.shutdown"}]
+    sent = []
+
+    async def receive():
+        return messages.pop(0)
+
+    async def send(message):
+        sent.append(message["type"])
+
+    asyncio.run(asgi.application({"type": "lifespan"}, receive, send))
+    assert started == [True]
+    assert sent == ["lifespan.startup.complete", "lifespan.shutdown.complete"]
@@ -0,0 +1,111 @@
+import os
+import json
+import uuid
+
+import pytest
+
+from fake_llm_server import start_server
+
+REPORT = ("Quarterly report. Revenue in the West region grew to 120 million while the East region "
+          "reported 80 million. Operating costs were flat compared to the previous quarter.\n") * 20
+
+
+@pytest.fixture(scope="module")
+def chat(tmp_path_factory):
+    """Flask test client and a session with an uploaded report, answering from the fake model server"""
+    server = start_server(chunk_delay=0)
+    directory = tmp_path_factory.mktemp("app")
+    os.environ["OPENAI_BASE_URL"] = f"http://127.0.0.1:{server.server_address[1]}/v1"
+    os.environ.setdefault("OPENAI_API_KEY", "test")
+    try:
+        from app import app
+        import document_processor
+        from sessions import session_manager
+
+        report = directory / "report.txt"
+        report.write_text(REPORT)
+        session_id = uuid.uuid4().hex
+        session = session_manager.get(session_id)
+        document_processor.process_document(str(report), session=session)
+        client = app.test_client()
+        client.set_cookie("chat_session", session_id)
+        yield client, session
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+def read_events(response):
+    """(event, data) pairs of a server-sent event stream"""
+    events = []
+    for block in response.get_data(as_text=True).split("\n\n"):
+        if not block.strip():
+            continue
+        event, data = "message", None
+        for line in block.split("\n"):
+            if line.startswith("event: "):
+                event = line[len("event: "):]
+            elif line.startswith("data: "):
+                data = json.loads(line[len("data: "):])
+        events.append((event, data))
+    return events
+
+
+def test_stream_sends_deltas_then_done(chat):
+    client, session = chat
+    question = "How much did revenue grow in the West region?"
+    response = client.post("/chat/stream", json={"message": question})
+    assert response.status_code == 200
+    assert response.mimetype == "text/event-stream"
+
+    events = read_events(response)
+    deltas = [data["delta"] for event, data in events[:-1]]
+    assert all(event == "message" for event, _ in events[:-1])
+    assert len(deltas) > 1
+    assert events[-1] == ("done", {})
+    answer = "".join(deltas)
+    assert answer.startswith("This is a fake answer to:")
+    assert question in answer
+
+    assert session.recent_history(2) == [{"role": "user", "content": question},
+                                         {"role": "assistant", "content": answer}]
+
+
+def test_stream_reports_model_failure_as_answer(chat, fake_llm, monkeypatch):
+    import chatbot
+    from llm_gateway import LLMGateway
+
+    # A 400 is not retried, so the call fails at once
+    failing = LLMGateway(api_key="test", base_url=fake_llm(error_rate=1.0, error_status=400), timeout=5)
+    monkeypatch.setattr(chatbot, "llm_gateway", failing)
+    client, session = chat
+    history = session.recent_history(100)
+
+    events = read_events(client.post("/chat/stream", json={"message": "What were the operating costs?"}))
+    assert events[-1] == ("done", {})
+    assert events[0][1]["delta"].startswith("Sorry, I encountered an error")
+    assert session.recent_history(100) == history
+
+
+def test_stream_sends_error_event(chat, monkeypatch):
+    import chatbot
+
+    class BrokenGateway:
+        def stream(self, messages, model):
+            yield "Partial"
+            raise RuntimeError("connection reset")
+
+    monkeypatch.setattr(chatbot, "llm_gateway", BrokenGateway())
+    client, session = chat
+    history = session.recent_history(100)
+
+    events = read_events(client.post("/chat/stream", json={"message": "Which region reported 80 million?"}))
+    assert events[0] == ("message", {"delta": "Partial"})
+    assert events[-1] == ("error", {"error": "connection reset"})
+    assert session.recent_history(100) == history
+
+
+def test_stream_requires_message(chat):
+    client, _ = chat
+    response = client.post("/chat/stream", json={})
+    assert response.status_code == 400
@@ -0,0 +1,101 @@
+import pandas as pd
+import pytest
+
+from excel_query import QueryError, plan_query, execute_query, validate_spec
+
+
+def sales(year_offset=0):
+    return pd.DataFrame({
+        "Region": pd.Categorical(["West", "East", "West", "North", "East", "West"]),
+        "Product": ["Chairs", "Desks", "Lamps", "Chairs", "Lamps", "Desks"],
+        "Profit": [100.0 + year_offset, 40.0, 60.0, 25.0, 35.0, 80.0],
+        "Units": [10, 4, 6, 3, 5, 8],
+    })
+
+
+@pytest.fixture
+def sheets():
+    return {"Sales": sales()}
+
+
+def test_region_value_becomes_a_filter(sheets):
+    spec = plan_query("What is the total profit in the West region?", sheets)
+    assert spec["filters"] == [{"column": "Region", "op": "==", "value": "West"}]
+    assert spec["aggregates"] == [{"column": "Profit", "func": "sum"}]
+    result = execute_query(spec, sheets)
+    assert result["rows"] == 6
+    assert result["matched"] == 3
+    assert result["table"]["sum(Profit)"].tolist() == [240.0]
+
+
+def test_several_values_become_an_in_filter(sheets):
+    spec = plan_query("Average profit in West and East", sheets)
+    assert spec["filters"] == [{"column": "Region", "op": "in", "value": ["East", "West"]}]
+    assert execute_query(spec, sheets)["table"]["mean(Profit)"].tolist() == [63.0]
+
+
+def test_grouped_aggregates_are_sorted(sheets):
+    spec = plan_query("Total profit per region", sheets)
+    table = execute_query(spec, sheets)["table"]
+    assert table["Region"].tolist() == ["West", "East", "North"]
+    assert table["sum(Profit)"].tolist() == [240.0, 75.0, 25.0]
+
+
+def test_count_and_ranking(sheets):
+    count = execute_query(plan_query("How many rows are in the East region?", sheets), sheets)
+    assert count["table"]["count"].tolist() == [2]
+
+    top = execute_query(plan_query("Top 2 products by profit", sheets), sheets)["table"]
+    assert top["Product"].tolist() == ["Chairs", "Desks"]
+    assert top["sum(Profit)"].tolist() == [125.0, 120.0]
+
+
+@pytest.mark.parametrize("question", [
+    # A name that is no column or value of the sheet
+    "What is the total profit in the South region?",
+    "Total profit of Acme",
+    # Numbers and months restrict the rows, but not through any column
+    "Total profit in 2019",
+    "Total profit in March",
+])
+def test_unmapped_terms_leave_the_question_to_the_model(sheets, question):
+    assert plan_query(question, sheets) is None
+
+
+@pytest.mark.parametrize("question", [
+    "Total profit where units are more than 5",
+    "Which products have profit above 50?",
+    "Total profit between West and East",
+    "Total profit not in the West region",
+    "Total profit without the East region",
+])
+def test_unsupported_conditions_return_none(sheets, question):
+    assert plan_query(question, sheets) is None
+
+
+def test_same_column_sheets_are_queried_together():
+    sheets = {"Sales 2020": sales(), "Sales 2021": sales(year_offset=50)}
+    spec = plan_query("Total profit in the West region", sheets)
+    assert spec["sheet"] == ["Sales 2020", "Sales 2021"]
+    assert execute_query(spec, sheets)["table"]["sum(Profit)"].tolist() == [530.0]
+
+    spec = plan_query("Total profit in the West region in 2021", sheets)
+    assert spec["sheet"] == "Sales 2021"
+    assert execute_query(spec, sheets)["table"]["sum(Profit)"].tolist() == [290.0]
+
+
+def test_spec_with_unknown_column_or_operator_is_rejected(sheets):
+    with pytest.raises(QueryError):
+        validate_spec({"sheet": "Sales", "aggregates": [{"column": "Revenue", "func": "sum"}]}, sheets)
+    with pytest.raises(QueryError):
+        validate_spec({"sheet": "Sales", "filters": [{"column": "Profit", "op": "~", "value": 1}]}, sheets)
+    with pytest.raises(QueryError):
+        execute_query({"sheet": "Sales", "aggregates": [{"column": "Product", "func": "sum"}]}, sheets)
+
+
+def test_explicit_filters_compare_numbers(sheets):
+    spec = {"sheet": "Sales", "filters": [{"column": "Units", "op": ">=", "value": "6"}],
+            "aggregates": [{"column": "Profit", "func": "sum"}]}
+    result = execute_query(spec, sheets)
+    assert result["matched"] == 3
+    assert result["table"]["sum(Profit)"].tolist() == [240.0]
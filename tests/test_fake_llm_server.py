@@ -0,0 +1,80 @@
+import json
+import urllib.error
+import urllib.request
+
+import pytest
+
+from fake_llm_server import start_server
+
+QUESTION = "What was the   total revenue?"
+ANSWER = "This is a fake answer to: What was the total revenue?"
+
+
+def post(url, payload):
+    request = urllib.request.Request(url, data=json.dumps(payload).encode("utf-8"),
+                                     headers={"Content-Type": "application/json"})
+    return urllib.request.urlopen(request, timeout=10)
+
+
+def complete(base_url, stream=False):
+    return post(f"{base_url}/chat/completions", {
+        "model": "fake-model", "stream": stream,
+        "messages": [{"role": "system", "content": "Answer briefly."}, {"role": "user", "content": QUESTION}],
+    })
+
+
+def test_completion_echoes_the_last_user_message(fake_llm):
+    with complete(fake_llm()) as response:
+        assert response.headers["Content-Type"] == "application/json"
+        body = json.load(response)
+    assert body["object"] == "chat.completion"
+    assert body["model"] == "fake-model"
+    assert body["choices"][0]["message"] == {"role": "assistant", "content": ANSWER}
+    assert body["choices"][0]["finish_reason"] == "stop"
+
+
+def test_stream_sends_chunks_then_done(fake_llm):
+    with complete(fake_llm(words_per_chunk=2), stream=True) as response:
+        assert response.headers["Content-Type"] == "text/event-stream"
+        events = [line[len("data: "):] for line in response.read().decode("utf-8").split("\n")
+                  if line.startswith("data: ")]
+    assert events[-1] == "[DONE]"
+    chunks = [json.loads(event) for event in events[:-1]]
+    assert all(chunk["object"] == "chat.completion.chunk" for chunk in chunks)
+    assert chunks[0]["choices"][0]["delta"] == {"role": "assistant", "content": ""}
+    assert chunks[-1]["choices"][0]["finish_reason"] == "stop"
+    deltas = [chunk["choices"][0]["delta"].get("content", "") for chunk in chunks]
+    assert len(deltas) > 3
+    assert "".join(deltas) == ANSWER
+
+
+def test_first_requests_fail_with_retry_after(fake_llm):
+    base_url = fake_llm(fail_first=2, error_status=429, retry_after=3)
+    for _ in range(2):
+        with pytest.raises(urllib.error.HTTPError) as failure:
+            complete(base_url)
+        assert failure.value.code == 429
+        assert failure.value.headers["Retry-After"] == "3"
+        assert json.load(failure.value)["error"]["type"] == "fake_error"
+    with complete(base_url) as response:
+        assert json.load(response)["choices"][0]["message"]["content"] == ANSWER
+
+
+def test_error_rate_fails_every_request(fake_llm):
+    base_url = fake_llm(error_rate=1.0, error_status=503)
+    for stream in (False, True):
+        with pytest.raises(urllib.error.HTTPError) as failure:
+            complete(base_url, stream=stream)
+        assert failure.value.code == 503
+        assert "Retry-After" not in failure.value.headers
+
+
+def test_unknown_path_is_not_found(fake_llm):
+    with pytest.raises(urllib.error.HTTPError) as failure:
+        post(f"{fake_llm()}/embeddings", {"input": "text"})
+    assert failure.value.code == 404
+
+
+def test_unknown_option_is_rejected():
+    with pytest.raises(TypeError, match="latancy"):
+        start_server(latancy=1)
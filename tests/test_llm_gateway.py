@@ -0,0 +1,129 @@
+import time
+import asyncio
+
+import pytest
+
+import llm_gateway
+from llm_gateway import LLMGateway, LLMError, LLMTimeoutError, TokenBucket
+
+MESSAGES = [{"role": "user", "content": "What was the total revenue?"}]
+ANSWER = "This is a fake answer to: What was the total revenue?"
+
+
+@pytest.fixture(autouse=True)
+def fast_backoff(monkeypatch):
+    monkeypatch.setattr(llm_gateway, "LLM_BACKOFF_BASE_SECONDS", 0.01)
+
+
+def gateway(base_url, **options):
+    options.setdefault("timeout", 10)
+    return LLMGateway(api_key="test", base_url=base_url, **options)
+
+
+@pytest.mark.parametrize("status", [500, 502, 503])
+def test_retries_server_errors(fake_llm, status):
+    client = gateway(fake_llm(fail_first=2, error_status=status))
+    assert client.complete(MESSAGES, "fake-model") == ANSWER
+    assert client.stats()["retries"] == 2
+    assert client.stats()["failures"] == 0
+
+
+def test_retries_rate_limit_after_retry_after(fake_llm):
+    client = gateway(fake_llm(fail_first=2, error_status=429, retry_after=0.2))
+    start = time.monotonic()
+    assert client.complete(MESSAGES, "fake-model") == ANSWER
+    assert time.monotonic() - start >= 0.4
+    assert client.stats()["retries"] == 2
+
+
+def test_gives_up_after_max_retries(fake_llm):
+    client = gateway(fake_llm(error_rate=1.0, error_status=503), max_retries=2)
+    with pytest.raises(LLMError):
+        client.complete(MESSAGES, "fake-model")
+    assert client.stats()["retries"] == 2
+    assert client.stats()["failures"] == 1
+
+
+def test_does_not_retry_client_errors(fake_llm):
+    client = gateway(fake_llm(fail_first=1, error_status=400))
+    with pytest.raises(LLMError):
+        client.complete(MESSAGES, "fake-model")
+    assert client.stats()["retries"] == 0
+
+
+def test_retries_stream_before_first_chunk(fake_llm):
+    client = gateway(fake_llm(fail_first=1, error_status=503))
+    assert "".join(client.stream(MESSAGES, "fake-model")) == ANSWER
+    assert client.stats()["retries"] == 1
+
+
+def test_hedge_answers_when_first_request_is_slow(fake_llm):
+    client = gateway(fake_llm(slow_first=1, tail_latency=2), hedge_after=0.1)
+    start = time.monotonic()
+    assert client.complete(MESSAGES, "fake-model") == ANSWER
+    assert time.monotonic() - start < 1
+    assert client.stats()["hedges"] == 1
+    assert client.stats()["hedge_wins"] == 1
+
+
+def test_async_hedge_cancels_losing_request(fake_llm):
+    client = gateway(fake_llm(slow_first=1, tail_latency=2), hedge_after=0.1, async_max_concurrency=4)
+
+    async def run():
+        start = time.monotonic()
+        answer = await client.acomplete(MESSAGES, "fake-model")
+        elapsed = time.monotonic() - start
+        # Let the cancelled request unwind
+        await asyncio.sleep(0.05)
+        free = client._async_semaphore._value
+        await client.aclose()
+        return answer, elapsed, free
+
+    answer, elapsed, free = asyncio.run(run())
+    assert answer == ANSWER
+    assert elapsed < 1
+    assert client.stats()["hedge_wins"] == 1
+    # The slow request gave its connection slot back without waiting for its response
+    assert free == 4
+
+
+def test_no_hedge_for_fast_answers(fake_llm):
+    client = gateway(fake_llm(), hedge_after=1)
+    assert client.complete(MESSAGES, "fake-model") == ANSWER
+    assert client.stats()["hedges"] == 0
+
+
+def test_token_bucket_paces_requests():
+    bucket = TokenBucket(rate=10, capacity=2)
+    deadline = time.monotonic() + 5
+    start = time.monotonic()
+    for _ in range(5):
+        assert bucket.acquire(deadline)
+    # Two tokens are there at once, the other three come at 10 per second
+    assert time.monotonic() - start >= 0.25
+
+
+def test_token_bucket_gives_up_at_deadline():
+    bucket = TokenBucket(rate=0.1, capacity=1)
+    assert bucket.acquire(time.monotonic() + 1)
+    start = time.monotonic()
+    assert not bucket.acquire(time.monotonic() + 1)
+    # It does not sleep when the next token comes after the deadline
+    assert time.monotonic() - start < 0.5
+
+
+def test_rate_limit_applies_to_model_calls(fake_llm):
+    client = gateway(fake_llm(), rate_limit_rpm=600, max_concurrency=1)
+    start = time.monotonic()
+    for _ in range(4):
+        assert client.complete(MESSAGES, "fake-model") == ANSWER
+    # One token at once, then one every 0.1 seconds
+    assert time.monotonic() - start >= 0.25
+
+
+def test_rate_limit_times_out_at_call_deadline(fake_llm):
+    client = gateway(fake_llm(), rate_limit_rpm=1, max_concurrency=1)
+    assert client.complete(MESSAGES, "fake-model") == ANSWER
+    with pytest.raises(LLMTimeoutError):
+        client.complete(MESSAGES, "fake-model", timeout=0.5)
+    assert client.stats()["timeouts"] == 1
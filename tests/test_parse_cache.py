@@ -0,0 +1,94 @@
+import os
+import uuid
+import functools
+
+from parse_cache import ParseCache
+
+MB = 1024 * 1024
+
+
+def make_entry(spill_dir, content_hash, size):
+    path = os.path.join(spill_dir, f"{content_hash}.chunks")
+    with open(path, "wb") as f:
+        f.write(b"x" * size)
+    return {"type": ".txt", "text": None, "chunks": [], "excel_data": None, "spill_files": [path]}
+
+
+def test_result_larger_than_cache_is_not_cached(tmp_path):
+    cache = ParseCache(str(tmp_path / "parse"), MB, spill_dir=str(tmp_path))
+    content_hash = "a" * 64
+    parsed = make_entry(str(tmp_path), content_hash, 2 * MB)
+    assert not cache.put(content_hash, parsed)
+    assert os.path.exists(parsed["spill_files"][0])
+    assert cache.get(content_hash) is None
+
+
+def test_put_evicts_older_entries_but_not_its_own(tmp_path):
+    cache = ParseCache(str(tmp_path / "parse"), MB, spill_dir=str(tmp_path))
+    old_hash, new_hash = "b" * 64, "c" * 64
+    old = make_entry(str(tmp_path), old_hash, 300 * 1024)
+    assert cache.put(old_hash, old)
+    # Used after the new entry is written, so the new one is the least recently used
+    future = os.path.getmtime(cache._path(old_hash)) + 60
+    os.utime(cache._path(old_hash), (future, future))
+    new = make_entry(str(tmp_path), new_hash, 900 * 1024)
+    assert cache.put(new_hash, new)
+
+    assert cache.get(new_hash) is not None
+    assert os.path.exists(new["spill_files"][0])
+    assert not os.path.exists(cache._path(old_hash))
+    assert not os.path.exists(old["spill_files"][0])
+
+
+def test_document_larger_than_cache_is_stored(tmp_path, monkeypatch):
+    import document_processor
+    from sessions import session_manager
+    from text_pipeline import CHUNK_SPILL_DIR
+
+    monkeypatch.setattr(document_processor, "parse_cache",
+                        ParseCache(str(tmp_path / "parse"), 256 * 1024, spill_dir=CHUNK_SPILL_DIR))
+    # Spill the chunks to disk well before the default spool size
+    monkeypatch.setattr(document_processor, "ChunkSpool",
+                        functools.partial(document_processor.ChunkSpool, max_chars=64 * 1024))
+    document = tmp_path / "large.txt"
+    document.write_text("Revenue grew in every region of the company this year. " * 6000)
+
+    parsed = document_processor.extract_document_cached(str(document))
+    assert parsed["cached"] is False
+    spill_path = parsed["chunks"].path
+    assert os.path.exists(spill_path)
+
+    session = session_manager.get(uuid.uuid4().hex)
+    assert document_processor.store_document(str(document), parsed, session)
+    assert len(session.store) > len(parsed["chunks"]) // 2
+    # Nothing else refers to the spill file of an uncached result
+    assert not os.path.exists(spill_path)
+    session_manager.drop(session.session_id)
+
+
+def test_evicted_entry_leaves_stored_sheets_readable(tmp_path, monkeypatch):
+    import pandas as pd
+    import excel_stream
+    import document_processor
+    from excel_store import SpilledSheet, load_sheet
+    from sessions import session_manager
+    from text_pipeline import session_spill_dir
+
+    monkeypatch.setattr(excel_stream, "EXCEL_STREAMING", "always")
+    workbook = tmp_path / "sales.xlsx"
+    pd.DataFrame({"Region": ["West", "East"] * 50, "Profit": range(100)}).to_excel(workbook, index=False)
+
+    parsed = document_processor.extract_document_cached(str(workbook))
+    session = session_manager.get(uuid.uuid4().hex)
+    assert document_processor.store_document(str(workbook), parsed, session)
+    sheet = next(iter(session.store.excel_data.values()))
+    assert isinstance(sheet, SpilledSheet)
+    assert sheet.path.startswith(session_spill_dir(session.session_id))
+
+    content_hash = os.path.basename(parsed["spill_files"][0])[:64]
+    assert document_processor.parse_cache.discard(content_hash)
+    assert not os.path.exists(parsed["spill_files"][0])
+    assert load_sheet(sheet)["Profit"].sum() == sum(range(100))
+
+    session_manager.drop(session.session_id)
+    assert not os.path.exists(session_spill_dir(session.session_id))
@@ -0,0 +1,62 @@
+import time
+import uuid
+
+import pytest
+
+
+def make_store(*texts):
+    from document_store import DocumentStore
+
+    store = DocumentStore()
+    for i, text in enumerate(texts):
+        store.add(f"doc_{i}", text, {"type": "txt"})
+    return store
+
+
+@pytest.fixture
+def backend(tmp_path):
+    from shared_store import SQLiteBackend
+
+    return SQLiteBackend(str(tmp_path / "store.db"), idle_seconds=3600)
+
+
+def age(backend, session_id, seconds):
+    backend._connection().execute("UPDATE sessions SET last_used = ? WHERE session_id = ?",
+                                  (time.time() - seconds, session_id))
+
+
+def test_publish_prunes_sessions_nobody_reads(backend):
+    backend.publish("idle", make_store("Old quarterly report"))
+    age(backend, "idle", 7200)
+    backend.publish("other", make_store("Budget"))
+    assert backend.version("idle") == 0
+    assert backend.load("idle") is None
+
+
+def test_reads_keep_a_session_from_being_pruned(backend):
+    version = backend.publish("active", make_store("Quarterly report"))
+    age(backend, "active", 7200)
+    # Another worker reading the session marks it used
+    assert backend.version("active") == version
+    backend.publish("other", make_store("Budget"))
+    loaded_version, store = backend.load("active")
+    assert loaded_version == version
+    assert store.documents["doc_0"] == "Quarterly report"
+
+
+def test_pruned_session_is_restored_from_its_snapshot(tmp_path):
+    from sessions import Session
+    from shared_store import SQLiteBackend
+
+    session_id = uuid.uuid4().hex
+    Session(session_id, SQLiteBackend(str(tmp_path / "old.db"))).replace_store(make_store("Quarterly report"))
+
+    # A new database (or one that pruned the session) has no store for it
+    backend = SQLiteBackend(str(tmp_path / "new.db"))
+    session = Session(session_id, backend)
+    assert session.store.documents["doc_0"] == "Quarterly report"
+    assert session.version == 0
+
+    # A store published by any worker replaces the restored one
+    Session(session_id, backend).replace_store(make_store("Revised report"))
+    assert session.store.documents["doc_0"] == "Revised report"
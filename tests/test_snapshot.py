@@ -0,0 +1,111 @@
+import json
+import struct
+
+import pytest
+
+CHUNKS = ["Revenue in the West region grew to 120 million.",
+          "The East region reported 80 million in revenue.",
+          "Operating costs were flat compared to the previous quarter."]
+
+
+@pytest.fixture
+def store():
+    from document_store import DocumentStore
+
+    store = DocumentStore()
+    text = " ".join(CHUNKS)
+    store.add("report.txt", text, {"source": "report.txt", "type": "txt"}, index=False)
+    for i, chunk in enumerate(CHUNKS):
+        store.add(f"report.txt_chunk_{i}", chunk,
+                  {"source": "report.txt", "type": "txt", "chunk_id": i, "parent_doc": "report.txt"})
+    store.add_vectors([f"report.txt_chunk_{i}" for i in range(len(CHUNKS))], CHUNKS)
+    return store
+
+
+def section(path, name):
+    """(offset, length) of a section, read from the manifest in the file's footer"""
+    from snapshot import FOOTER
+
+    with open(path, "rb") as f:
+        data = f.read()
+    manifest_offset, manifest_length, _, _ = FOOTER.unpack_from(data, len(data) - FOOTER.size)
+    manifest = json.loads(data[manifest_offset:manifest_offset + manifest_length])
+    return manifest["sections"][name]["offset"], manifest["sections"][name]["length"]
+
+
+def test_round_trip(tmp_path, store):
+    from snapshot import write_snapshot, read_snapshot
+
+    path = tmp_path / "session.snap"
+    write_snapshot(str(path), store, version=3)
+    version, loaded = read_snapshot(str(path))
+
+    assert version == 3
+    assert list(loaded.rows()) == list(store.rows())
+    assert loaded.content_version() == store.content_version()
+    assert loaded.get_metadata("report.txt_chunk_1") == store.get_metadata("report.txt_chunk_1")
+    assert [doc_id for doc_id, _ in loaded.search("East region revenue")] == \
+        [doc_id for doc_id, _ in store.search("East region revenue")]
+
+
+def test_non_ascii_text_round_trips(tmp_path):
+    from document_store import DocumentStore
+    from snapshot import write_snapshot, read_snapshot
+
+    store = DocumentStore()
+    store.add("notes.txt", "Umsatz: 12 Mio. € — Kosten stabil", {"type": "txt"}, index=False)
+    store.add("notes.txt_chunk_0", "12 Mio. €", {"chunk_id": 0, "parent_doc": "notes.txt"})
+    store.add("notes.txt_chunk_1", "Kosten stabil", {"chunk_id": 1, "parent_doc": "notes.txt"})
+    write_snapshot(str(tmp_path / "notes.snap"), store)
+    _, loaded = read_snapshot(str(tmp_path / "notes.snap"))
+    assert dict(loaded.documents) == dict(store.documents)
+
+
+@pytest.mark.parametrize("name", ["text", "byte_starts", "index_docs"])
+def test_corrupt_section_is_detected(tmp_path, store, name):
+    from snapshot import SnapshotError, write_snapshot, read_snapshot
+
+    path = tmp_path / "session.snap"
+    write_snapshot(str(path), store)
+    offset, length = section(path, name)
+    with open(path, "r+b") as f:
+        f.seek(offset + length // 2)
+        byte = f.read(1)
+        f.seek(offset + length // 2)
+        f.write(bytes([byte[0] ^ 0xFF]))
+    with pytest.raises(SnapshotError):
+        read_snapshot(str(path))
+
+
+def test_truncated_snapshot_is_discarded(tmp_path, store):
+    from snapshot import SnapshotDirectory
+
+    snapshots = SnapshotDirectory(str(tmp_path))
+    assert snapshots.save("session", store)
+    path = snapshots.path("session")
+    with open(path, "r+b") as f:
+        f.truncate(struct.calcsize("<8sI") + 100)
+    assert snapshots.load("session") is None
+    assert not (tmp_path / "session.snap").exists()
+
+
+def test_restored_store_accepts_writes(tmp_path, store):
+    from snapshot import SnapshotDirectory
+
+    snapshots = SnapshotDirectory(str(tmp_path))
+    snapshots.save("session", store, version=1)
+    _, loaded = snapshots.load("session")
+    version = loaded.content_version()
+
+    loaded.add("memo.txt", "The board approved a dividend of 2 euros per share.", {"type": "txt"})
+    loaded.add_vectors(["memo.txt"], ["The board approved a dividend of 2 euros per share."])
+
+    assert len(loaded) == len(store) + 1
+    assert loaded.documents["report.txt_chunk_1"] == CHUNKS[1]
+    assert loaded.search("dividend per share")[0][0] == "memo.txt"
+    assert loaded.search("East region revenue")[0][0] == "report.txt_chunk_1"
+    assert loaded.content_version() != version
+    # The copied store is an ordinary one and can be snapshotted again
+    assert snapshots.save("session", loaded, version=2)
+    _, reloaded = snapshots.load("session")
+    assert list(reloaded.rows()) == list(loaded.rows())
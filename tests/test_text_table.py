@@ -0,0 +1,79 @@
+from text_table import CHUNK_SEPARATOR, ParentText, TextTable, TextView
+
+TEXT = "Revenue grew in the West region. Costs were flat. The East region reported 80 million."
+CHUNKS = ["Revenue grew in the West region.", "Costs were flat.", "The East region reported 80 million."]
+
+
+def chunk_metadata(i, parent="report.txt"):
+    return {"source": parent, "type": "txt", "chunk_id": i, "parent_doc": parent}
+
+
+def test_chunks_of_a_stored_document_are_ranges_of_its_text():
+    table = TextTable()
+    table.add("report.txt", TEXT, {"source": "report.txt", "type": "txt"})
+    for i, chunk in enumerate(CHUNKS):
+        table.add(f"report.txt_chunk_{i}", chunk, chunk_metadata(i))
+
+    assert len(table.buffers) == 1
+    assert table.buffers[0].length == len(TEXT)
+    for i, chunk in enumerate(CHUNKS):
+        row = table.rows[f"report.txt_chunk_{i}"]
+        assert (table.starts[row], table.ends[row]) == (TEXT.index(chunk), TEXT.index(chunk) + len(chunk))
+        assert table.text(row) == chunk
+        assert table.metadata(row) == chunk_metadata(i)
+    # The chunks share one interned metadata dict apart from their chunk_id
+    assert len({table.meta_index[table.rows[f"report.txt_chunk_{i}"]] for i in range(3)}) == 1
+
+
+def test_chunks_without_their_document_build_its_buffer_without_overlap():
+    table = TextTable()
+    shared = "the overlap carried into the next chunk"
+    chunks = ["Opening sentence and " + shared, shared + " and what follows it", "A separate section"]
+    for i, chunk in enumerate(chunks):
+        table.add(f"notes.txt_chunk_{i}", chunk, chunk_metadata(i, "notes.txt"))
+
+    buffer = table.buffers[table.parents["notes.txt"]]
+    assert buffer.text == ("Opening sentence and " + shared + " and what follows it"
+                           + CHUNK_SEPARATOR + "A separate section")
+    assert [table.text(table.rows[f"notes.txt_chunk_{i}"]) for i in range(3)] == chunks
+
+
+def test_locate_searches_from_the_last_match():
+    buffer = ParentText("total: 5, total: 5, other")
+    assert buffer.locate("total: 5") == (0, 8)
+    # The second occurrence is found from the cursor, the first one again when searched from the start
+    assert buffer.locate("total: 5, other") == (10, 25)
+    assert buffer.locate("total: 5") == (10, 18)
+    assert buffer.locate("total: 5, total") == (0, 15)
+    # Text that is not in the buffer is appended after a separator
+    assert buffer.locate("missing") == (26, 33)
+    assert buffer.text == "total: 5, total: 5, other" + CHUNK_SEPARATOR + "missing"
+
+
+def test_replacing_a_document_removes_its_old_row():
+    table = TextTable()
+    table.add("a.txt", "first version", {"type": "txt"}, timestamp=1.0)
+    table.add("b.txt", "other document", {"type": "txt"}, timestamp=2.0)
+    table.add("a.txt", "second version", {"type": "txt", "revision": 2}, timestamp=3.0)
+
+    assert len(table) == 2
+    assert table.doc_ids == ["b.txt", "a.txt"]
+    assert table.rows == {"b.txt": 0, "a.txt": 1}
+    assert len(table.starts) == len(table.timestamps) == len(table.meta_index) == 2
+    assert dict(TextView(table)) == {"b.txt": "other document", "a.txt": "second version"}
+    assert table.record("a.txt").metadata == {"type": "txt", "revision": 2}
+    assert table.timestamps[table.rows["b.txt"]] == 2.0
+
+
+def test_store_rows_have_no_duplicates_after_a_replace():
+    from document_store import DocumentStore
+
+    store = DocumentStore()
+    for i, chunk in enumerate(CHUNKS):
+        store.add(f"report.txt_chunk_{i}", chunk, chunk_metadata(i))
+    store.add("report.txt_chunk_1", "Costs fell.", chunk_metadata(1))
+
+    rows = list(store.rows())
+    assert [row[0] for row in rows] == ["report.txt_chunk_0", "report.txt_chunk_2", "report.txt_chunk_1"]
+    assert rows[-1][1] == "Costs fell."
+    assert store.search("costs fell")[0][0] == "report.txt_chunk_1"
@@ -0,0 +1,70 @@
+import os
+import time
+import uuid
+
+import pytest
+
+
+@pytest.fixture
+def manifest(tmp_path):
+    from upload_manifest import UploadManifest
+    return UploadManifest(str(tmp_path / "uploads" / ".manifest.db"), max_age_days=1, max_total_mb=0)
+
+
+def upload(tmp_path, name, content, age_days=0):
+    path = tmp_path / "uploads" / name
+    path.write_bytes(content)
+    mtime = time.time() - age_days * 86400
+    os.utime(path, (mtime, mtime))
+    return str(path)
+
+
+def test_expired_upload_leaves_stored_sheets_readable(tmp_path, manifest, monkeypatch):
+    import pandas as pd
+    import excel_stream
+    import document_processor
+    from excel_store import load_sheet
+    from parse_cache import file_sha256
+    from sessions import session_manager
+
+    monkeypatch.setattr(excel_stream, "EXCEL_STREAMING", "always")
+    session = session_manager.get(uuid.uuid4().hex)
+    workbook = tmp_path / "uploads" / "sales.xlsx"
+    pd.DataFrame({"Region": ["West", "East"] * 50, "Profit": range(100)}).to_excel(workbook, index=False)
+    assert document_processor.process_document(str(workbook), session=session)
+    old = upload(tmp_path, "sales.xlsx", workbook.read_bytes(), age_days=2)
+    content_hash = file_sha256(old)
+    manifest.record(old, "sales.xlsx", content_hash, session.session_id)
+    manifest.set_status(old, "done")
+    newer = upload(tmp_path, "notes.txt", b"Meeting notes")
+    manifest.record(newer, "notes.txt", file_sha256(newer), session.session_id)
+    manifest.set_status(newer, "done")
+
+    assert manifest.enforce_retention() == 1
+    assert not os.path.exists(old)
+    # The cache entry of the workbook and its spill files are gone
+    assert document_processor.parse_cache.get(content_hash) is None
+    # The session still has uploads, so it keeps its documents, and its sheets do not depend on the cache
+    assert session_manager.sessions.get(session.session_id) is session
+    sheet = next(iter(session.store.excel_data.values()))
+    assert load_sheet(sheet)["Profit"].sum() == sum(range(100))
+    session_manager.drop(session.session_id)
+
+
+def test_session_without_uploads_loses_its_documents(tmp_path, manifest):
+    import document_processor
+    from parse_cache import file_sha256
+    from sessions import session_manager
+    from snapshot import snapshots
+
+    session = session_manager.get(uuid.uuid4().hex)
+    path = upload(tmp_path, "report.txt", b"Revenue grew in the West region.", age_days=2)
+    assert document_processor.process_document(path, session=session)
+    assert os.path.exists(snapshots.path(session.session_id))
+    manifest.record(path, "report.txt", file_sha256(path), session.session_id)
+    manifest.set_status(path, "done")
+
+    assert manifest.enforce_retention() == 1
+    assert session.session_id not in session_manager.sessions
+    assert not os.path.exists(snapshots.path(session.session_id))
+    assert len(session_manager.get(session.session_id).store) == 0
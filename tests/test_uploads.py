@@ -0,0 +1,170 @@
+import io
+import os
+import uuid
+import hashlib
+
+import pytest
+
+REPORT = b"Quarterly report. Revenue in the West region grew to 120 million.\n" * 40
+
+
+@pytest.fixture
+def client(monkeypatch):
+    """Flask test client of a new session; ingestion jobs are recorded instead of run"""
+    import app as app_module
+
+    jobs = []
+
+    def submit(file_path, filename=None, content_hash=None, session_id=None):
+        jobs.append({"job_id": uuid.uuid4().hex, "file_path": file_path, "filename": filename,
+                     "content_hash": content_hash})
+        return jobs[-1]
+
+    monkeypatch.setattr(app_module.ingestion_queue, "submit", submit)
+    client = app_module.app.test_client()
+    client.set_cookie("chat_session", uuid.uuid4().hex)
+    client.jobs = jobs
+    return client
+
+
+def upload(client, content, filename):
+    return client.post("/upload", data={"file": (io.BytesIO(content), filename)}, content_type="multipart/form-data")
+
+
+def partial_files():
+    from uploads import PARTIAL_UPLOAD_DIR
+
+    return [name for name in os.listdir(PARTIAL_UPLOAD_DIR) if name.endswith(".part")] \
+        if os.path.isdir(PARTIAL_UPLOAD_DIR) else []
+
+
+def start(client, filename, size):
+    response = client.post("/upload/resumable", json={"filename": filename, "size": size})
+    assert response.status_code == 201
+    return response.get_json()
+
+
+def put(client, upload_url, offset, data):
+    return client.put(upload_url, data=data, headers={"Upload-Offset": str(offset)})
+
+
+def test_upload_is_stored_and_queued(client):
+    response = upload(client, REPORT, "report.txt")
+    assert response.status_code == 202
+    job = client.jobs[-1]
+    assert job["content_hash"] == hashlib.sha256(REPORT).hexdigest()
+    with open(job["file_path"], "rb") as f:
+        assert f.read() == REPORT
+
+
+@pytest.mark.parametrize("filename, content", [
+    ("report.pdf", REPORT),
+    ("report.docx", REPORT),
+    ("report.xlsx", b"%PDF-1.4\n" + REPORT),
+    ("report.txt", b"\x00\x01\x02" + REPORT),
+])
+def test_content_that_does_not_match_the_extension_is_rejected(client, filename, content):
+    before = partial_files()
+    response = upload(client, content, filename)
+    assert response.status_code == 415
+    assert client.jobs == []
+    # The partial file of the rejected upload is deleted
+    assert partial_files() == before
+
+
+def test_truncated_pdf_is_rejected(client):
+    response = upload(client, b"%PDF-1.4\n" + REPORT, "report.pdf")
+    assert response.status_code == 415
+    assert "complete PDF" in response.get_json()["error"]
+
+
+def test_upload_over_the_size_limit_is_rejected(client, monkeypatch):
+    import app as app_module
+
+    monkeypatch.setitem(app_module.app.config, "MAX_CONTENT_LENGTH", 1024)
+    response = upload(client, REPORT, "report.txt")
+    assert response.status_code == 413
+    assert "larger than" in response.get_json()["error"]
+    assert client.jobs == []
+
+
+def test_resumable_upload_over_the_size_limit_is_rejected(client, monkeypatch):
+    from uploads import resumable_uploads
+
+    monkeypatch.setattr(resumable_uploads, "max_bytes", 1024)
+    response = client.post("/upload/resumable", json={"filename": "report.txt", "size": len(REPORT)})
+    assert response.status_code == 413
+
+    # More bytes than the size the upload was started with
+    started = start(client, "report.txt", 100)
+    assert put(client, started["upload_url"], 0, REPORT[:200]).status_code == 413
+
+
+def test_chunk_at_the_wrong_offset_is_rejected(client):
+    started = start(client, "report.txt", len(REPORT))
+    response = put(client, started["upload_url"], 100, REPORT[100:])
+    assert response.status_code == 409
+
+    assert put(client, started["upload_url"], 0, REPORT[:1000]).get_json()["offset"] == 1000
+    # A repeated chunk is not appended twice
+    response = put(client, started["upload_url"], 0, REPORT[:1000])
+    assert response.status_code == 409
+    assert "offset 1000" in response.get_json()["error"]
+    assert client.get(started["upload_url"]).get_json()["offset"] == 1000
+    assert client.jobs == []
+
+
+def test_upload_continues_after_a_lost_final_chunk(client):
+    started = start(client, "report.txt", len(REPORT))
+    assert put(client, started["upload_url"], 0, REPORT[:1000]).status_code == 200
+    # The connection dropped during the final chunk: what arrived is kept
+    assert put(client, started["upload_url"], 1000, REPORT[1000:1500]).get_json()["offset"] == 1500
+
+    offset = client.get(started["upload_url"]).get_json()["offset"]
+    response = put(client, started["upload_url"], offset, REPORT[offset:])
+    assert response.status_code == 202
+    assert client.jobs[-1]["content_hash"] == hashlib.sha256(REPORT).hexdigest()
+    # The finished upload is gone
+    assert client.get(started["upload_url"]).status_code == 404
+
+
+def test_final_chunk_can_be_repeated_when_no_job_started(client, monkeypatch):
+    import app as app_module
+    from ingest_queue import QueueFullError
+
+    submit = app_module.ingestion_queue.submit
+
+    def busy(*args, **kwargs):
+        raise QueueFullError("queue is full")
+
+    started = start(client, "report.txt", len(REPORT))
+    monkeypatch.setattr(app_module.ingestion_queue, "submit", busy)
+    response = put(client, started["upload_url"], 0, REPORT)
+    assert response.status_code == 429
+    assert client.get(started["upload_url"]).get_json()["offset"] == len(REPORT)
+
+    monkeypatch.setattr(app_module.ingestion_queue, "submit", submit)
+    response = put(client, started["upload_url"], len(REPORT), b"")
+    assert response.status_code == 202
+    assert client.jobs[-1]["content_hash"] == hashlib.sha256(REPORT).hexdigest()
+
+
+def test_reported_filenames_are_secured(client):
+    started = start(client, "../../etc/quarterly report.txt", len(REPORT))
+    assert started["filename"] == "etc_quarterly_report.txt"
+    response = put(client, started["upload_url"], 0, REPORT)
+    assert response.get_json()["filename"] == "etc_quarterly_report.txt"
+    assert client.jobs[-1]["filename"] == "etc_quarterly_report.txt"
+
+    response = upload(client, REPORT, "../laporan kuartal.txt")
+    assert response.get_json()["filename"] == "laporan_kuartal.txt"
+
+
+def test_uploads_of_another_session_are_not_found(client):
+    import app as app_module
+
+    started = start(client, "report.txt", len(REPORT))
+    other = app_module.app.test_client()
+    other.set_cookie("chat_session", uuid.uuid4().hex)
+    assert other.get(started["upload_url"]).status_code == 404
+    assert put(other, started["upload_url"], 0, REPORT).status_code == 404
@@ -0,0 +1,231 @@
+import os
+import time
+import pickle
+
+# Streaming ingestion pipeline. Extractors yield (text, metadata) segments,
+# StreamingSplitter cuts them into overlapping chunks through a bounded
+# window, and a ChunkSpool keeps the chunks in memory for small documents or
+# in a spill file beyond that until the serving process adds them to the store
+# in batches. No stage holds the whole document text, except for documents
+# short enough to also be stored whole (DOCUMENT_TEXT_MAX_CHARS).
+# PipelineStats measures the throughput of every stage in MB of text per second.
+
+CHUNK_SIZE = 1000
+CHUNK_OVERLAP = 100
+# Characters the splitter works on at once; larger than a chunk by far, so windows rarely cut a chunk short
+SPLIT_WINDOW_CHARS = 64 * 1024
+# Documents up to this length are also stored whole, next to their chunks
+DOCUMENT_TEXT_MAX_CHARS = int(os.getenv("DOCUMENT_TEXT_MAX_CHARS", "200000"))
+# Chunk characters held in memory before the spool moves to a spill file
+CHUNK_SPOOL_MAX_CHARS = int(os.getenv("CHUNK_SPOOL_MAX_CHARS", str(4 * 1024 * 1024)))
+# Shared with the column files of streamed Excel sheets (excel_stream.EXCEL_SPILL_DIR);
+# read here so that splitting does not load the Excel reader
+CHUNK_SPILL_DIR = os.getenv("EXCEL_SPILL_DIR", os.path.join("cache", "spill"))
+# Hard links of the sheet spill files each session's store reads, so that the
+# parse cache never deletes data a store still uses; removed with the session
+SESSION_SPILL_DIR = os.path.join(CHUNK_SPILL_DIR, "sessions")
+
+MB = 1024 * 1024
+
+
+def session_spill_dir(session_id):
+    return os.path.join(SESSION_SPILL_DIR, session_id)
+
+
+def segment_size(item):
+    return len(item[0])
+
+
+class StreamingSplitter:
+    """RecursiveCharacterTextSplitter applied to a stream of segments.
+
+    Segments are buffered up to the window size and split; all chunks but the
+    last are emitted and the text from the start of the last chunk is carried
+    into the next window, so chunks and their overlap come out as they would
+    from splitting the whole text, apart from an occasional chunk at a window
+    boundary that is merged or cut differently. Segments with different metadata (e.g.
+    PDF pages) are never merged into one chunk.
+    """
+
+    def __init__(self, chunk_size=CHUNK_SIZE, chunk_overlap=CHUNK_OVERLAP, window=SPLIT_WINDOW_CHARS):
+        # langchain takes a noticeable time to import, so it is loaded with the first splitter
+        from langchain.text_splitter import RecursiveCharacterTextSplitter
+
+        self.splitter = RecursiveCharacterTextSplitter(
+            chunk_size=chunk_size,
+            chunk_overlap=chunk_overlap,
+            length_function=len,
+        )
+        self.window = max(window, 4 * chunk_size)
+
+    def split(self, segments, separator="\n"):
+        """Yield (chunk, metadata) pairs for an iterable of (text, metadata) segments"""
+        parts = []
+        size = 0
+        metadata = None
+        for text, segment_metadata in segments:
+            if parts and segment_metadata != metadata:
+                yield from self._split_window(separator.join(parts), metadata, final=True)
+                parts, size = [], 0
+            parts.append(text)
+            size += len(text) + len(separator)
+            metadata = segment_metadata
+            if size >= self.window:
+                carry = yield from self._split_window(separator.join(parts), metadata, final=False)
+                parts = [carry] if carry else []
+                size = len(carry)
+        if parts:
+            yield from self._split_window(separator.join(parts), metadata, final=True)
+
+    def _split_window(self, text, metadata, final):
+        """Emit the chunks of text and return the part to carry into the next window"""
+        chunks = self.splitter.split_text(text)
+        if not final and len(chunks) > 1:
+            start = text.rfind(chunks[-1])
+            if start > 0:
+                for chunk in chunks[:-1]:
+                    yield chunk, metadata
+                return text[start:]
+        for chunk in chunks:
+            yield chunk, metadata
+        return ""
+
+
+class TextCollector:
+    """Passes segments through and keeps their text while it stays under max_chars"""
+
+    def __init__(self, max_chars=DOCUMENT_TEXT_MAX_CHARS):
+        self.max_chars = max_chars
+        self.parts = []
+        self.chars = 0
+        self.complete = True
+
+    def collect(self, segments):
+        for segment in segments:
+            if self.complete:
+                self.chars += len(segment[0])
+                if self.chars > self.max_chars:
+                    self.complete = False
+                    self.parts = []
+                else:
+                    self.parts.append(segment[0])
+            yield segment
+
+    def text(self, separator="\n"):
+        """The joined text, or None when the document was too long to keep"""
+        return separator.join(self.parts) if self.complete else None
+
+
+class SpilledChunks:
+    """(chunk, metadata) pairs pickled one after another in a spill file"""
+
+    def __init__(self, path, count):
+        self.path = path
+        self.count = count
+
+    def __len__(self):
+        return self.count
+
+    def __iter__(self):
+        with open(self.path, 'rb') as f:
+            for _ in range(self.count):
+                yield pickle.load(f)
+
+    def remove(self):
+        try:
+            os.remove(self.path)
+        except FileNotFoundError:
+            pass
+
+
+class ChunkSpool:
+    """Collects the chunks of one document, moving them to spill_path once they outgrow max_chars"""
+
+    def __init__(self, spill_path, max_chars=CHUNK_SPOOL_MAX_CHARS):
+        self.spill_path = spill_path
+        self.max_chars = max_chars
+        self.chunks = []
+        self.chars = 0
+        self.count = 0
+        self.file = None
+
+    def append(self, chunk, metadata):
+        self.count += 1
+        if self.file is not None:
+            pickle.dump((chunk, metadata), self.file, protocol=pickle.HIGHEST_PROTOCOL)
+            return
+        self.chunks.append((chunk, metadata))
+        self.chars += len(chunk)
+        if self.chars > self.max_chars:
+            os.makedirs(os.path.dirname(self.spill_path) or ".", exist_ok=True)
+            self.file = open(f"{self.spill_path}.{os.getpid()}.tmp", 'wb')
+            for item in self.chunks:
+                pickle.dump(item, self.file, protocol=pickle.HIGHEST_PROTOCOL)
+            self.chunks = []
+
+    def finish(self):
+        """The chunks as a list, or as SpilledChunks when they were moved to disk"""
+        if self.file is None:
+            return self.chunks
+        temp_path = self.file.name
+        self.file.close()
+        self.file = None
+        os.replace(temp_path, self.spill_path)
+        return SpilledChunks(self.spill_path, self.count)
+
+    def discard(self):
+        if self.file is not None:
+            temp_path = self.file.name
+            self.file.close()
+            self.file = None
+            os.remove(temp_path)
+        self.chunks = []
+
+
+class PipelineStats:
+    """Characters and time per pipeline stage.
+
+    Stages wrap each other's iterators, so the time of a stage excludes the
+    time spent pulling from the stages it reads from.
+    """
+
+    def __init__(self):
+        self.stages = {}
+        self._frames = []
+
+    def record(self, stage, chars, seconds):
+        entry = self.stages.setdefault(stage, [0, 0.0])
+        entry[0] += chars
+        entry[1] += seconds
+
+    def meter(self, stage, items, size=segment_size):
+        """Pass items through, counting their size and the time taken to produce them"""
+        iterator = iter(items)
+        while True:
+            frame = [0.0]
+            self._frames.append(frame)
+            start = time.perf_counter()
+            try:
+                item = next(iterator)
+            except StopIteration:
+                return
+            finally:
+                elapsed = time.perf_counter() - start
+                self._frames.pop()
+                if self._frames:
+                    self._frames[-1][0] += elapsed
+                self.record(stage, 0, elapsed - frame[0])
+            self.record(stage, size(item), 0.0)
+            yield item
+
+    def report(self):
+        """Stage -> {"mb", "seconds", "mb_per_s"}"""
+        return {stage: {"mb": round(chars / MB, 3),
+                        "seconds": round(seconds, 3),
+                        "mb_per_s": round(chars / MB / seconds, 2) if seconds > 0 else None}
+                for stage, (chars, seconds) in self.stages.items()}
+
+
+def format_report(report):
+    return ", ".join(f"{stage} {entry['mb']} MB in {entry['seconds']}s ({entry['mb_per_s']} MB/s)"
+                     for stage, entry in report.items())
@@ -0,0 +1,272 @@
+import threading
+from array import array
+from datetime import datetime
+from collections.abc import Mapping
+
+from context_packer import overlap_length
+
+# Compact storage of document and chunk text. Every parent document has one
+# text buffer; a chunk is a (start, end) range of its parent's buffer and its
+# text is sliced out when read. When the full document text is stored first,
+# chunks are located inside it and cost no text at all; for documents stored
+# as chunks only, the buffer is built from the chunks with their overlap
+# removed. Per-row fields live in typed arrays, and metadata dicts are
+# interned, so the chunks of a document share one dict for source, type and
+# parent instead of one dict each.
+
+CHUNK_SEPARATOR = "\n"
+
+
+class ParentText:
+    """Text buffer of one parent document"""
+
+    __slots__ = ("parts", "length", "cursor", "tail", "complete")
+
+    def __init__(self, text=None):
+        self.parts = [text] if text else []
+        self.length = len(text) if text else 0
+        # Chunks arrive in document order, so the next one is searched for from the last match
+        self.cursor = 0
+        # Last appended chunk, to detect its overlap with the next one
+        self.tail = None
+        # The full text was given and chunks are looked up in it
+        self.complete = text is not None
+
+    @property
+    def text(self):
+        """The whole buffer; pending parts are joined, so callers must hold the table lock if it may grow"""
+        if len(self.parts) > 1:
+            self.parts = ["".join(self.parts)]
+        return self.parts[0] if self.parts else ""
+
+    def locate(self, chunk):
+        """(start, end) of chunk in the buffer, appending it when it is not there"""
+        if self.complete:
+            text = self.text
+            start = text.find(chunk, self.cursor)
+            if start < 0:
+                start = text.find(chunk)
+            if start >= 0:
+                self.cursor = start
+                return start, start + len(chunk)
+        overlap = overlap_length(self.tail, chunk) if self.tail else 0
+        if overlap:
+            start = self.length - overlap
+            piece = chunk[overlap:]
+        else:
+            if self.length:
+                self.parts.append(CHUNK_SEPARATOR)
+                self.length += len(CHUNK_SEPARATOR)
+            start = self.length
+            piece = chunk
+        self.parts.append(piece)
+        self.length += len(piece)
+        self.tail = chunk
+        return start, start + len(chunk)
+
+
+class TextTable:
+    """Rows of (doc_id, text range, metadata, timestamp) over shared parent buffers.
+
+    A row whose metadata names a parent_doc is a chunk of that parent; any
+    other row is a document with its own buffer. Adding an existing doc_id
+    removes its row and appends the new one, so the rows after it move up by
+    one; rows are looked up by doc_id when they are read.
+    """
+
+    def __init__(self):
+        self.parents = {}
+        self.buffers = []
+        self.doc_ids = []
+        self.rows = {}
+        self.buffer_index = array('l')
+        self.starts = array('q')
+        self.ends = array('q')
+        # chunk_id of chunk rows, -1 for others
+        self.chunk_numbers = array('l')
+        self.meta_index = array('l')
+        self.timestamps = array('d')
+        self.metas = []
+        self._interned = {}
+        # Guards appends to buffers against a reader joining their parts
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.rows)
+
+    def _intern(self, metadata):
+        try:
+            key = tuple(sorted(metadata.items()))
+            index = self._interned.get(key)
+        except TypeError:
+            # Unhashable values: stored as they are, without sharing
+            key = index = None
+        if index is None:
+            index = len(self.metas)
+            self.metas.append(dict(metadata))
+            if key is not None:
+                self._interned[key] = index
+        return index
+
+    def _buffer(self, doc_id, text=None):
+        buffer = ParentText(text)
+        self.parents[doc_id] = len(self.buffers)
+        self.buffers.append(buffer)
+        return self.parents[doc_id]
+
+    def add(self, doc_id, content, metadata=None, timestamp=0.0):
+        with self.lock:
+            return self._add(doc_id, content, metadata, timestamp)
+
+    def _add(self, doc_id, content, metadata, timestamp):
+        metadata = dict(metadata or {})
+        chunk_number = metadata.pop("chunk_id", -1)
+        if not isinstance(chunk_number, int):
+            metadata["chunk_id"] = chunk_number
+            chunk_number = -1
+        parent_id = metadata.get("parent_doc")
+        if parent_id is not None and parent_id != doc_id:
+            index = self.parents.get(parent_id)
+            if index is None:
+                # Chunks of a document that is not stored whole build its buffer
+                index = self._buffer(parent_id)
+            start, end = self.buffers[index].locate(content)
+        else:
+            index = self._buffer(doc_id, content)
+            start, end = 0, len(content)
+
+        replaced = self.rows.pop(doc_id, None)
+        if replaced is not None:
+            self._remove_row(replaced)
+        row = len(self.doc_ids)
+        self.doc_ids.append(doc_id)
+        self.buffer_index.append(index)
+        self.starts.append(start)
+        self.ends.append(end)
+        self.chunk_numbers.append(chunk_number)
+        self.meta_index.append(self._intern(metadata))
+        self.timestamps.append(timestamp)
+        self.rows[doc_id] = row
+        return row
+
+    def _remove_row(self, row):
+        """Delete a row from every row array, moving the rows after it up by one"""
+        del self.doc_ids[row]
+        for values in (self.buffer_index, self.starts, self.ends, self.chunk_numbers, self.meta_index,
+                       self.timestamps):
+            del values[row]
+        for doc_id, other in self.rows.items():
+            if other > row:
+                self.rows[doc_id] = other - 1
+
+    def text(self, row):
+        buffer = self.buffers[self.buffer_index[row]]
+        if len(buffer.parts) > 1:
+            with self.lock:
+                text = buffer.text
+        else:
+            text = buffer.text
+        return text[self.starts[row]:self.ends[row]]
+
+    def metadata(self, row):
+        metadata = dict(self.metas[self.meta_index[row]])
+        if self.chunk_numbers[row] >= 0:
+            metadata["chunk_id"] = self.chunk_numbers[row]
+        return metadata
+
+    def timestamp(self, row):
+        return datetime.fromtimestamp(self.timestamps[row]).isoformat()
+
+    def record(self, doc_id):
+        row = self.rows.get(doc_id)
+        return None if row is None else DocumentRecord(self, row)
+
+    def memory_usage(self):
+        """Approximate bytes held: buffers, row arrays, ids and interned metadata"""
+        size = sum(buffer.length for buffer in self.buffers)
+        size += len(self.doc_ids) * (5 * 8 + 4)
+        size += sum(len(doc_id) + 49 for doc_id in self.doc_ids)
+        # Entries of the doc_id -> row dict and the interned metadata dicts
+        size += 100 * len(self.rows) + 400 * len(self.metas)
+        return size
+
+
+class DocumentRecord:
+    """View of one stored row; text and metadata are read on access"""
+
+    __slots__ = ("table", "row")
+
+    def __init__(self, table, row):
+        self.table = table
+        self.row = row
+
+    @property
+    def doc_id(self):
+        return self.table.doc_ids[self.row]
+
+    @property
+    def text(self):
+        return self.table.text(self.row)
+
+    @property
+    def metadata(self):
+        return self.table.metadata(self.row)
+
+    @property
+    def timestamp(self):
+        return self.table.timestamp(self.row)
+
+
+class TextView(Mapping):
+    """Read-only doc_id -> text mapping over a TextTable, in insertion order"""
+
+    __slots__ = ("table",)
+
+    def __init__(self, table):
+        self.table = table
+
+    def __getitem__(self, doc_id):
+        return self.table.text(self.table.rows[doc_id])
+
+    def __iter__(self):
+        return iter(self.table.rows)
+
+    def __len__(self):
+        return len(self.table.rows)
+
+    def __contains__(self, doc_id):
+        return doc_id in self.table.rows
+
+
+class MappedTextTable(TextTable):
+    """Read-only TextTable over UTF-8 text in a buffer, such as a memory-mapped snapshot.
+
+    Rows carry byte ranges into the buffer, so reading a row decodes just
+    that row and the text is never copied into the Python heap as a whole.
+    Stores holding one are copied into a TextTable before they are written to.
+    """
+
+    def __init__(self, data, doc_ids, byte_starts, byte_ends, chunk_numbers, meta_index, timestamps, metas):
+        super().__init__()
+        self.data = data
+        self.doc_ids = doc_ids
+        self.rows = {doc_id: row for row, doc_id in enumerate(doc_ids)}
+        self.byte_starts = byte_starts
+        self.byte_ends = byte_ends
+        self.chunk_numbers = chunk_numbers
+        self.meta_index = meta_index
+        self.timestamps = timestamps
+        self.metas = metas
+
+    def add(self, doc_id, content, metadata=None, timestamp=0.0):
+        raise TypeError("A mapped text table is read-only")
+
+    def text(self, row):
+        return bytes(self.data[self.byte_starts[row]:self.byte_ends[row]]).decode("utf-8", "surrogatepass")
+
+    def memory_usage(self):
+        """Row ids, arrays and metadata; the mapped text is left to the page cache"""
+        size = len(self.doc_ids) * (4 * 8 + 4)
+        size += sum(len(doc_id) + 49 for doc_id in self.doc_ids)
+        size += 100 * len(self.rows) + 400 * len(self.metas)
+        return size
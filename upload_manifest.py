@@ -0,0 +1,236 @@
+import os
+import time
+import uuid
+import sqlite3
+import logging
+import threading
+
+import metrics
+from uploads import UPLOAD_FOLDER, file_extension
+from parse_cache import parse_cache
+from sessions import session_manager
+
+logger = logging.getLogger(__name__)
+
+# Index of the files in UPLOAD_FOLDER, kept in a SQLite database next to them
+# by the upload path and the ingestion jobs: one row per file with its hash,
+# size, type, upload time, session and parse status. Finding the latest file
+# of a session is an index lookup instead of a directory scan.
+#
+# A retention thread deletes processed files older than UPLOAD_MAX_AGE_DAYS,
+# and the oldest ones while all uploads together exceed UPLOAD_MAX_TOTAL_MB,
+# together with what was derived from them: the parse cache entry and spill
+# files of their content (unless another upload has the same content), which
+# no store reads since stores keep links of their own, and the documents of
+# a session none of whose files are left: its store in memory and in the
+# shared backend, its snapshot and its sheet links. Either quota is off when
+# set to 0.
+
+MANIFEST_PATH = os.path.join(UPLOAD_FOLDER, '.manifest.db')
+UPLOAD_MAX_AGE_DAYS = float(os.getenv("UPLOAD_MAX_AGE_DAYS", "30"))
+UPLOAD_MAX_TOTAL_MB = int(os.getenv("UPLOAD_MAX_TOTAL_MB", "10240"))
+UPLOAD_RETENTION_INTERVAL_SECONDS = int(os.getenv("UPLOAD_RETENTION_INTERVAL_SECONDS", "600"))
+MANIFEST_BUSY_TIMEOUT_SECONDS = 30
+# Bumped when the schema changes; 0 is a database that was just created
+MANIFEST_SCHEMA_VERSION = 1
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS uploads (
+    file_id TEXT PRIMARY KEY,
+    path TEXT NOT NULL UNIQUE,
+    filename TEXT NOT NULL,
+    session_id TEXT,
+    content_hash TEXT,
+    size INTEGER NOT NULL,
+    type TEXT NOT NULL,
+    mtime REAL NOT NULL,
+    status TEXT NOT NULL,
+    error TEXT
+);
+CREATE INDEX IF NOT EXISTS uploads_session_mtime ON uploads (session_id, mtime);
+CREATE INDEX IF NOT EXISTS uploads_mtime ON uploads (mtime);
+CREATE INDEX IF NOT EXISTS uploads_content_hash ON uploads (content_hash);
+"""
+
+
+class UploadManifest:
+    """Uploaded files and their parse status in a SQLite database shared by the worker processes"""
+
+    def __init__(self, path=MANIFEST_PATH, max_age_days=UPLOAD_MAX_AGE_DAYS, max_total_mb=UPLOAD_MAX_TOTAL_MB):
+        self.path = path
+        self.max_age_seconds = max_age_days * 86400
+        self.max_total_bytes = max_total_mb * 1024 * 1024
+        self.evictions = 0
+        self._local = threading.local()
+        self._retention = None
+        self._retention_lock = threading.Lock()
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        connection = self._connection()
+        connection.executescript(SCHEMA)
+        self._transaction(connection, lambda: self._adopt_existing(connection), immediate=True)
+
+    def _connection(self):
+        connection = getattr(self._local, "connection", None)
+        if connection is None:
+            # Autocommit mode; transactions are opened explicitly below
+            connection = sqlite3.connect(self.path, timeout=MANIFEST_BUSY_TIMEOUT_SECONDS, isolation_level=None)
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("PRAGMA synchronous=NORMAL")
+            self._local.connection = connection
+        return connection
+
+    def _transaction(self, connection, body, immediate=False):
+        connection.execute("BEGIN IMMEDIATE" if immediate else "BEGIN")
+        try:
+            result = body()
+        except BaseException:
+            connection.execute("ROLLBACK")
+            raise
+        connection.execute("COMMIT")
+        return result
+
+    def _adopt_existing(self, connection):
+        """Index the files a new manifest finds in the upload folder, so retention covers them too"""
+        if connection.execute("PRAGMA user_version").fetchone()[0] != 0:
+            return
+        directory = os.path.dirname(self.path) or "."
+        rows = []
+        for entry in os.scandir(directory):
+            if entry.is_file() and not entry.name.startswith('.'):
+                stat = entry.stat()
+                rows.append((uuid.uuid4().hex, entry.path, entry.name.split('_', 1)[-1], None, None,
+                             stat.st_size, file_extension(entry.name), stat.st_mtime, "done"))
+        connection.executemany("INSERT OR IGNORE INTO uploads VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, NULL)", rows)
+        connection.execute(f"PRAGMA user_version = {MANIFEST_SCHEMA_VERSION}")
+        if rows:
+            logger.info("Added %s existing uploads to the manifest", len(rows))
+
+    def record(self, path, filename, content_hash, session_id=None):
+        """Add a stored upload whose ingestion is about to start; returns its file id"""
+        file_id = uuid.uuid4().hex
+        stat = os.stat(path)
+        self._connection().execute(
+            "INSERT INTO uploads VALUES (?, ?, ?, ?, ?, ?, ?, ?, 'queued', NULL)",
+            (file_id, path, filename, session_id, content_hash, stat.st_size, file_extension(path), stat.st_mtime))
+        return file_id
+
+    def set_status(self, path, status, error=None):
+        self._connection().execute("UPDATE uploads SET status = ?, error = ? WHERE path = ?", (status, error, path))
+
+    def forget(self, path):
+        """Remove the row of an upload that was not kept"""
+        self._connection().execute("DELETE FROM uploads WHERE path = ?", (path,))
+
+    def latest(self, session_id):
+        """Path of the session's most recent upload that did not fail to parse, or None"""
+        row = self._connection().execute(
+            "SELECT path FROM uploads WHERE session_id = ? AND status != 'failed' ORDER BY mtime DESC LIMIT 1",
+            (session_id,)).fetchone()
+        return row[0] if row else None
+
+    def get(self, path):
+        row = self._connection().execute(
+            "SELECT file_id, path, filename, session_id, content_hash, size, type, mtime, status, error "
+            "FROM uploads WHERE path = ?", (path,)).fetchone()
+        if row is None:
+            return None
+        return dict(zip(("file_id", "path", "filename", "session_id", "content_hash", "size", "type", "mtime",
+                         "status", "error"), row))
+
+    def enforce_retention(self, now=None):
+        """Evict uploads over the age and size quotas; returns how many were evicted"""
+        now = time.time() if now is None else now
+        connection = self._connection()
+        evicted = 0
+        # Files still being ingested are left alone by both quotas
+        if self.max_age_seconds > 0:
+            expired = connection.execute(
+                "SELECT file_id FROM uploads WHERE mtime < ? AND status IN ('done', 'failed')",
+                (now - self.max_age_seconds,)).fetchall()
+            evicted += sum(self._evict(file_id) for file_id, in expired)
+        if self.max_total_bytes > 0:
+            total = connection.execute("SELECT COALESCE(SUM(size), 0) FROM uploads").fetchone()[0]
+            if total > self.max_total_bytes:
+                # The oldest finished ones go first
+                for file_id, size in connection.execute(
+                        "SELECT file_id, size FROM uploads WHERE status IN ('done', 'failed') "
+                        "ORDER BY mtime").fetchall():
+                    if total <= self.max_total_bytes:
+                        break
+                    if self._evict(file_id):
+                        evicted += 1
+                    total -= size
+        if evicted:
+            logger.info("Evicted %s uploads under the retention quotas", evicted)
+        return evicted
+
+    def _evict(self, file_id):
+        """Delete an upload and the artifacts nothing else uses; False when another process got to it first"""
+        connection = self._connection()
+
+        def delete():
+            row = connection.execute("SELECT path, content_hash, session_id FROM uploads WHERE file_id = ?",
+                                     (file_id,)).fetchone()
+            if row is None:
+                return None
+            connection.execute("DELETE FROM uploads WHERE file_id = ?", (file_id,))
+            path, content_hash, session_id = row
+            hash_used = content_hash is not None and connection.execute(
+                "SELECT 1 FROM uploads WHERE content_hash = ? LIMIT 1", (content_hash,)).fetchone() is not None
+            session_used = session_id is not None and connection.execute(
+                "SELECT 1 FROM uploads WHERE session_id = ? LIMIT 1", (session_id,)).fetchone() is not None
+            return path, None if hash_used else content_hash, None if session_used else session_id
+
+        deleted = self._transaction(connection, delete, immediate=True)
+        if deleted is None:
+            return False
+        path, content_hash, session_id = deleted
+        self.evictions += 1
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+        if content_hash:
+            # Also deletes the chunk and sheet spill files of the content
+            parse_cache.discard(content_hash)
+        if session_id:
+            session_manager.drop(session_id)
+        logger.debug("Evicted upload %s", path)
+        return True
+
+    def start_retention(self, interval=UPLOAD_RETENTION_INTERVAL_SECONDS):
+        """Run enforce_retention every interval seconds on a daemon thread"""
+        with self._retention_lock:
+            if self._retention is not None or interval <= 0:
+                return
+            self._retention = threading.Thread(target=self._run_retention, args=(interval,),
+                                               name="upload-retention", daemon=True)
+            self._retention.start()
+
+    def _run_retention(self, interval):
+        while True:
+            try:
+                self.enforce_retention()
+            except Exception as e:
+                logger.warning("Error enforcing upload retention: %s", e)
+            time.sleep(interval)
+
+    def stats(self):
+        files, total = self._connection().execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM uploads").fetchone()
+        return {"files": files, "bytes": total, "evictions": self.evictions}
+
+
+upload_manifest = UploadManifest()
+
+
+def _collect_metrics():
+    stats = upload_manifest.stats()
+    return [("chatbot_upload_files", "gauge", "Uploaded files kept on disk", [({}, stats["files"])]),
+            ("chatbot_upload_bytes", "gauge", "Size of the uploaded files kept on disk", [({}, stats["bytes"])]),
+            ("chatbot_upload_evictions_total", "counter", "Uploads deleted by the retention job of this process",
+             [({}, stats["evictions"])])]
+
+
+metrics.register_collector(_collect_metrics)
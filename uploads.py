@@ -0,0 +1,309 @@
+import os
+import json
+import time
+import uuid
+import fcntl
+import hashlib
+import logging
+import zipfile
+import threading
+
+from werkzeug.utils import secure_filename
+
+logger = logging.getLogger(__name__)
+
+# Uploads are written to disk as they arrive, a block at a time, never held
+# whole in memory. The SHA-256 the parse cache needs is computed during the
+# copy, and the first bytes are checked against the signature of the file
+# type the name claims, so a mislabelled or corrupted file is rejected before
+# the rest of it is stored and long before it reaches a parser.
+#
+# Files too large for one request can be sent in pieces: POST /upload/resumable
+# starts an upload, every PUT appends a chunk at the offset the server reports,
+# and an interrupted upload continues from the last byte that was stored.
+
+UPLOAD_FOLDER = 'uploads'
+ALLOWED_EXTENSIONS = {'docx', 'xlsx', 'xls', 'pdf', 'txt'}
+MAX_UPLOAD_MB = int(os.getenv("MAX_UPLOAD_MB", "512"))
+MAX_UPLOAD_BYTES = MAX_UPLOAD_MB * 1024 * 1024
+UPLOAD_BLOCK_SIZE = 1024 * 1024  # Copy uploads to disk 1MB at a time
+
+# Files still being received, and the state of resumable uploads
+PARTIAL_UPLOAD_DIR = os.path.join(UPLOAD_FOLDER, '.partial')
+RESUMABLE_CHUNK_BYTES = 8 * 1024 * 1024  # Chunk size suggested to clients
+RESUMABLE_EXPIRY_SECONDS = 24 * 3600  # Unfinished uploads are deleted after a day
+
+# Bytes inspected to recognise the file type
+SNIFF_BYTES = 4096
+ZIP_SIGNATURE = b"PK\x03\x04"
+OLE2_SIGNATURE = b"\xd0\xcf\x11\xe0\xa1\xb1\x1a\xe1"
+
+# Whether the first bytes of a file fit its extension. An .xls name may hold
+# an old binary workbook or an .xlsx one, both of which pandas reads.
+HEAD_CHECKS = {
+    '.docx': lambda head: head.startswith(ZIP_SIGNATURE),
+    '.xlsx': lambda head: head.startswith(ZIP_SIGNATURE),
+    '.xls': lambda head: head.startswith((OLE2_SIGNATURE, ZIP_SIGNATURE)),
+    '.pdf': lambda head: b"%PDF-" in head[:1024],
+    '.txt': lambda head: b"\x00" not in head,
+}
+
+# Folder every Office Open XML package of a type has parts in
+ZIP_PART_PREFIXES = {'.docx': 'word/', '.xlsx': 'xl/', '.xls': 'xl/'}
+
+TYPE_NAMES = {'.docx': 'Word document', '.xlsx': 'Excel workbook', '.xls': 'Excel workbook',
+              '.pdf': 'PDF file', '.txt': 'text file'}
+
+
+class UploadRejected(Exception):
+    """An upload that is not accepted; status is the HTTP status to answer with"""
+
+    def __init__(self, message, status=400):
+        super().__init__(message)
+        self.status = status
+
+
+def file_extension(filename):
+    return os.path.splitext(filename or '')[1].lower()
+
+
+def check_extension(filename):
+    """Extension of an accepted file name, or UploadRejected"""
+    extension = file_extension(filename)
+    if extension[1:] not in ALLOWED_EXTENSIONS:
+        raise UploadRejected('File type not allowed')
+    return extension
+
+
+def safe_filename(filename):
+    """Name of an uploaded file as stored and reported back: secure_filename, keeping the extension"""
+    name = secure_filename(filename)
+    extension = file_extension(filename)
+    # secure_filename drops non-ASCII characters and can take the extension with them
+    if file_extension(name) != extension:
+        name = f"{os.path.splitext(name)[0] or 'upload'}{extension}"
+    return name
+
+
+def upload_path(filename):
+    """Unique path in UPLOAD_FOLDER for a file, keeping its extension"""
+    return os.path.join(UPLOAD_FOLDER, f"{uuid.uuid4()}_{safe_filename(filename)}")
+
+
+def _check_complete(path, extension):
+    """Check the structure of a fully received file"""
+    prefix = ZIP_PART_PREFIXES.get(extension)
+    if prefix is not None and (extension != '.xls' or zipfile.is_zipfile(path)):
+        try:
+            with zipfile.ZipFile(path) as package:
+                valid = any(name.startswith(prefix) for name in package.namelist())
+        except zipfile.BadZipFile:
+            valid = False
+        if not valid:
+            raise UploadRejected(f"File is not a valid {TYPE_NAMES[extension]}", 415)
+    elif extension == '.pdf':
+        with open(path, 'rb') as f:
+            f.seek(max(0, os.path.getsize(path) - 1024))
+            if b"%%EOF" not in f.read():
+                raise UploadRejected("File is not a complete PDF file", 415)
+
+
+class UploadWriter:
+    """File an upload is streamed into, hashing and type-checking the bytes as they arrive.
+
+    Bytes are appended to path, so a writer can continue a partial file. The
+    file is checked when the first SNIFF_BYTES have arrived and again by
+    finish(), which moves it to its final place.
+    """
+
+    def __init__(self, path, extension, max_bytes=MAX_UPLOAD_BYTES, sha=None):
+        self.path = path
+        self.extension = extension
+        self.max_bytes = max_bytes
+        self.file = open(path, 'ab+')
+        self.size = self.file.tell()
+        self.file.seek(0)
+        self.head = self.file.read(SNIFF_BYTES)
+        self.checked = len(self.head) >= SNIFF_BYTES
+        self.finished = False
+        if sha is None:
+            # Continuing a file another process started: hash what is already there
+            sha = hashlib.sha256()
+            self.file.seek(0)
+            for block in iter(lambda: self.file.read(UPLOAD_BLOCK_SIZE), b''):
+                sha.update(block)
+        self.sha = sha
+
+    def _check_head(self):
+        self.checked = True
+        if not HEAD_CHECKS[self.extension](self.head):
+            raise UploadRejected(f"File content does not match a {TYPE_NAMES[self.extension]}", 415)
+
+    def write(self, data):
+        if self.size + len(data) > self.max_bytes:
+            raise UploadRejected(f"File is larger than {self.max_bytes // (1024 * 1024)}MB", 413)
+        if not self.checked:
+            self.head += data[:SNIFF_BYTES - len(self.head)]
+            if len(self.head) >= SNIFF_BYTES:
+                self._check_head()
+        self.sha.update(data)
+        self.file.write(data)
+        self.size += len(data)
+        return len(data)
+
+    def copy_from(self, stream):
+        """Append a readable stream a block at a time"""
+        for block in iter(lambda: stream.read(UPLOAD_BLOCK_SIZE), b''):
+            self.write(block)
+
+    # The multipart parser rewinds the file once it has been written
+    def seek(self, offset, whence=0):
+        return self.file.seek(offset, whence)
+
+    def read(self, size=-1):
+        return self.file.read(size)
+
+    def close(self):
+        self.file.close()
+
+    def finish(self, destination):
+        """Check the complete file and move it to destination; returns its SHA-256"""
+        if self.size == 0:
+            raise UploadRejected("File is empty")
+        if not self.checked:
+            self._check_head()
+        self.file.close()
+        _check_complete(self.path, self.extension)
+        os.replace(self.path, destination)
+        self.finished = True
+        return self.sha.hexdigest()
+
+    def discard(self):
+        """Close the writer and delete the partial file unless it was finished"""
+        self.file.close()
+        if not self.finished and os.path.exists(self.path):
+            os.remove(self.path)
+
+
+def open_upload(filename, directory=PARTIAL_UPLOAD_DIR):
+    """UploadWriter for a file sent in one request; UploadRejected for a type that is not accepted"""
+    extension = check_extension(filename)
+    os.makedirs(directory, exist_ok=True)
+    return UploadWriter(os.path.join(directory, f"{uuid.uuid4().hex}.part"), extension)
+
+
+class ResumableUploads:
+    """Uploads received in chunks over several requests.
+
+    Each upload is a partial file and a small JSON record in directory, so
+    any worker process on the node can take the next chunk. A lock on the
+    partial file keeps two requests from appending at once. The running hash
+    is kept by the process that received the last chunk; another process
+    hashes the partial file again before it appends.
+    """
+
+    def __init__(self, directory=PARTIAL_UPLOAD_DIR, max_bytes=MAX_UPLOAD_BYTES,
+                 expiry_seconds=RESUMABLE_EXPIRY_SECONDS):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.expiry_seconds = expiry_seconds
+        # upload_id -> (size, sha256 object) after the chunks this process appended
+        self._hashes = {}
+        self._lock = threading.Lock()
+
+    def _paths(self, upload_id):
+        base = os.path.join(self.directory, upload_id)
+        return f"{base}.part", f"{base}.json"
+
+    def create(self, filename, size, session_id):
+        """Start an upload of size bytes; returns its record"""
+        extension = check_extension(filename)
+        if type(size) is not int or size <= 0:
+            raise UploadRejected("Upload size must be a positive number of bytes")
+        if size > self.max_bytes:
+            raise UploadRejected(f"File is larger than {self.max_bytes // (1024 * 1024)}MB", 413)
+        os.makedirs(self.directory, exist_ok=True)
+        self._prune()
+        upload_id = uuid.uuid4().hex
+        record = {"upload_id": upload_id, "filename": safe_filename(filename), "extension": extension, "size": size,
+                  "session_id": session_id, "created_at": time.time()}
+        part_path, record_path = self._paths(upload_id)
+        open(part_path, 'wb').close()
+        with open(record_path, 'w') as f:
+            json.dump(record, f)
+        record["offset"] = 0
+        return record
+
+    def get(self, upload_id, session_id):
+        """Record of an upload of the session with its current offset, or None"""
+        if not upload_id.isalnum():
+            return None
+        part_path, record_path = self._paths(upload_id)
+        try:
+            with open(record_path) as f:
+                record = json.load(f)
+            record["offset"] = os.path.getsize(part_path)
+        except (OSError, ValueError):
+            return None
+        return record if record["session_id"] == session_id else None
+
+    def append(self, record, offset, stream, destination):
+        """Append a chunk sent for offset. Returns the new offset, and the SHA-256 of the
+        file once its last byte arrived and it was moved to destination (else None)."""
+        upload_id = record["upload_id"]
+        part_path, _ = self._paths(upload_id)
+        with open(part_path, 'ab') as lock:
+            try:
+                fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                raise UploadRejected("Another chunk of this upload is being received", 409)
+            current = os.path.getsize(part_path)
+            if offset != current:
+                raise UploadRejected(f"Upload is at offset {current}, not {offset}", 409)
+            with self._lock:
+                size, sha = self._hashes.pop(upload_id, (None, None))
+            writer = UploadWriter(part_path, record["extension"], max_bytes=record["size"],
+                                  sha=sha if size == current else None)
+            rejected = False
+            try:
+                writer.copy_from(stream)
+                if writer.size < record["size"]:
+                    return writer.size, None
+                return writer.size, writer.finish(destination)
+            except UploadRejected as e:
+                # Content that is not of the declared type does not get better with more chunks
+                rejected = e.status == 415
+                raise
+            finally:
+                writer.close()
+                if rejected:
+                    self.remove(upload_id)
+                elif not writer.finished:
+                    # Bytes received before a rejected or dropped chunk are kept for the retry
+                    with self._lock:
+                        self._hashes[upload_id] = (writer.size, writer.sha)
+
+    def restore(self, record, path):
+        """Put a finished upload back, e.g. when no ingestion job could be started for it"""
+        os.replace(path, self._paths(record["upload_id"])[0])
+
+    def remove(self, upload_id):
+        with self._lock:
+            self._hashes.pop(upload_id, None)
+        for path in self._paths(upload_id):
+            if os.path.exists(path):
+                os.remove(path)
+
+    def _prune(self):
+        """Delete uploads that received no chunk for expiry_seconds, and files left by stopped processes"""
+        cutoff = time.time() - self.expiry_seconds
+        for name in os.listdir(self.directory):
+            upload_id, extension = os.path.splitext(name)
+            try:
+                if extension == '.part' and os.path.getmtime(os.path.join(self.directory, name)) < cutoff:
+                    self.remove(upload_id)
+            except OSError:
+                pass
+
+
+resumable_uploads = ResumableUploads()
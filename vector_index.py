@@ -0,0 +1,209 @@
+import zlib
+import numpy as np
+
+from search_index import TOKEN_PATTERN
+
+# Dense retrieval backend kept next to the in-memory document store. Chunk
+# vectors live in a single contiguous float32 matrix (optionally backed by a
+# memory-mapped file) and queries are answered with one matrix-vector product
+# followed by an argpartition top-k.
+
+
+class HashingEmbedder:
+    """Deterministic local embedder based on hashed word and character n-grams.
+
+    Needs no network or model download, so retrieval can be exercised offline
+    and gives stable vectors across processes (crc32 rather than hash()).
+    """
+
+    name = "hashing"
+
+    def __init__(self, dim=512, char_ngrams=(3, 4, 5)):
+        self.dim = dim
+        self.char_ngrams = char_ngrams
+
+    def _features(self, text):
+        words = TOKEN_PATTERN.findall(text.lower())
+        for word in words:
+            yield word, 1.0
+            padded = f" {word} "
+            for n in self.char_ngrams:
+                for i in range(len(padded) - n + 1):
+                    yield padded[i:i + n], 0.5
+        for first, second in zip(words, words[1:]):
+            yield f"{first} {second}", 1.0
+
+    def embed(self, texts):
+        vectors = np.zeros((len(texts), self.dim), dtype=np.float32)
+        for row, text in enumerate(texts):
+            for feature, weight in self._features(text):
+                h = zlib.crc32(feature.encode('utf-8'))
+                vectors[row, h % self.dim] += weight if h & 0x80000000 else -weight
+        norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+        norms[norms == 0] = 1.0
+        return vectors / norms
+
+
+class OpenAIEmbedder:
+    """Embedder backed by the OpenAI embeddings endpoint"""
+
+    name = "openai"
+
+    def __init__(self, model="text-embedding-3-small", dim=1536):
+        from llm_gateway import llm_gateway
+        self.gateway = llm_gateway
+        self.model = model
+        self.dim = dim
+
+    def embed(self, texts):
+        vectors = np.asarray(self.gateway.embed(texts, self.model), dtype=np.float32)
+        norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+        norms[norms == 0] = 1.0
+        return vectors / norms
+
+
+EMBEDDERS = {
+    "hashing": HashingEmbedder,
+    "openai": OpenAIEmbedder,
+}
+
+
+def create_embedder(name):
+    if name not in EMBEDDERS:
+        raise ValueError(f"Unknown embedding backend: {name}")
+    return EMBEDDERS[name]()
+
+
+class VectorIndex:
+    """Top-k cosine search over a contiguous float32 matrix of chunk vectors"""
+
+    def __init__(self, embedder, path=None, capacity=1024, batch_size=64):
+        self.embedder = embedder
+        self.dim = embedder.dim
+        self.path = path
+        self.batch_size = batch_size
+        self.initial_capacity = capacity
+        self.clear()
+
+    def clear(self):
+        self.doc_ids = []
+        self.rows = {}
+        self.size = 0
+        self.live = np.zeros(self.initial_capacity, dtype=bool)
+        self.matrix = self._allocate(self.initial_capacity)
+
+    def __len__(self):
+        return len(self.rows)
+
+    def _allocate(self, capacity):
+        if self.path:
+            return np.memmap(self.path, dtype=np.float32, mode='w+', shape=(capacity, self.dim))
+        return np.zeros((capacity, self.dim), dtype=np.float32)
+
+    def _reserve(self, extra):
+        capacity = self.matrix.shape[0]
+        needed = self.size + extra
+        if needed <= capacity:
+            return
+        while capacity < needed:
+            capacity *= 2
+        if self.path:
+            # Copy through RAM before the backing file is recreated at the new size
+            existing = np.array(self.matrix[:self.size])
+            del self.matrix
+            self.matrix = self._allocate(capacity)
+            self.matrix[:self.size] = existing
+        else:
+            matrix = self._allocate(capacity)
+            matrix[:self.size] = self.matrix[:self.size]
+            self.matrix = matrix
+        live = np.zeros(capacity, dtype=bool)
+        live[:self.size] = self.live[:self.size]
+        self.live = live
+
+    def add(self, doc_ids, texts):
+        """Embed texts in batches and append them to the matrix"""
+        doc_ids = list(doc_ids)
+        texts = list(texts)
+        self._reserve(len(doc_ids))
+        for start in range(0, len(texts), self.batch_size):
+            self._append(doc_ids[start:start + self.batch_size],
+                         self.embedder.embed(texts[start:start + self.batch_size]))
+        if self.path:
+            self.matrix.flush()
+
+    def add_vectors(self, doc_ids, vectors):
+        """Append already embedded vectors (one row per doc_id)"""
+        doc_ids = list(doc_ids)
+        self._reserve(len(doc_ids))
+        self._append(doc_ids, vectors)
+        if self.path:
+            self.matrix.flush()
+
+    def _append(self, doc_ids, vectors):
+        for doc_id in doc_ids:
+            self.remove(doc_id)
+        end = self.size + len(doc_ids)
+        self.matrix[self.size:end] = vectors
+        self.live[self.size:end] = True
+        for offset, doc_id in enumerate(doc_ids):
+            self.rows[doc_id] = self.size + offset
+            self.doc_ids.append(doc_id)
+        self.size = end
+
+    def live_vectors(self):
+        """(doc_ids, matrix) of the searchable rows, in the order they were added"""
+        rows = sorted(self.rows.items(), key=lambda item: item[1])
+        return [doc_id for doc_id, _ in rows], np.array(self.matrix[[row for _, row in rows]], dtype=np.float32)
+
+    def remove(self, doc_id):
+        row = self.rows.pop(doc_id, None)
+        if row is None:
+            return False
+        self.live[row] = False
+        return True
+
+    def scores(self, query):
+        """Cosine similarity of the query against every row (dead rows score -inf)"""
+        query_vector = self.embedder.embed([query])[0]
+        scores = self.matrix[:self.size] @ query_vector
+        scores[~self.live[:self.size]] = -np.inf
+        return scores
+
+    def _top_k(self, scores, top_k):
+        top_k = min(top_k, len(self.rows))
+        if top_k <= 0:
+            return []
+        candidates = np.argpartition(-scores, top_k - 1)[:top_k]
+        ordered = candidates[np.argsort(-scores[candidates])]
+        return [(self.doc_ids[row], float(scores[row])) for row in ordered if np.isfinite(scores[row])]
+
+    def search(self, query, top_k=5):
+        """Return up to top_k (doc_id, score) pairs by cosine similarity"""
+        if not self.rows:
+            return []
+        return self._top_k(self.scores(query), top_k)
+
+    def hybrid_search(self, query, lexical_hits, top_k=5, alpha=0.5):
+        """Fuse dense scores with lexical (doc_id, score) hits.
+
+        Both score sets are scaled to [0, 1] before mixing; alpha is the weight
+        of the dense side. Lexical hits for documents without a vector are
+        ignored.
+        """
+        if not self.rows:
+            return lexical_hits[:top_k]
+        dense = self.scores(query)
+        finite = np.isfinite(dense)
+        if finite.any():
+            low, high = dense[finite].min(), dense[finite].max()
+            dense[finite] = (dense[finite] - low) / (high - low) if high > low else 1.0
+        combined = alpha * dense
+
+        if lexical_hits:
+            top_lexical = max(score for _, score in lexical_hits) or 1.0
+            for doc_id, score in lexical_hits:
+                row = self.rows.get(doc_id)
+                if row is not None:
+                    combined[row] += (1 - alpha) * score / top_lexical
+        return self._top_k(combined, top_k)